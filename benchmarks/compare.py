@@ -0,0 +1,73 @@
+import argparse
+import json
+import sys
+from typing import Any, Dict, List, Optional, Tuple
+
+# Compares two result files of benchmarks.run, scenario by scenario. A metric counts as a regression when it got
+# worse by more than the threshold, relative to the base run. Exits with 1 when any did, so it can gate a change.
+#
+#   python -m benchmarks.compare before.json after.json --threshold 0.1
+
+# metric path in a scenario's results, and whether higher values are better.
+METRICS: List[Tuple[Tuple[str, ...], bool]] = [
+    (("throughput_per_second",), True),
+    (("latency_ms", "p50"), False),
+    (("latency_ms", "p99"), False),
+    (("first_call_ms",), False),
+    (("sizes", "request_bytes"), False),
+    (("sizes", "response_bytes"), False),
+    (("sizes", "blob_put_bytes"), False),
+    (("sizes", "blob_get_bytes"), False),
+]
+
+
+def lookup(results: Dict[str, Any], path: Tuple[str, ...]) -> Optional[float]:
+    for key in path:
+        if not isinstance(results, dict) or key not in results:
+            return None
+        results = results[key]
+    return results
+
+
+def compare(base: Dict[str, Any], new: Dict[str, Any], threshold: float) -> List[Dict[str, Any]]:
+    rows = []
+    for scenario in sorted(set(base["scenarios"]) & set(new["scenarios"])):
+        for path, is_higher_better in METRICS:
+            base_value = lookup(base["scenarios"][scenario], path)
+            new_value = lookup(new["scenarios"][scenario], path)
+            if base_value is None or new_value is None:
+                continue
+            change = (new_value - base_value) / base_value if base_value else 0.0
+            worse = -change if is_higher_better else change
+            rows.append({"scenario": scenario, "metric": ".".join(path), "base": base_value, "new": new_value,
+                         "change": change, "is_regression": worse > threshold})
+    return rows
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="compares two benchmark result files")
+    parser.add_argument("base")
+    parser.add_argument("new")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative change past which a metric that got worse is a regression")
+    arguments = parser.parse_args(argv)
+    with open(arguments.base) as file:
+        base = json.load(file)
+    with open(arguments.new) as file:
+        new = json.load(file)
+    if base.get("schema") != new.get("schema"):
+        raise Exception(f"result files have different schemas: {base.get('schema')} and {new.get('schema')}")
+    print(f"base: {base.get('commit')}, new: {new.get('commit')}")
+    rows = compare(base, new, arguments.threshold)
+    for row in rows:
+        marker = " <- regression" if row["is_regression"] else ""
+        print(f"{row['scenario']:<24} {row['metric']:<22} {row['base']:>14.2f} {row['new']:>14.2f} "
+              f"{row['change']:>+8.1%}{marker}")
+    for scenario in sorted(set(base["scenarios"]) ^ set(new["scenarios"])):
+        print(f"{scenario:<24} only in {'base' if scenario in base['scenarios'] else 'new'}")
+    if any(row["is_regression"] for row in rows):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
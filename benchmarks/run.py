@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import importlib
+import json
+import math
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+from benchmarks.settings import COLD_START_DELAY_VARIABLE, IDLE_TIMEOUT_VARIABLE, ROOT_VARIABLE
+
+# Offline benchmark suite. Runs the real client path, LambdaBuilder, the engine, codecs, project shipping and the
+# handler, against FakeLambdaClient, whose containers are local processes. Every scenario reports throughput, latency
+# percentiles, bytes on the wire and the stage timings of its calls, gathered from traces so calls made inside
+# containers are counted too. Results are written as json, compare two runs with benchmarks.compare.
+#
+#   python -m benchmarks.run --output before.json
+#   python -m benchmarks.run --output after.json --scenarios tiny_sequential,fan_out
+#   python -m benchmarks.compare before.json after.json
+SCHEMA_VERSION = 1
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    # nearest rank, no interpolation between samples.
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Calls made by a scenario, with the builder they go through. call takes the index of the call, warmup calls are
+# made first, with the scenario's concurrency so as many containers are warm as calls will run at once, and are left
+# out of every number except first_call_ms, the latency of the very first call, which pays for a cold container and
+# shipping the whole project.
+class Scenario:
+    def __init__(self, name: str, call: Callable[[int], Any], builder: Any, sink: Any, calls: int,
+                 concurrency: int = 1, warmup: int = 1, directory: Optional[str] = None):
+        self.name = name
+        self.call = call
+        self.builder = builder
+        self.sink = sink
+        self.calls = calls
+        self.concurrency = concurrency
+        self.warmup = warmup
+        # working directory the project is snapshotted from, the checkout when None.
+        self.directory = directory
+
+
+def timed(call: Callable[[int], Any], index: int) -> float:
+    start = time.perf_counter()
+    call(index)
+    return (time.perf_counter() - start) * 1000
+
+
+def summarize_spans(spans: List[Dict[str, Any]]) -> Dict[str, Any]:
+    sizes: Dict[str, int] = {}
+    for span in spans:
+        for name, size in span["sizes"].items():
+            sizes[name] = sizes.get(name, 0) + size
+    client_spans = [span for span in spans if span["kind"] == "client"]
+    top_span_ids = {span["span_id"] for span in client_spans if span["parent_id"] is None}
+    handler_spans = [span for span in spans if span["kind"] == "handler"]
+
+    def mean_stages(selected: List[Dict[str, Any]], key: str = "stages") -> Dict[str, float]:
+        totals: Dict[str, float] = {}
+        for span in selected:
+            for stage, duration in span[key].items():
+                totals[stage] = totals.get(stage, 0.0) + duration
+        return {stage: total / len(selected) for stage, total in sorted(totals.items())} if selected else {}
+
+    cold_spans = [span for span in handler_spans if span["cold"] and span["parent_id"] in top_span_ids]
+
+    return {
+        "invocations": len(client_spans),
+        "cold_starts": sum(1 for span in handler_spans if span["cold"]),
+        "sizes": dict(sorted(sizes.items())),
+        # mean stage timings of the calls the scenario made itself, nested calls are part of their "call" stage.
+        "client_stages_ms": mean_stages([span for span in client_spans if span["span_id"] in top_span_ids]),
+        "handler_stages_ms": mean_stages([span for span in handler_spans if span["parent_id"] in top_span_ids]),
+        # first invocations of containers: their handler time, and what the init phase did before them.
+        "cold_handler_ms": sum(span["duration_ms"] for span in cold_spans) / len(cold_spans) if cold_spans else None,
+        "init_stages_ms": mean_stages([span for span in cold_spans if "init_stages" in span], "init_stages"),
+    }
+
+
+def run_scenario(scenario: Scenario) -> Dict[str, Any]:
+    print(f"running {scenario.name}: {scenario.calls} calls, concurrency {scenario.concurrency}")
+    with ThreadPoolExecutor(max_workers=scenario.concurrency) as executor:
+        first_call_ms = timed(scenario.call, 0)
+        list(executor.map(lambda index: timed(scenario.call, index), range(1, scenario.warmup)))
+        scenario.sink.spans.clear()
+        start = time.perf_counter()
+        latencies = list(executor.map(lambda index: timed(scenario.call, index),
+                                      range(scenario.warmup, scenario.warmup + scenario.calls)))
+        seconds = time.perf_counter() - start
+    result = {
+        "calls": scenario.calls,
+        "concurrency": scenario.concurrency,
+        "seconds": seconds,
+        "throughput_per_second": scenario.calls / seconds,
+        "first_call_ms": first_call_ms,
+        "latency_ms": {"p50": percentile(latencies, 0.5), "p99": percentile(latencies, 0.99),
+                       "mean": sum(latencies) / len(latencies), "max": max(latencies)},
+        **summarize_spans(list(scenario.sink.spans)),
+    }
+    print(f"  {result['throughput_per_second']:.1f} calls/s, p50 {result['latency_ms']['p50']:.1f}ms, "
+          f"p99 {result['latency_ms']['p99']:.1f}ms, {result['sizes'].get('request_bytes', 0)} bytes sent, "
+          f"{result['sizes'].get('response_bytes', 0)} bytes received")
+    return result
+
+
+# A project of depth nested packages below a "deep" package, each holding modules_per_package modules of about
+# module_bytes of source, with the benchmarked function in the innermost package. Importing it imports every package
+# on the way down and every package imports its modules, so the whole tree is in the function's import closure.
+# benchmarks and src are linked in from this checkout. Returns the module name of the function.
+def generate_deep_project(root: str, depth: int, modules_per_package: int, module_bytes: int) -> str:
+    package = ["deep"]
+    for level in range(depth + 1):
+        directory = os.path.join(root, *package)
+        os.makedirs(directory, exist_ok=True)
+        modules = [f"module{index}" for index in range(modules_per_package)] if level > 0 else []
+        with open(os.path.join(directory, "__init__.py"), "w") as file:
+            file.write("".join(f"from . import {module}\n" for module in modules))
+        for module in modules:
+            write_module(os.path.join(directory, f"{module}.py"), module_bytes, random.Random(f"{level}{module}"))
+        package.append(f"level{level}")
+    with open(os.path.join(root, *package[:-1], "leaf.py"), "w") as file:
+        file.write("from benchmarks.scenarios import make_builder\n"
+                   "from src.bauplan.tracing import MemorySink\n\n"
+                   "sink = MemorySink()\n"
+                   "env = make_builder(sink)\n\n\n"
+                   "@env.cloud_execute()\n"
+                   "def deep_call(x: int) -> int:\n"
+                   "    return x + 1\n")
+    return ".".join(package[:-1] + ["leaf"])
+
+
+# A function whose module imports a dependency taking import_seconds to import, standing in for numpy and the like,
+# called on a fresh container every time. The preloaded variant bakes the project into the handler and imports the
+# dependency in the init phase. Returns the module names of both.
+def generate_cold_project(root: str, import_seconds: float) -> List[str]:
+    directory = os.path.join(root, "cold")
+    os.makedirs(directory)
+    with open(os.path.join(directory, "__init__.py"), "w") as file:
+        file.write("")
+    with open(os.path.join(directory, "heavy_dependency.py"), "w") as file:
+        file.write(f"import time\n\ntime.sleep({import_seconds})\n")
+    modules = []
+    for name, params in (("cold", ""), ("preloaded", ", preload=['cold.heavy_dependency'], preload_project=True")):
+        with open(os.path.join(directory, f"{name}.py"), "w") as file:
+            file.write("from benchmarks.scenarios import make_builder\n"
+                       "from src.bauplan.tracing import MemorySink\n"
+                       "from cold import heavy_dependency\n\n"
+                       "sink = MemorySink()\n"
+                       f"env = make_builder(sink, idle_timeout=0.0{params})\n\n\n"
+                       "@env.cloud_execute()\n"
+                       "def cold_call(x: int) -> int:\n"
+                       "    return x + 1\n")
+        modules.append(f"cold.{name}")
+    return modules
+
+
+def write_module(path: str, module_bytes: int, generator: random.Random) -> None:
+    lines = ["VALUES = ["]
+    size = len(lines[0])
+    while size < module_bytes:
+        line = "    " + ", ".join(str(generator.randrange(10 ** 9)) for _ in range(8)) + ","
+        lines.append(line)
+        size += len(line) + 1
+    lines.append("]\n")
+    with open(path, "w") as file:
+        file.write("\n".join(lines))
+
+
+def build_scenarios(selected: List[str], arguments: argparse.Namespace, project_root: str) -> List[Scenario]:
+    from benchmarks import scenarios
+
+    small_data = random.Random(0).randbytes(512 * 1024)
+    large_data = random.Random(1).randbytes(16 * 1024 * 1024)
+    scenarios_by_name = {
+        "tiny_sequential": lambda: Scenario("tiny_sequential", lambda index: scenarios.add(index, 1), scenarios.env,
+                                            scenarios.sink, arguments.calls),
+        "tiny_concurrent": lambda: Scenario("tiny_concurrent", lambda index: scenarios.add(index, 1), scenarios.env,
+                                            scenarios.sink, arguments.calls, concurrency=arguments.concurrency,
+                                            warmup=arguments.concurrency),
+        # below the offload threshold the argument travels in the payload, above it through the blob store.
+        "large_args": lambda: Scenario("large_args", lambda index: scenarios.checksum(small_data), scenarios.env,
+                                       scenarios.sink, max(1, arguments.calls // 10)),
+        "large_args_offloaded": lambda: Scenario("large_args_offloaded", lambda index: scenarios.checksum(large_data),
+                                                 scenarios.env, scenarios.sink, max(1, arguments.calls // 20)),
+        "fan_out": lambda: Scenario("fan_out", lambda index: asyncio.run(
+            scenarios.fan_out(arguments.fan_out_depth, arguments.fan_out_width)), scenarios.env, scenarios.sink,
+                                    max(1, arguments.calls // 20)),
+    }
+    result = [scenarios_by_name[name]() for name in selected if name in scenarios_by_name]
+    # generated projects link in benchmarks and src from this checkout.
+    repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for name in ("src", "benchmarks"):
+        os.symlink(os.path.join(repository, name), os.path.join(project_root, name))
+    if "cold_start" in selected or "cold_start_preloaded" in selected:
+        cold, preloaded = [importlib.import_module(name)
+                           for name in generate_cold_project(project_root, arguments.cold_import_seconds)]
+        # what a deploy would do, the handler is published with the preload file.
+        cwd = os.getcwd()
+        os.chdir(project_root)
+        try:
+            preloaded.env.lambda_client.publish_handler(preloaded.env.handler_files())
+        finally:
+            os.chdir(cwd)
+        # every call starts a container, warmup is skipped so the first call counts as well.
+        calls = max(1, arguments.calls // 10)
+        if "cold_start" in selected:
+            result.append(Scenario("cold_start", cold.cold_call, cold.env, cold.sink, calls, warmup=0,
+                                   directory=project_root))
+        if "cold_start_preloaded" in selected:
+            result.append(Scenario("cold_start_preloaded", preloaded.cold_call, preloaded.env, preloaded.sink, calls,
+                                   warmup=0, directory=project_root))
+    if "deep_project" in selected or "deep_project_edits" in selected:
+        module = importlib.import_module(generate_deep_project(project_root, arguments.deep_depth,
+                                                               arguments.deep_modules, arguments.deep_module_bytes))
+        edited_module = os.path.join(project_root, "deep", "level0", "module0.py")
+        # a module near the top of the tree changes before every call, only the delta is shipped.
+        def edit_and_call(index: int) -> int:
+            write_module(edited_module, arguments.deep_module_bytes, random.Random(index))
+            return module.deep_call(index)
+
+        if "deep_project" in selected:
+            result.append(Scenario("deep_project", module.deep_call, module.env, module.sink, arguments.calls,
+                                   directory=project_root))
+        if "deep_project_edits" in selected:
+            result.append(Scenario("deep_project_edits", edit_and_call, module.env, module.sink,
+                                   max(1, arguments.calls // 5), directory=project_root))
+    return sorted(result, key=lambda scenario: selected.index(scenario.name))
+
+
+SCENARIOS = ["tiny_sequential", "tiny_concurrent", "large_args", "large_args_offloaded", "deep_project",
+             "deep_project_edits", "fan_out", "cold_start", "cold_start_preloaded"]
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(description="offline benchmarks of the bauplan client against a fake lambda")
+    parser.add_argument("--output", default="benchmark.json", help="path of the json results")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma separated scenarios to run")
+    parser.add_argument("--calls", type=int, default=100, help="calls of the tiny scenarios, others scale from it")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--cold-start-delay", type=float, default=0.0,
+                        help="seconds added to every container start, standing in for lambda's init")
+    parser.add_argument("--idle-timeout", type=float, default=None,
+                        help="seconds after which idle containers are stopped, so later calls start cold")
+    parser.add_argument("--deep-depth", type=int, default=8)
+    parser.add_argument("--deep-modules", type=int, default=8)
+    parser.add_argument("--deep-module-bytes", type=int, default=4096)
+    parser.add_argument("--fan-out-depth", type=int, default=2)
+    parser.add_argument("--fan-out-width", type=int, default=4)
+    parser.add_argument("--cold-import-seconds", type=float, default=0.5,
+                        help="import time of the dependency of the cold start scenarios")
+    arguments = parser.parse_args(argv)
+    selected = arguments.scenarios.split(",")
+    unknown = [name for name in selected if name not in SCENARIOS]
+    if unknown:
+        raise Exception(f"unknown scenarios: {', '.join(unknown)}, available: {', '.join(SCENARIOS)}")
+
+    # set before the scenarios module is imported, containers inherit them and so do the fakes created inside them.
+    root = tempfile.mkdtemp(prefix="bauplan-benchmark-")
+    os.environ[ROOT_VARIABLE] = root
+    os.environ[COLD_START_DELAY_VARIABLE] = str(arguments.cold_start_delay)
+    if arguments.idle_timeout is not None:
+        os.environ[IDLE_TIMEOUT_VARIABLE] = str(arguments.idle_timeout)
+    project_root = os.path.join(root, "project")
+    os.makedirs(project_root)
+    cwd = os.getcwd()
+    results = {}
+    scenarios: List[Scenario] = []
+    try:
+        sys.path.insert(0, project_root)
+        scenarios = build_scenarios(selected, arguments, project_root)
+        for scenario in scenarios:
+            # projects are snapshotted from the working directory, generated projects are their own.
+            os.chdir(scenario.directory or cwd)
+            try:
+                results[scenario.name] = run_scenario(scenario)
+            finally:
+                os.chdir(cwd)
+    finally:
+        for builder in {id(scenario.builder): scenario.builder for scenario in scenarios}.values():
+            builder.shutdown()
+            builder.lambda_client.shutdown()
+        sys.path.remove(project_root)
+        shutil.rmtree(root, ignore_errors=True)
+    report = {
+        "schema": SCHEMA_VERSION,
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.time(),
+        "settings": {key: value for key, value in vars(arguments).items() if key not in ("output", "scenarios")},
+        "scenarios": results,
+    }
+    with open(arguments.output, "w") as file:
+        json.dump(report, file, indent=2, sort_keys=True)
+    print(f"results written to {arguments.output}")
+
+
+if __name__ == "__main__":
+    main()
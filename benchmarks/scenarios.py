@@ -0,0 +1,51 @@
+import asyncio
+import hashlib
+import os
+import tempfile
+from typing import Optional
+
+from benchmarks.settings import COLD_START_DELAY_VARIABLE, IDLE_TIMEOUT_VARIABLE, ROOT_VARIABLE
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.lambda_function import LocalBlobStore
+from src.bauplan.local_lambda import FakeLambdaClient
+from src.bauplan.tracing import MemorySink, Tracer
+
+# Functions the benchmarks call. This module is shipped to the fake lambda and executed there like any user code, so
+# the builder is created at import in every container as well: calls made from inside a container go to a fake of
+# their own, with containers nested in the benchmark's root directory. See settings.
+
+
+# idle_timeout overrides the setting, params go to the builder.
+def make_builder(sink: Optional[MemorySink] = None, idle_timeout: Optional[float] = None, **params) -> LambdaBuilder:
+    root = os.environ.get(ROOT_VARIABLE)
+    if idle_timeout is None and os.environ.get(IDLE_TIMEOUT_VARIABLE) is not None:
+        idle_timeout = float(os.environ[IDLE_TIMEOUT_VARIABLE])
+    client = FakeLambdaClient(tempfile.mkdtemp(prefix="lambda-", dir=root) if root is not None else None,
+                              cold_start_delay=float(os.environ.get(COLD_START_DELAY_VARIABLE, "0")),
+                              idle_timeout=idle_timeout)
+    # the blob store directory is shared by the driver and every container, like a bucket would be.
+    blob_store = LocalBlobStore(os.path.join(root, "blobs")) if root is not None else None
+    return LambdaBuilder("benchmark", "local", "bauplan", lambda_client=client, auto_deploy=False,
+                         blob_store=blob_store, tracer=Tracer(sink) if sink is not None else None, **params)
+
+
+sink = MemorySink()
+env = make_builder(sink)
+
+
+@env.cloud_execute()
+def add(a: int, b: int) -> int:
+    return a + b
+
+
+@env.cloud_execute()
+def checksum(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+# every call below depth 0 fans out to width calls, each a lambda of its own: 1 + width + width ** 2 ... invocations.
+@env.aio_cloud_execute()
+async def fan_out(depth: int, width: int) -> int:
+    if depth == 0:
+        return 1
+    return 1 + sum(await asyncio.gather(*[fan_out(depth - 1, width) for _ in range(width)]))
@@ -0,0 +1,5 @@
+# Settings of the fake lambda the benchmarks run against. They travel in environment variables, which containers
+# inherit, so the fakes created by code running inside a container simulate the same lambda as the driver's.
+ROOT_VARIABLE = "BAUPLAN_BENCHMARK_ROOT"
+COLD_START_DELAY_VARIABLE = "BAUPLAN_BENCHMARK_COLD_START_DELAY"
+IDLE_TIMEOUT_VARIABLE = "BAUPLAN_BENCHMARK_IDLE_TIMEOUT"
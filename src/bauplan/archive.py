@@ -0,0 +1,233 @@
+import fnmatch
+import hashlib
+import json
+import os
+import py_compile
+import struct
+import sys
+import tempfile
+import zlib
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+# Deployment archives. Files are pruned by configurable rules, optionally pre-compiled to .pyc for the target runtime,
+# and written in a deterministic layout: entries sorted by name, fixed timestamps and permissions and no extra fields,
+# so equal inputs give byte identical archives and stable hashes. A manifest written next to the archive records
+# the content digest of every member, so a rebuild copies the compressed bytes of unchanged members from the previous
+# archive instead of compressing (and compiling) them again.
+
+# the zip format's earliest timestamp, 1980-01-01 00:00:00 in dos date/time encoding.
+FIXED_DOS_DATE = (0 << 9) | (1 << 5) | 1
+FIXED_DOS_TIME = 0
+FILE_PERMISSIONS = 0o100644 << 16
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+UTF8_NAME_FLAG = 0x800
+VERSION = 20
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+END_OF_CENTRAL_DIRECTORY = struct.Struct("<IHHHHIIH")
+LOCAL_HEADER_SIGNATURE = 0x04034b50
+CENTRAL_HEADER_SIGNATURE = 0x02014b50
+END_OF_CENTRAL_DIRECTORY_SIGNATURE = 0x06054b50
+ZIP64_LIMIT = 0xFFFFFFFF
+
+
+class PruneRules:
+    def __init__(self,
+                 exclude_dirs: Iterable[str] = ("__pycache__", "tests", "test", "testing_data", "docs", "doc",
+                                                "examples", "benchmarks"),
+                 exclude_files: Iterable[str] = ("*.pyc", "*.pyo", "*.pyi", "*.pxd", "*.c", "*.h", "*.cpp",
+                                                 "*.md", "*.rst"),
+                 dist_info_keep: Iterable[str] = ("METADATA", "entry_points.txt", "top_level.txt"),
+                 include: Iterable[str] = (),
+                 prune_packages: bool = False):
+        # directory names dropped anywhere in the tree. Directories holding an __init__.py are importable and may be
+        # imported at runtime (botocore.docs is), they are only dropped with prune_packages.
+        self.exclude_dirs = set(exclude_dirs)
+        self.prune_packages = prune_packages
+        # file name patterns dropped anywhere in the tree.
+        self.exclude_files = list(exclude_files)
+        # .dist-info directories only keep these files, importlib.metadata and entry points still work.
+        self.dist_info_keep = set(dist_info_keep)
+        # relative path patterns kept regardless of the rules above.
+        self.include = list(include)
+
+    # the rules as json, part of the key of archives built with them.
+    def spec(self) -> Dict[str, Any]:
+        return {"exclude_dirs": sorted(self.exclude_dirs), "exclude_files": self.exclude_files,
+                "dist_info_keep": sorted(self.dist_info_keep), "include": self.include,
+                "prune_packages": self.prune_packages}
+
+    # packages are the relative paths of the directories holding an __init__.py.
+    def keeps(self, relative_path: str, packages: Iterable[str] = ()) -> bool:
+        if any(fnmatch.fnmatch(relative_path, pattern) for pattern in self.include):
+            return True
+        *folders, filename = relative_path.split("/")
+        for depth, folder in enumerate(folders):
+            if folder in self.exclude_dirs and (self.prune_packages or "/".join(folders[:depth + 1]) not in packages):
+                return False
+        if folders and folders[-1].endswith(".dist-info"):
+            return filename in self.dist_info_keep
+        return not any(fnmatch.fnmatch(filename, pattern) for pattern in self.exclude_files)
+
+
+NO_PRUNING = PruneRules(exclude_dirs=(), exclude_files=(), dist_info_keep=(), include=("*",))
+
+
+def runtime_cache_tag(runtime: str) -> str:
+    # "python3.10" -> "cpython-310"
+    return f"cpython-{runtime.replace('python', '').replace('.', '')}"
+
+
+def compile_source(path: str, arcname: str) -> bytes:
+    # unchecked hash based pycs embed no timestamp, they are deterministic and never re-validated against the source.
+    with tempfile.TemporaryDirectory() as directory:
+        compiled_path = os.path.join(directory, "compiled.pyc")
+        py_compile.compile(path, cfile=compiled_path, dfile=arcname, doraise=True,
+                           invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        with open(compiled_path, "rb") as file:
+            return file.read()
+
+
+def compress(data: bytes, level: int) -> Tuple[int, bytes]:
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    if len(compressed) >= len(data):
+        return ZIP_STORED, data
+    return ZIP_DEFLATED, compressed
+
+
+def collect_files(source_dir: str, prune_rules: PruneRules) -> Dict[str, str]:
+    paths = {}
+    packages = set()
+    for root, _, filenames in os.walk(source_dir):
+        relative_root = os.path.relpath(root, source_dir).replace(os.sep, "/")
+        if "__init__.py" in filenames:
+            packages.add(relative_root)
+        for filename in filenames:
+            paths[f"{relative_root}/{filename}" if relative_root != "." else filename] = os.path.join(root, filename)
+    return {relative_path: path for relative_path, path in paths.items() if prune_rules.keeps(relative_path, packages)}
+
+
+def load_manifest(output_path: str) -> Dict[str, Dict[str, Any]]:
+    manifest_path = f"{output_path}.manifest.json"
+    if not os.path.exists(output_path) or not os.path.exists(manifest_path):
+        return {}
+    with open(manifest_path) as file:
+        return json.load(file)
+
+
+def build_archive(source_dir: str, output_path: str, prune_rules: Optional[PruneRules] = None,
+                  compile_for: Optional[str] = None, compression_level: int = 6, prefix: str = "") -> Dict[str, Any]:
+    # compile_for is the lambda runtime, e.g. "python3.10". Byte code is only valid for the interpreter version that
+    # produced it, so pycs are only added when the local interpreter matches the runtime.
+    prune_rules = prune_rules or PruneRules()
+    local_runtime = f"python{sys.version_info.major}.{sys.version_info.minor}"
+    compile_pyc = compile_for is not None and compile_for == local_runtime
+    if compile_for is not None and not compile_pyc:
+        print(f"not pre-compiling: local {local_runtime} does not match runtime {compile_for}")
+
+    files = collect_files(source_dir, prune_rules)
+    previous_manifest = load_manifest(output_path)
+    previous_archive = open(output_path, "rb") if previous_manifest else None
+    manifest: Dict[str, Dict[str, Any]] = {}
+    members: List[Tuple[str, Dict[str, Any], bytes]] = []
+    reused = 0
+    try:
+        # (name in the archive, file on disk, name of the source the member is compiled from or None)
+        entries: List[Tuple[str, str, Optional[str]]] = []
+        for relative_path, path in files.items():
+            arcname = f"{prefix}{relative_path}"
+            entries.append((arcname, path, None))
+            if compile_pyc and relative_path.endswith(".py"):
+                folder, filename = os.path.split(arcname)
+                compiled_name = f"{filename[:-3]}.{runtime_cache_tag(compile_for)}.pyc"
+                entries.append((f"{folder}/__pycache__/{compiled_name}" if folder else f"__pycache__/{compiled_name}",
+                                path, arcname))
+        for arcname, path, source_arcname in sorted(entries):
+            is_compiled = source_arcname is not None
+            # members are matched on content rather than mtime, a reinstall of the same wheels reuses everything.
+            with open(path, "rb") as file:
+                content = file.read()
+            stamp = [hashlib.sha256(content).hexdigest(), is_compiled, compression_level]
+            previous = previous_manifest.get(arcname)
+            if previous is not None and previous["stamp"] == stamp:
+                previous_archive.seek(previous["offset"] + LOCAL_HEADER.size + len(arcname.encode("utf-8")))
+                data = previous_archive.read(previous["compressed_size"])
+                member = {key: previous[key] for key in ("stamp", "crc", "size", "compressed_size", "method")}
+                reused += 1
+            else:
+                if is_compiled:
+                    content = compile_source(path, source_arcname)
+                method, data = compress(content, compression_level)
+                member = {"stamp": stamp, "crc": zlib.crc32(content), "size": len(content),
+                          "compressed_size": len(data), "method": method}
+            members.append((arcname, member, data))
+    finally:
+        if previous_archive is not None:
+            previous_archive.close()
+
+    partial_path = f"{output_path}.partial"
+    with open(partial_path, "wb") as archive:
+        central_directory = []
+        for arcname, member, data in members:
+            name = arcname.encode("utf-8")
+            flags = 0 if arcname.isascii() else UTF8_NAME_FLAG
+            member["offset"] = archive.tell()
+            if member["offset"] > ZIP64_LIMIT or member["size"] > ZIP64_LIMIT:
+                raise Exception("archive too large, zip64 is not supported")
+            archive.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIGNATURE, VERSION, flags, member["method"], FIXED_DOS_TIME,
+                                            FIXED_DOS_DATE, member["crc"], member["compressed_size"], member["size"],
+                                            len(name), 0))
+            archive.write(name)
+            archive.write(data)
+            central_directory.append(CENTRAL_HEADER.pack(CENTRAL_HEADER_SIGNATURE, VERSION, VERSION, flags,
+                                                         member["method"], FIXED_DOS_TIME, FIXED_DOS_DATE,
+                                                         member["crc"], member["compressed_size"], member["size"],
+                                                         len(name), 0, 0, 0, 0, FILE_PERMISSIONS, member["offset"])
+                                     + name)
+            manifest[arcname] = member
+        if len(central_directory) > 0xFFFF:
+            raise Exception("archive has too many entries, zip64 is not supported")
+        central_directory_offset = archive.tell()
+        central_directory_bytes = b"".join(central_directory)
+        archive.write(central_directory_bytes)
+        archive.write(END_OF_CENTRAL_DIRECTORY.pack(END_OF_CENTRAL_DIRECTORY_SIGNATURE, 0, 0, len(central_directory),
+                                                    len(central_directory), len(central_directory_bytes),
+                                                    central_directory_offset, 0))
+    os.replace(partial_path, output_path)
+    with open(f"{output_path}.manifest.json", "w") as file:
+        json.dump(manifest, file)
+
+    with open(output_path, "rb") as file:
+        sha256 = hashlib.sha256(file.read()).hexdigest()
+    return {"path": output_path, "sha256": sha256, "size": os.path.getsize(output_path), "members": len(members),
+            "reused_members": reused, "pruned_files": count_files(source_dir) - len(files),
+            "packages": size_breakdown(manifest, prefix)}
+
+
+def count_files(source_dir: str) -> int:
+    return sum(len(filenames) for _, _, filenames in os.walk(source_dir))
+
+
+# sizes per top level package, what a cold start has to download and unpack.
+def size_breakdown(manifest: Dict[str, Dict[str, Any]], prefix: str = "") -> Dict[str, Dict[str, int]]:
+    breakdown: Dict[str, Dict[str, int]] = {}
+    for arcname, member in manifest.items():
+        top_level = arcname[len(prefix):].split("/")[0]
+        if top_level.endswith(".dist-info"):
+            top_level = "*.dist-info"
+        package = breakdown.setdefault(top_level, {"files": 0, "size": 0, "compressed_size": 0})
+        package["files"] += 1
+        package["size"] += member["size"]
+        package["compressed_size"] += member["compressed_size"]
+    return dict(sorted(breakdown.items(), key=lambda item: -item[1]["compressed_size"]))
+
+
+def print_archive_report(report: Dict[str, Any], top: int = 15) -> None:
+    print(f"{report['path']}: {report['size'] / 1024 / 1024:.2f}MB, {report['members']} members "
+          f"({report['reused_members']} reused, {report['pruned_files']} files pruned), sha256 {report['sha256']}")
+    for package, sizes in list(report["packages"].items())[:top]:
+        print(f"  {package}: {sizes['compressed_size'] / 1024:.0f}KB compressed, {sizes['size'] / 1024:.0f}KB "
+              f"unpacked, {sizes['files']} files")
@@ -0,0 +1,143 @@
+import json
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from botocore.exceptions import ClientError
+
+from src.bauplan.deploy import is_not_found_error
+from src.bauplan.local_lambda import LocalContainer, extract, handler_package
+from src.bauplan.resources import ResourceProfile
+from src.bauplan.utils import is_in_aws_lambda
+
+# set in the environment of process pool workers.
+WORKER_VARIABLE = "BAUPLAN_POOL_WORKER"
+
+
+# Where the invocations of a LambdaBuilder run. A backend is handed the json request of an invocation, the same
+# envelope whatever the backend, and answers with the handler's json response. Calls, maps, codecs, project shipping,
+# caching and tracing are the builder's and work the same on every backend. resources is the profile of the function
+# called, backends without a notion of memory and timeout ignore it.
+class ExecutionBackend:
+    # whether the builder builds and deploys an environment before the first invocation.
+    needs_deploy = False
+    # invocations the backend runs at once, the builder's engine keeps at least this many threads to issue them.
+    max_concurrency: Optional[int] = None
+
+    def invoke(self, payload: bytes, resources: Optional[ResourceProfile] = None) -> bytes:
+        raise NotImplementedError
+
+    # queues an invocation and returns without waiting for it to run, its response is dropped. Used for jobs, which
+    # write their outcome to a result store, see jobs.
+    def submit(self, payload: bytes, resources: Optional[ResourceProfile] = None) -> None:
+        raise NotImplementedError
+
+    # calls made from code the backend is running are run in that process instead of going through the backend.
+    def runs_nested_calls_in_process(self) -> bool:
+        return False
+
+    def shutdown(self, wait: bool = True) -> None:
+        pass
+
+
+# Invocations are lambda invocations of the builder's function, or of its variant deployed for the call's resources,
+# through its engine, on the version the builder's qualifier points at.
+class LambdaBackend(ExecutionBackend):
+    needs_deploy = True
+
+    def __init__(self, builder: Any):
+        self.builder = builder
+
+    def invoke(self, payload: bytes, resources: Optional[ResourceProfile] = None) -> bytes:
+        builder = self.builder
+        function_name = builder.function_name_for(resources)
+        params = dict(FunctionName=function_name, Qualifier=builder.qualifier_for(function_name), Payload=payload,
+                      InvocationType="RequestResponse")
+        try:
+            response = builder.engine.invoke(**params)
+        except ClientError as e:
+            # the manifest is stale when the function was removed behind its back, it is redeployed once.
+            if not is_not_found_error(e) or is_in_aws_lambda() or not builder.auto_deploy:
+                raise
+            builder.manifest.forget(function_name)
+            builder.deploy(force=True, resources=resources)
+            response = builder.engine.invoke(**params)
+        return response['Payload'].read()
+
+    # an asynchronous invocation, lambda queues the event and answers right away.
+    def submit(self, payload: bytes, resources: Optional[ResourceProfile] = None) -> None:
+        builder = self.builder
+        function_name = builder.function_name_for(resources)
+        builder.engine.invoke(FunctionName=function_name, Qualifier=builder.qualifier_for(function_name),
+                              Payload=payload, InvocationType="Event")
+
+
+# Runs invocations in local worker processes instead of lambdas, to spread the calls of a decorated function over the
+# cores of one machine when lambda's overhead is not worth it, or as a fast and faithful target for integration tests.
+# Workers run the handler of this checkout on the request a lambda would receive and stay warm between invocations:
+# unpacked projects, loaded contexts and imported modules are reused like in a warm container. At most max_workers
+# invocations run at once, further callers wait for a worker to be free. Calls made by code running in a worker run in
+# that worker, the pool already keeps every core busy. Workers are started on first use, in directory or a temporary
+# directory, each with its own tmp directory. Submitted invocations wait in a queue for a free worker.
+class ProcessPoolBackend(ExecutionBackend):
+    def __init__(self, max_workers: Optional[int] = None, directory: Optional[str] = None, timeout: int = 300):
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_concurrency = self.max_workers
+        self.directory = directory
+        self.timeout = timeout
+        self.idle_workers: List[LocalContainer] = []
+        self.workers_started = 0
+        self.invocations = 0
+        self.slots = threading.BoundedSemaphore(self.max_workers)
+        self._lock = threading.Lock()
+        self._queue: Optional[ThreadPoolExecutor] = None
+
+    def _start_worker(self) -> LocalContainer:
+        with self._lock:
+            if self.directory is None:
+                self.directory = tempfile.mkdtemp(prefix="bauplan-pool-")
+            self.workers_started += 1
+            directory = os.path.join(os.path.abspath(self.directory), f"worker-{self.workers_started}")
+        extract(handler_package(), os.path.join(directory, "task"))
+        return LocalContainer(directory, "lambda_function.lambda_handler", {WORKER_VARIABLE: "1"})
+
+    def invoke(self, payload: bytes, resources: Optional[ResourceProfile] = None) -> bytes:
+        with self.slots:
+            with self._lock:
+                self.invocations += 1
+                worker = self.idle_workers.pop() if self.idle_workers else None
+            if worker is None:
+                worker = self._start_worker()
+            # a worker that died raises here and is not put back.
+            response = worker.invoke(json.loads(payload), time.time() + self.timeout, "local:process-pool")
+            with self._lock:
+                self.idle_workers.append(worker)
+        # unhandled exceptions are answered like lambda does, with the error as the payload.
+        return json.dumps(response["error"] if "error" in response else response["payload"]).encode()
+
+    def submit(self, payload: bytes, resources: Optional[ResourceProfile] = None) -> None:
+        with self._lock:
+            if self._queue is None:
+                self._queue = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bauplan-pool")
+            self._queue.submit(self._run_submitted, payload)
+
+    def _run_submitted(self, payload: bytes) -> None:
+        try:
+            self.invoke(payload)
+        except Exception as e:
+            # jobs write their own exceptions to the result store, this is a worker that died.
+            print(f"submitted invocation failed: {e}")
+
+    def runs_nested_calls_in_process(self) -> bool:
+        return WORKER_VARIABLE in os.environ
+
+    def shutdown(self, wait: bool = True) -> None:
+        if self._queue is not None:
+            self._queue.shutdown(wait)
+        with self._lock:
+            workers, self.idle_workers = self.idle_workers, []
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,193 @@
+import hashlib
+import os
+import struct
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import dill as pickle
+
+from src.bauplan.lambda_function import BlobStore
+from src.bauplan.utils import is_in_aws_lambda, get_file, write_file
+
+# every cached entry is stored as an 8 byte expiry timestamp (0 for no expiry) followed by the pickled result.
+EXPIRY_HEADER = struct.Struct(">d")
+
+
+def pack_entry(value: bytes, ttl: Optional[float]) -> bytes:
+    return EXPIRY_HEADER.pack(time.time() + ttl if ttl is not None else 0) + value
+
+
+def unpack_entry(entry: bytes) -> Optional[bytes]:
+    expires_at, = EXPIRY_HEADER.unpack_from(entry)
+    if expires_at and expires_at < time.time():
+        return None
+    return entry[EXPIRY_HEADER.size:]
+
+
+class CacheTier:
+    name = "tier"
+
+    def get(self, key: str) -> Optional[bytes]:
+        raise NotImplementedError
+
+    def set(self, key: str, value: bytes, ttl: Optional[float]) -> None:
+        raise NotImplementedError
+
+
+# per process LRU, bounded by entry count and total bytes.
+class MemoryTier(CacheTier):
+    name = "memory"
+
+    def __init__(self, max_entries: int = 1024, max_bytes: int = 256 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value = unpack_entry(entry)
+            if value is None:
+                self.size -= len(self._entries.pop(key))
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float]) -> None:
+        entry = pack_entry(value, ttl)
+        if len(entry) > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self.size -= len(self._entries.pop(key))
+            self._entries[key] = entry
+            self.size += len(entry)
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+
+
+# one file per entry, the least recently used entries are removed once the directory grows past max_bytes.
+# inside a lambda the default directory is in /tmp, the only writable path, so warm containers keep their entries. The
+# directory is created by the first set, decorating a function at import time writes nothing.
+class DiskTier(CacheTier):
+    name = "disk"
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = 1024 * 1024 * 1024):
+        if directory is None:
+            directory = "/tmp/bauplan-cache" if is_in_aws_lambda() else os.path.join(".bauplan", "cache")
+        self.directory = os.path.abspath(directory)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[bytes]:
+        path = os.path.join(self.directory, key)
+        try:
+            entry = get_file(path)
+        except FileNotFoundError:
+            return None
+        value = unpack_entry(entry)
+        if value is None:
+            self._remove(path)
+            return None
+        os.utime(path)
+        return value
+
+    def set(self, key: str, value: bytes, ttl: Optional[float]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        partial_path = os.path.join(self.directory, f".{key}.{os.getpid()}.{threading.get_ident()}")
+        write_file(partial_path, pack_entry(value, ttl))
+        os.replace(partial_path, os.path.join(self.directory, key))
+        self._evict()
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _evict(self) -> None:
+        with self._lock:
+            entries = []
+            with os.scandir(self.directory) as scanned:
+                for entry in scanned:
+                    if not entry.name.startswith("."):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, stat.st_size, entry.path))
+            size = sum(entry_size for _, entry_size, _ in entries)
+            entries.sort()
+            while size > self.max_bytes and entries:
+                _, entry_size, path = entries.pop(0)
+                self._remove(path)
+                size -= entry_size
+
+
+# shared tier backed by a blob store, readable from inside lambdas so nested calls share hits with each other and with
+# the local driver.
+class BlobStoreTier(CacheTier):
+    name = "blob"
+
+    def __init__(self, blob_store: BlobStore, namespace: str = "cache-"):
+        self.blob_store = blob_store
+        self.namespace = namespace
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.blob_store.exists(f"{self.namespace}{key}"):
+            return None
+        return unpack_entry(self.blob_store.get(f"{self.namespace}{key}"))
+
+    def set(self, key: str, value: bytes, ttl: Optional[float]) -> None:
+        self.blob_store.write(f"{self.namespace}{key}", pack_entry(value, ttl))
+
+
+# identifies a call by the source digest of the file defining the function, its name, the project digest and the
+# serialized arguments. Shared by the result cache and single flight coalescing.
+def call_key(context_digest: str, func_name: str, project_digest: str, args: Tuple, kwargs: Dict[str, Any]) -> str:
+    call_hash = hashlib.sha256(pickle.dumps((args, sorted(kwargs.items()))))
+    call_hash.update(f"\0{context_digest}\0{func_name}\0{project_digest}".encode())
+    return call_hash.hexdigest()
+
+
+# Memoizes results of decorated functions. The key covers the source of the file defining the function, the project
+# digest and the serialized arguments, so editing the function or anything in the project invalidates its entries.
+# Tiers are tried in order and a hit in a slower tier is copied into the faster ones.
+class ResultCache:
+    def __init__(self, tiers: Optional[List[CacheTier]] = None, ttl: Optional[float] = None):
+        self.tiers = tiers if tiers is not None else [MemoryTier(), DiskTier()]
+        self.ttl = ttl
+        self.hits: Dict[str, int] = {tier.name: 0 for tier in self.tiers}
+        self.misses = 0
+        self.sets = 0
+        self._lock = threading.Lock()
+
+    # returns (hit, value), a cached None is a hit.
+    def get(self, key: str) -> Tuple[bool, Any]:
+        for index, tier in enumerate(self.tiers):
+            value = tier.get(key)
+            if value is not None:
+                for faster_tier in self.tiers[:index]:
+                    faster_tier.set(key, value, self.ttl)
+                with self._lock:
+                    self.hits[tier.name] += 1
+                return True, pickle.loads(value)
+        with self._lock:
+            self.misses += 1
+        return False, None
+
+    def set(self, key: str, value: Any) -> None:
+        serialized = pickle.dumps(value)
+        for tier in self.tiers:
+            tier.set(key, serialized, self.ttl)
+        with self._lock:
+            self.sets += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"hits": dict(self.hits), "misses": self.misses, "sets": self.sets}
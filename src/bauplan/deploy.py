@@ -0,0 +1,179 @@
+import base64
+import hashlib
+import json
+from typing import Any, Callable, Dict, List, Optional
+
+import boto3
+from botocore.exceptions import ClientError
+
+from src.bauplan.archive import PruneRules
+
+# alias every invoke goes through, deploys publish a new version and move the alias to it in one step.
+LIVE_ALIAS = "live"
+
+
+def code_sha256(data: bytes) -> str:
+    # lambda reports CodeSha256 as the base64 encoded sha256 of the deployment package.
+    return base64.b64encode(hashlib.sha256(data).digest()).decode()
+
+
+# the layer holds the environment archived with the given options, changing how it is pruned or pre-compiled
+# publishes a new layer. compile_for is the runtime pycs are compiled for, None without pre-compilation.
+def layer_key(package_hash: str, prune_rules: Optional[PruneRules] = None, compile_for: Optional[str] = None) -> str:
+    options = json.dumps([package_hash, (prune_rules or PruneRules()).spec(), compile_for])
+    return hashlib.sha256(options.encode()).hexdigest()
+
+
+def layer_name(key: str) -> str:
+    # layer names are at most 64 characters, the key is shared by every function with the same requirements and
+    # archive options so they all reuse one layer.
+    return f"bauplan-deps-{key[:48]}"
+
+
+def is_not_found_error(error: Exception) -> bool:
+    return isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") == "ResourceNotFoundException"
+
+
+# Deploys a function as two parts: the dependencies, published once per environment hash as a lambda layer, and the
+# small handler package. Existing functions are updated in place with update_function_code and
+# update_function_configuration and a new version is published, then the live alias is moved to it. Invocations
+# already running finish on the containers of the previous version, and nothing is touched when the handler, the
+# layer and the configuration are unchanged. Works against anything implementing the boto3 lambda client api,
+# see LocalLambdaClient.
+class Deployer:
+    def __init__(self,
+                 lambda_client: Any,
+                 function_name: str,
+                 get_role_arn: Callable[[], str],
+                 runtime: str = "python3.10",
+                 memory_size: int = 256,
+                 timeout: int = 300,
+                 s3_bucket: Optional[str] = None,
+                 keep_versions: int = 3):
+        self.client = lambda_client
+        self.function_name = function_name
+        self.get_role_arn = get_role_arn
+        self.runtime = runtime
+        self.memory_size = memory_size
+        self.timeout = timeout
+        # layers above the 50MB direct upload limit go through s3.
+        self.s3_bucket = s3_bucket
+        # published versions kept besides the one the alias points to, older ones are deleted.
+        self.keep_versions = keep_versions
+
+    def ensure_layer(self, key: str, layer_zip_path: str) -> str:
+        name = layer_name(key)
+        versions = self.client.list_layer_versions(LayerName=name, CompatibleRuntime=self.runtime)["LayerVersions"]
+        if versions:
+            return max(versions, key=lambda version: version["Version"])["LayerVersionArn"]
+        print(f"publishing dependency layer: {name}")
+        if self.s3_bucket is not None:
+            s3_key = f"{name}.zip"
+            boto3.client('s3').upload_file(layer_zip_path, self.s3_bucket, s3_key)
+            content = {"S3Bucket": self.s3_bucket, "S3Key": s3_key}
+        else:
+            with open(layer_zip_path, "rb") as file:
+                content = {"ZipFile": file.read()}
+        response = self.client.publish_layer_version(LayerName=name, Description=f"bauplan environment {key}",
+                                                     Content=content, CompatibleRuntimes=[self.runtime])
+        return response["LayerVersionArn"]
+
+    def get_configuration(self) -> Optional[Dict[str, Any]]:
+        try:
+            return self.client.get_function(FunctionName=self.function_name)["Configuration"]
+        except ClientError as e:
+            if is_not_found_error(e):
+                return None
+            raise
+
+    def get_alias_version(self) -> Optional[str]:
+        try:
+            return self.client.get_alias(FunctionName=self.function_name, Name=LIVE_ALIAS)["FunctionVersion"]
+        except ClientError as e:
+            if is_not_found_error(e):
+                return None
+            raise
+
+    def wait(self, waiter_name: str, **params) -> None:
+        self.client.get_waiter(waiter_name).wait(FunctionName=self.function_name, **params)
+
+    # returns the version the live alias points to once the deploy is done. key is the layer_key of the layer archive.
+    def deploy(self, key: str, layer_zip_path: str, handler_zip_path: str) -> str:
+        layer_arn = self.ensure_layer(key, layer_zip_path)
+        with open(handler_zip_path, "rb") as file:
+            handler_zip = file.read()
+        configuration = self.get_configuration()
+        if configuration is None:
+            print(f"creating function: {self.function_name}")
+            response = self.client.create_function(
+                FunctionName=self.function_name,
+                Description="lambda executer",
+                Runtime=self.runtime,
+                Handler="lambda_function.lambda_handler",
+                MemorySize=self.memory_size,
+                Code={"ZipFile": handler_zip},
+                Layers=[layer_arn],
+                Timeout=self.timeout,
+                Role=self.get_role_arn(),
+                Publish=True
+            )
+            self.wait("function_active_v2")
+            version = response["Version"]
+            self.client.create_alias(FunctionName=self.function_name, Name=LIVE_ALIAS, FunctionVersion=version)
+            print("finished creating aws function")
+            return version
+
+        # lambda only allows one update at a time on a function, each update is waited on before the next one.
+        is_changed = False
+        if configuration["CodeSha256"] != code_sha256(handler_zip):
+            print(f"updating handler of: {self.function_name}")
+            self.client.update_function_code(FunctionName=self.function_name, ZipFile=handler_zip)
+            self.wait("function_updated_v2")
+            is_changed = True
+        configuration_changes = self.configuration_changes(configuration, [layer_arn])
+        if configuration_changes:
+            print(f"updating configuration of: {self.function_name} ({', '.join(sorted(configuration_changes))})")
+            self.client.update_function_configuration(FunctionName=self.function_name, **configuration_changes)
+            self.wait("function_updated_v2")
+            is_changed = True
+
+        alias_version = self.get_alias_version()
+        if not is_changed and alias_version is not None:
+            return alias_version
+        version = self.client.publish_version(FunctionName=self.function_name)["Version"]
+        self.wait("published_version_active", Qualifier=version)
+        if alias_version is None:
+            self.client.create_alias(FunctionName=self.function_name, Name=LIVE_ALIAS, FunctionVersion=version)
+        else:
+            self.client.update_alias(FunctionName=self.function_name, Name=LIVE_ALIAS, FunctionVersion=version)
+        print(f"{self.function_name}:{LIVE_ALIAS} now points to version {version}")
+        self.prune_versions(version)
+        return version
+
+    def configuration_changes(self, configuration: Dict[str, Any], layers: List[str]) -> Dict[str, Any]:
+        changes = {}
+        if [layer["Arn"] for layer in configuration.get("Layers", [])] != layers:
+            changes["Layers"] = layers
+        if configuration.get("Runtime") != self.runtime:
+            changes["Runtime"] = self.runtime
+        if configuration.get("MemorySize") != self.memory_size:
+            changes["MemorySize"] = self.memory_size
+        if configuration.get("Timeout") != self.timeout:
+            changes["Timeout"] = self.timeout
+        return changes
+
+    def list_versions(self) -> List[str]:
+        versions = []
+        params = {"FunctionName": self.function_name}
+        while True:
+            response = self.client.list_versions_by_function(**params)
+            versions += [version["Version"] for version in response["Versions"] if version["Version"] != "$LATEST"]
+            if not response.get("NextMarker"):
+                return versions
+            params["Marker"] = response["NextMarker"]
+
+    def prune_versions(self, live_version: str) -> None:
+        # code storage per region is limited, only the most recent versions are kept around for rollbacks.
+        stale_versions = sorted((version for version in self.list_versions() if version != live_version), key=int)
+        for version in stale_versions[:max(0, len(stale_versions) - self.keep_versions)]:
+            self.client.delete_function(FunctionName=self.function_name, Qualifier=version)
@@ -0,0 +1,142 @@
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Any, Callable, Dict, Optional
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+THROTTLE_ERROR_CODES = {"TooManyRequestsException", "ThrottlingException", "EC2ThrottledException"}
+
+# seconds the read timeout of invokes outlives the function timeout by, so a call running up to its timeout is answered
+# by lambda rather than cut off by the client.
+READ_TIMEOUT_MARGIN = 30
+
+
+# Classic token bucket, invokes take a token before they are sent so a burst of calls queues locally at the configured
+# rate instead of being rejected by lambda.
+class TokenBucket:
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1.0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_seconds = (1 - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+
+def is_throttle_error(error: Exception) -> bool:
+    return isinstance(error, ClientError) and error.response.get("Error", {}).get("Code") in THROTTLE_ERROR_CODES
+
+
+# One engine per LambdaBuilder. It owns the pooled boto3 client and a single thread pool shared by every async call
+# and map of the builder, and caps the number of invokes in flight across all of them, including synchronous calls
+# made from arbitrary threads. max_concurrency is what thread_count_per_lambda configures: the number of concurrent
+# invokes one process (the local driver or a lambda fanning out further) issues through the builder.
+class InvocationEngine:
+    def __init__(self,
+                 region: Optional[str] = None,
+                 max_concurrency: int = 8,
+                 rate: Optional[float] = None,
+                 burst: Optional[float] = None,
+                 max_throttle_retries: int = 8,
+                 base_backoff: float = 0.05,
+                 max_backoff: float = 5.0,
+                 read_timeout: int = 300 + READ_TIMEOUT_MARGIN,
+                 client: Optional[Any] = None):
+        self.max_concurrency = max_concurrency
+        self.max_throttle_retries = max_throttle_retries
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.region = region
+        self.read_timeout = read_timeout
+        self._client = client
+        self._owns_client = client is None
+        self._client_lock = threading.Lock()
+        self.bucket = TokenBucket(rate, burst) if rate is not None else None
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="bauplan-invoke")
+        self.slots = threading.BoundedSemaphore(max_concurrency)
+        self.throttled = 0
+        self.is_shut_down = False
+
+    # created on first use, builders running on another backend never need one.
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    # read timeout outlives the function timeout, botocore retries are disabled since throttles are
+                    # retried here and retrying an invoke that may have run is not botocore's call to make.
+                    self._client = boto3.client(
+                        "lambda", self.region,
+                        config=Config(max_pool_connections=self.max_concurrency, read_timeout=self.read_timeout,
+                                      retries={"max_attempts": 0}, tcp_keepalive=True))
+        return self._client
+
+    # raises the read timeout to outlive function_timeout. A client created with a shorter one is replaced on next use,
+    # invokes in flight finish on the previous one.
+    def ensure_read_timeout(self, function_timeout: int) -> None:
+        read_timeout = function_timeout + READ_TIMEOUT_MARGIN
+        if read_timeout <= self.read_timeout:
+            return
+        with self._client_lock:
+            self.read_timeout = max(self.read_timeout, read_timeout)
+            if self._owns_client:
+                self._client = None
+
+    def backoff_seconds(self, attempt: int) -> float:
+        # full jitter, spreads retries of a throttled burst out instead of retrying it in lockstep.
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+    def invoke(self, **params) -> Dict[str, Any]:
+        if self.is_shut_down:
+            raise Exception("invocation engine was shut down")
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            with self.slots:
+                try:
+                    return self.client.invoke(**params)
+                except ClientError as e:
+                    if not is_throttle_error(e) or attempt >= self.max_throttle_retries:
+                        raise
+                    self.throttled += 1
+            time.sleep(self.backoff_seconds(attempt))
+            attempt += 1
+
+    # work runs in the caller's context, context variables such as the current trace span follow it to the pool.
+    def submit(self, fn: Callable[..., Any], *args) -> Future:
+        return self.executor.submit(contextvars.copy_context().run, fn, *args)
+
+    async def run(self, fn: Callable[..., Any], *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self.executor, contextvars.copy_context().run, fn,
+                                                                *args)
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.is_shut_down = True
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self) -> "InvocationEngine":
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.shutdown()
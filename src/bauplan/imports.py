@@ -0,0 +1,117 @@
+import ast
+import fnmatch
+import threading
+from typing import Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
+
+from src.bauplan.snapshot import ProjectSnapshot
+
+
+# module names imported by a file. Relative imports are resolved against the package of the file, imports anywhere
+# in the file count (inside functions, try blocks, TYPE_CHECKING guards), as do importlib.import_module and __import__
+# calls with a constant module name. "from package import name" yields both the package and package.name since name
+# may be a submodule.
+def parse_imports(source: bytes, relative_path: str) -> List[str]:
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return []
+    package = relative_path.split("/")[:-1]
+    modules = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom):
+            if node.level > 0:
+                if node.level - 1 > len(package):
+                    continue
+                base = package[:len(package) - (node.level - 1)]
+                module = ".".join(base + ([node.module] if node.module else []))
+            else:
+                module = node.module
+            if module:
+                modules.append(module)
+            modules += [f"{module}.{alias.name}" if module else alias.name
+                        for alias in node.names if alias.name != "*"]
+        elif isinstance(node, ast.Call) and node.args and isinstance(node.args[0], ast.Constant) \
+                and isinstance(node.args[0].value, str):
+            function = node.func
+            name = function.attr if isinstance(function, ast.Attribute) else getattr(function, "id", None)
+            if name in ("import_module", "__import__"):
+                modules.append(node.args[0].value)
+    return modules
+
+
+# project files executed when a module is imported: the module itself and the __init__.py of every package above it.
+# Modules that are not part of the project (the standard library, installed packages) resolve to nothing.
+def module_files(module: str, files: Set[str]) -> List[str]:
+    parts = module.split(".")
+    resolved = []
+    for index in range(1, len(parts) + 1):
+        path = "/".join(parts[:index])
+        if f"{path}/__init__.py" in files:
+            resolved.append(f"{path}/__init__.py")
+        elif index == len(parts) and f"{path}.py" in files:
+            resolved.append(f"{path}.py")
+        elif f"{path}.py" in files:
+            # a module with the name of a package prefix, e.g. "import a.b" where a.py exists, stops the descent.
+            resolved.append(f"{path}.py")
+            break
+    return resolved
+
+
+# Static import graph of the python files in a project snapshot. Imports are parsed once per file version, the
+# snapshot only re-reads a file when its mtime or size changes, and closures are cached per snapshot digest.
+class ImportGraph:
+    def __init__(self, snapshot: ProjectSnapshot):
+        self.snapshot = snapshot
+        self._imports: Dict[str, Tuple[str, List[str]]] = {}
+        self._closures: Dict[Tuple[str, str, Tuple[str, ...]], FrozenSet[str]] = {}
+        self._lock = threading.Lock()
+
+    def imports(self, relative_path: str) -> List[str]:
+        file_digest = self.snapshot.file_digest(relative_path)
+        cached = self._imports.get(relative_path)
+        if cached is not None and cached[0] == file_digest:
+            return cached[1]
+        modules = parse_imports(self.snapshot.content(relative_path), relative_path)
+        self._imports[relative_path] = (file_digest, modules)
+        return modules
+
+    # the files a function defined in relative_path needs, None when the file is not part of the project. include
+    # holds relative path patterns always shipped, for modules loaded in ways static analysis cannot see and data files.
+    def closure(self, relative_path: str, include: Iterable[str] = ()) -> Optional[FrozenSet[str]]:
+        include = tuple(sorted(include))
+        with self._lock:
+            files = self.snapshot.paths()
+            if relative_path not in files:
+                return None
+            key = (self.snapshot.digest, relative_path, include)
+            if key in self._closures:
+                return self._closures[key]
+            python_files = {path for path in files if path.endswith(".py")}
+            reached = {relative_path}
+            pending = [relative_path]
+            while pending:
+                for module in self.imports(pending.pop()):
+                    for path in module_files(module, python_files):
+                        if path not in reached:
+                            reached.add(path)
+                            pending.append(path)
+            reached |= {path for path in files if any(fnmatch.fnmatch(path, pattern) for pattern in include)}
+            closure = frozenset(reached)
+            if len(self._closures) > 256:
+                self._closures.clear()
+            self._closures[key] = closure
+            return closure
+
+
+_graphs: Dict[str, ImportGraph] = {}
+_graphs_lock = threading.Lock()
+
+
+# one graph per snapshot root, parsed imports are shared by every LambdaBuilder in a process.
+def get_import_graph(snapshot: ProjectSnapshot) -> ImportGraph:
+    with _graphs_lock:
+        if snapshot.root not in _graphs or _graphs[snapshot.root].snapshot is not snapshot:
+            _graphs[snapshot.root] = ImportGraph(snapshot)
+        return _graphs[snapshot.root]
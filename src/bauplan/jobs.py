@@ -0,0 +1,169 @@
+import asyncio
+import json
+import threading
+import time
+import uuid
+from concurrent.futures import CancelledError, TimeoutError
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from src.bauplan.lambda_function import JOB_CANCELLED, BlobStore, decode
+from src.bauplan.retries import RemoteError
+
+# polling backs off from the first interval to the last while nothing finishes.
+MIN_POLL_SECONDS = 0.05
+MAX_POLL_SECONDS = 2.0
+
+# asynchronous invocations carry at most 256KB, larger requests are written to the result store and only their key
+# travels in the event.
+EVENT_PAYLOAD_LIMIT = 256 * 1024
+
+
+# Handle of a call submitted with LambdaBuilder.submit. The call runs from an asynchronous invocation, so no connection
+# or thread waits for it: the lambda writes the outcome to the result store under the job's result key and the handle
+# polls for it. Keys of one builder share a session prefix, so as_completed finds the results of many jobs with one
+# listing. A job is resubmitted when the lambda could not run it: the container did not hold the project base or could
+# not load the compiled context. Every attempt writes to a key of its own. Once the outcome was read it is kept on the
+# handle and the job's keys are deleted, so listings only hold the results nobody consumed yet. Calls run locally (mock
+# mode, local functions) give a job that is done from the start, response holds their outcome.
+class Job:
+    def __init__(self, builder: Any, name: str, prepared: Any, args: Tuple, kwargs: Dict[str, Any], codec: str,
+                 session: str, response: Optional[Dict[str, Any]] = None):
+        self.builder = builder
+        self.name = name
+        self.prepared = prepared
+        self.args = args
+        self.kwargs = kwargs
+        self.codec = codec
+        self.session = session
+        self.id = uuid.uuid4().hex
+        self.attempt = 0
+        self.is_cancelled = False
+        self._response = response
+        self._lock = threading.Lock()
+
+    @property
+    def store(self) -> BlobStore:
+        return self.builder.result_store
+
+    @property
+    def result_key(self) -> str:
+        return f"job-{self.session}-{self.id}-{self.attempt}"
+
+    # created by the lambda when it starts the job, or by cancel before that, see run_job.
+    @property
+    def start_key(self) -> str:
+        return f"start-{self.session}-{self.id}"
+
+    @property
+    def request_key(self) -> str:
+        return f"request-{self.session}-{self.id}-{self.attempt}"
+
+    def __repr__(self) -> str:
+        return f"Job({self.name}, {self.id})"
+
+    # the response once it was written, resubmitting the job when the lambda asked for the full project or source.
+    def _poll(self, listed_keys: Optional[set] = None) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if self._response is not None:
+                return self._response
+            key = self.result_key
+            if not (key in listed_keys if listed_keys is not None else self.store.exists(key)):
+                return None
+            response = json.loads(self.store.get(key))
+            if "missing_project" in response or "unsupported_context" in response:
+                if "unsupported_context" in response:
+                    self.builder.ship_compiled_contexts = False
+                self._delete_attempt()
+                self.attempt += 1
+                self.builder._submit_job(self)
+                return None
+            self._response = response
+            self._delete_attempt()
+            self.store.delete(self.start_key)
+            return response
+
+    def _delete_attempt(self) -> None:
+        self.store.delete(self.result_key)
+        self.store.delete(self.request_key)
+
+    def done(self) -> bool:
+        return self.is_cancelled or self._poll() is not None
+
+    # cancels the job unless a lambda started it, the start key goes to whichever of the two creates it first. Returns
+    # False when the job started or finished, the handle stays pollable for its outcome.
+    def cancel(self) -> bool:
+        if self.is_cancelled:
+            return True
+        if self._poll() is not None or not self.store.create(self.start_key, JOB_CANCELLED):
+            return False
+        self.is_cancelled = True
+        return True
+
+    def _outcome(self, response: Dict[str, Any]) -> Any:
+        if "cancelled" in response:
+            raise CancelledError(f"job {self.id} was cancelled")
+        if "error" in response:
+            raise RemoteError.from_payload(response["error"])
+        return decode(response["result"], self.builder.blob_store)
+
+    def result(self, timeout: Optional[float] = None) -> Any:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        delay = MIN_POLL_SECONDS
+        while True:
+            if self.is_cancelled:
+                raise CancelledError(f"job {self.id} was cancelled")
+            response = self._poll()
+            if response is not None:
+                return self._outcome(response)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"job {self.id} did not finish within {timeout}s")
+            time.sleep(delay)
+            delay = min(MAX_POLL_SECONDS, delay * 2)
+
+    async def aio_result(self, timeout: Optional[float] = None) -> Any:
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        delay = MIN_POLL_SECONDS
+        while True:
+            if self.is_cancelled:
+                raise CancelledError(f"job {self.id} was cancelled")
+            # store requests may block, they run on the builder's threads.
+            response = await self.builder.engine.run(self._poll)
+            if response is not None:
+                return self._outcome(response)
+            if deadline is not None and time.monotonic() + delay > deadline:
+                raise TimeoutError(f"job {self.id} did not finish within {timeout}s")
+            await asyncio.sleep(delay)
+            delay = min(MAX_POLL_SECONDS, delay * 2)
+
+    def __await__(self):
+        return self.aio_result().__await__()
+
+
+# yields jobs as they finish, cancelled jobs right away. Each poll lists the result keys of every session once instead
+# of checking jobs one by one, so polling tens of thousands of jobs costs a listing per poll. Consumed results are
+# deleted, a listing covers the jobs of the session still running or not read yet.
+def as_completed(jobs: Iterable[Job], timeout: Optional[float] = None) -> Iterator[Job]:
+    pending: Dict[str, Job] = {}
+    for job in jobs:
+        pending[job.id] = job
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    delay = MIN_POLL_SECONDS
+    while pending:
+        finished: List[Job] = [job for job in pending.values() if job.is_cancelled]
+        sessions: Dict[Tuple[int, str], List[Job]] = {}
+        for job in pending.values():
+            if not job.is_cancelled:
+                sessions.setdefault((id(job.store), job.session), []).append(job)
+        for (_, session), session_jobs in sessions.items():
+            listed_keys = set(session_jobs[0].store.list_keys(f"job-{session}-"))
+            finished += [job for job in session_jobs if job._poll(listed_keys) is not None]
+        for job in finished:
+            del pending[job.id]
+            yield job
+        if finished:
+            delay = MIN_POLL_SECONDS
+            continue
+        if deadline is not None and time.monotonic() + delay > deadline:
+            raise TimeoutError(f"{len(pending)} jobs did not finish within {timeout}s")
+        time.sleep(delay)
+        delay = min(MAX_POLL_SECONDS, delay * 2)
@@ -1,18 +1,100 @@
 #!/usr/bin/env python3
 
+import contextvars
+import functools
+import hashlib
+import itertools
 import json
 import os.path
+import platform
 import shutil
-from concurrent.futures import ThreadPoolExecutor
-from typing import Callable, Any, Dict, Optional, Union, Awaitable
-import base64
-import lzma
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import Callable, Any, Dict, Optional, Union, Awaitable, Tuple, Iterable, Iterator, AsyncIterator, List, \
+    NamedTuple, Deque, FrozenSet
 import boto3
-import dill as pickle
 import inspect
 import asyncio
-from src.bauplan.utils import build_env, get_project_reqs, hash_env, get_context_from_file, get_python_project_structure, \
-    is_in_aws_lambda, find_file_with_function
+from src.bauplan.archive import PruneRules
+from src.bauplan.backends import ExecutionBackend, LambdaBackend
+from src.bauplan.cache import ResultCache, call_key
+from src.bauplan.deploy import LIVE_ALIAS, Deployer, layer_key
+from src.bauplan.engine import READ_TIMEOUT_MARGIN, InvocationEngine
+from src.bauplan.imports import get_import_graph
+from src.bauplan.jobs import EVENT_PAYLOAD_LIMIT, Job
+from src.bauplan.lambda_function import AUTO_CODEC, OFFLOAD_THRESHOLD, PRELOAD_FILE, BlobStore, Envelope, S3BlobStore, \
+    encode, decode, encode_call, make_context, record_size, stage, encode_exception
+from src.bauplan.manifest import DeploymentManifest
+from src.bauplan.policy import ExecutionPolicy, get_next_depth
+from src.bauplan.resources import MemoryTuner, ResourceProfile, variant_name
+from src.bauplan.retries import HedgePolicy, RemoteError, RetryPolicy
+from src.bauplan.singleflight import SingleFlight
+from src.bauplan.snapshot import ProjectSnapshot, ProjectDelta, get_project_snapshot
+from src.bauplan.streams import StreamReader, aio_read_stream, read_stream
+from src.bauplan.symbols import get_symbol_index
+from src.bauplan.tracing import Tracer, record_response_trace, request_trace, span
+from src.bauplan.utils import build_env, build_handler_archive, get_project_reqs, hash_env, is_in_aws_lambda, \
+    hash_file, get_file
+
+
+# role_name may also be given as a full role arn, which skips the iam lookup.
+def get_role_arn(role_name: str) -> str:
+    if role_name.startswith("arn:"):
+        return role_name
+    return boto3.client('iam').get_role(RoleName=role_name)['Role']['Arn']
+
+
+class PreparedFunction(NamedTuple):
+    snapshot: ProjectSnapshot
+    context_digest: str
+    func_name: str
+    # source of the file defining the function and its path relative to the project root.
+    source: str
+    filename: str
+    # files of the project the function imports, shipped instead of the whole project. None ships everything.
+    files: Optional[FrozenSet[str]]
+    # profile, retry and hedge policies given to the function's decorator, None uses the builder's.
+    resources: Optional[ResourceProfile] = None
+    retry: Optional[RetryPolicy] = None
+    hedge: Optional[HedgePolicy] = None
+
+
+# encoded contexts kept per builder, keyed by (context digest, compiled, codec).
+MAX_CACHED_CONTEXTS = 64
+
+
+# Picks the number of elements per invocation from the observed per element latency, aiming for invocations of about
+# target_seconds so the fixed invocation overhead is amortized without making chunks so long that stragglers dominate.
+class ChunkSizer:
+    def __init__(self, chunksize: Optional[int] = None, target_seconds: float = 2.0, initial_chunksize: int = 16,
+                 max_chunksize: int = 4096, smoothing: float = 0.5):
+        self.fixed_chunksize = chunksize
+        self.target_seconds = target_seconds
+        self.chunksize = initial_chunksize
+        self.max_chunksize = max_chunksize
+        self.smoothing = smoothing
+        self.seconds_per_element: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def observe(self, elements: int, seconds: float) -> None:
+        with self._lock:
+            observed = seconds / max(elements, 1)
+            if self.seconds_per_element is None:
+                self.seconds_per_element = observed
+            else:
+                self.seconds_per_element += self.smoothing * (observed - self.seconds_per_element)
+            self.chunksize = int(min(self.max_chunksize,
+                                     max(1, self.target_seconds / max(self.seconds_per_element, 1e-9))))
+
+    def next_chunksize(self) -> int:
+        if self.fixed_chunksize is not None:
+            return self.fixed_chunksize
+        with self._lock:
+            return self.chunksize
 
 
 class LambdaBuilder:
@@ -27,73 +109,509 @@ class LambdaBuilder:
                  mock_mode: bool = False,
                  thread_count_per_lambda: int = 8,
                  s3_bucket: Optional[str] = None,
-                 s3_key: Optional[str] = None):
-        self.thread_count = thread_count_per_lambda
+                 s3_key: Optional[str] = None,
+                 codec: str = AUTO_CODEC,
+                 blob_store: Optional[BlobStore] = None,
+                 offload_threshold: int = OFFLOAD_THRESHOLD,
+                 invoke_rate: Optional[float] = None,
+                 invoke_burst: Optional[float] = None,
+                 policy: Optional[ExecutionPolicy] = None,
+                 wheelhouse: Optional[str] = None,
+                 offline_build: bool = False,
+                 prune_rules: Optional[PruneRules] = None,
+                 compile_pyc: bool = False,
+                 lambda_client: Optional[Any] = None,
+                 manifest: Optional[DeploymentManifest] = None,
+                 slice_imports: bool = True,
+                 include: Iterable[str] = (),
+                 tracer: Optional[Tracer] = None,
+                 auto_deploy: bool = True,
+                 backend: Optional[ExecutionBackend] = None,
+                 result_store: Optional[BlobStore] = None,
+                 memory_size: int = 256,
+                 timeout: int = 300,
+                 tuner: Optional[MemoryTuner] = None,
+                 retry: Optional[RetryPolicy] = None,
+                 hedge: Optional[HedgePolicy] = None,
+                 preload: Iterable[str] = (),
+                 preload_project: bool = False):
+        # invocations run on lambda unless another backend is given, e.g. ProcessPoolBackend to run them in local
+        # worker processes. The engine keeps enough threads to keep every slot of the backend busy.
+        self.backend = backend if backend is not None else LambdaBackend(self)
+        self.thread_count = max(thread_count_per_lambda, self.backend.max_concurrency or 0)
         self.mock_mode = mock_mode
-        if mock_mode:
-            return
-        requirements = get_project_reqs() if requirements is None else requirements
-        requirements |= {"dill": "0.3.6"}
-        self.package_hash = hash_env(requirements)
+        # payload codec used for requests and responses, can be overridden per decorator and per call.
+        self.codec = codec
+        # arguments and results larger than offload_threshold are passed by reference through the blob store.
+        # defaults to the s3 bucket when one is given, LocalBlobStore can be used for tests.
+        self.blob_store = blob_store if blob_store is not None or s3_bucket is None else S3BlobStore(s3_bucket)
+        self.offload_threshold = offload_threshold
+        # submitted jobs write their outcome here, see submit. Defaults to a prefix of the s3 bucket, or the blob store.
+        self.result_store = result_store if result_store is not None else \
+            S3BlobStore(s3_bucket, "bauplan/jobs/") if s3_bucket is not None else self.blob_store
+        self.job_session = uuid.uuid4().hex[:16]
+        self._job_project: Optional[Tuple[Tuple[str, Optional[FrozenSet[str]], str], Envelope]] = None
+        # decides whether calls made from inside a lambda are shipped out or run in process, can be set per decorator.
+        self.policy = policy
+        # digest of the last project tree a lambda container reported holding, deltas are computed against it.
+        self.remote_project_digest: Optional[str] = None
+        # invokes go through the live alias. Nested calls made from inside a lambda stay on the version running them,
+        # so a deploy in the middle of a call tree does not mix handler versions.
+        running_version = os.environ.get("AWS_LAMBDA_FUNCTION_VERSION")
+        self.qualifier = running_version if running_version not in (None, "$LATEST") else LIVE_ALIAS
+        # only the project files reachable through imports from the file defining a function are shipped with it.
+        # include adds relative path patterns (modules imported dynamically, data files) to every call.
+        self.slice_imports = slice_imports
+        self.include = list(include)
+        # records a span with stage timings for every call, see tracing. Calls made inside a traced lambda are traced
+        # regardless and their spans are returned to the caller.
+        self.tracer = tracer
+        # contexts are shipped compiled when this interpreter matches the lambda runtime, see make_context. Switched
+        # off when a container answers that it cannot load them.
+        self.ship_compiled_contexts = runtime == f"python{sys.version_info.major}.{sys.version_info.minor}"
+        self._contexts: "OrderedDict[Tuple[str, bool, str], Envelope]" = OrderedDict()
+        self._contexts_lock = threading.Lock()
         self.lambda_function_name = lambda_function_name
-        self.lambda_client = boto3.client("lambda", region)
-        lambda_functions = self.list_lambda_functions()
-        if not is_in_aws_lambda():  # no building in aws lambda, lambdas can only invoke they cannot create lambdas.
-            does_lambda_exist_in_aws = self.lambda_function_name in lambda_functions
-            was_package_built = os.path.exists(f"{package_dir}/{self.package_hash}")
-            was_pacakge_zipped = os.path.exists(f"{package_dir}/{self.package_hash}.zip")
-            should_rebuild = not was_package_built or not was_pacakge_zipped or force_rebuild  # or not does_lambda_exist_in_aws
-            if should_rebuild and was_package_built:
-                shutil.rmtree(f"{package_dir}/{self.package_hash}")
-            if should_rebuild and was_pacakge_zipped:
-                os.remove(f"{package_dir}/{self.package_hash}.zip")
-            if self.lambda_function_name in lambda_functions and should_rebuild:
-                self.lambda_client.delete_function(FunctionName=self.lambda_function_name)
-            if should_rebuild:
-                print("building python environment")
-                build_env(self.package_hash, requirements=requirements, package_dir=package_dir)
-                print("finished creating python environment")
-            if not does_lambda_exist_in_aws or should_rebuild:
-                zip_file_path = os.path.join(f"{package_dir}", f"{self.package_hash}.zip")
-                with open(zip_file_path, 'rb') as file:
-                    lambda_zip_package = file.read()
-                role_arn: Optional[str] = boto3.client('iam').get_role(RoleName=role_name)['Role']['Arn']
-                print(f"creating function: {self.lambda_function_name}")
-                code_parameter = {
-                    "ZipFile": lambda_zip_package if s3_bucket is None else None,
-                    "S3Bucket": s3_bucket if s3_bucket is not None else None,
-                    "S3Key": f"{self.lambda_function_name}-{self.package_hash}.zip" if s3_bucket is not None else None,
-                }
-                code_parameter = {k: v for k, v in code_parameter.items() if v is not None}
-
-                if s3_bucket is not None:
-                    s3_client = boto3.client('s3')
-                    s3_client.upload_file(zip_file_path, s3_bucket,
-                                          f"{self.lambda_function_name}-{self.package_hash}.zip")
-
-                response = self.lambda_client.create_function(
-                    FunctionName=self.lambda_function_name,
-                    Description="lambda executer",
-                    Runtime=runtime,
-                    Handler="lambda_function.lambda_handler",
-                    MemorySize=256,
-                    Code=code_parameter,
-                    Timeout=300,
-                    Role=role_arn
-                )
-                waiter = self.lambda_client.get_waiter('function_active_v2')
-                waiter.wait(FunctionName=self.lambda_function_name)
-                print("finished creating aws function")
+        # nothing touches aws or pip here: the environment is built and deployed on the first invoke or an explicit
+        # deploy(), see deploy. Without auto_deploy the function is expected to exist already, deployed ahead of time
+        # or by a client that manages its own code such as FakeLambdaClient.
+        self.auto_deploy = auto_deploy
+        self.role_name = role_name
+        self.region = region
+        self.requirements = requirements
+        self.runtime = runtime
+        self.package_dir = package_dir
+        self.force_rebuild = force_rebuild
+        self.s3_bucket = s3_bucket
+        self.invoke_rate = invoke_rate
+        self.invoke_burst = invoke_burst
+        self.wheelhouse = wheelhouse
+        self.offline_build = offline_build
+        self.prune_rules = prune_rules
+        self.compile_pyc = compile_pyc
+        self.manifest = manifest if manifest is not None else DeploymentManifest()
+        self.package_hash: Optional[str] = None
+        self.layer_key: Optional[str] = None
+        # memory size and timeout of the builder's function. Decorators given other resources run their calls on
+        # variants of it deployed with their configuration, see function_name_for.
+        self.resources = ResourceProfile(memory_size, timeout)
+        self._function_resources: Dict[Callable, ResourceProfile] = {}
+        # failed invokes are retried according to retry, calls slower than usual are hedged according to hedge, both
+        # can be set per decorator. Without a retry policy only the engine retries throttles.
+        self.retry = retry
+        self.hedge = hedge
+        self._function_retries: Dict[Callable, RetryPolicy] = {}
+        self._function_hedges: Dict[Callable, HedgePolicy] = {}
+        self._hedge_executor: Optional[ThreadPoolExecutor] = None
+        # modules imported in the init phase of every container, before its first invocation, and whether the project
+        # and the contexts of the decorated functions are unpacked and executed there as well. See handler_files.
+        self.preload = list(preload)
+        self.preload_project = preload_project
+        self._functions: List[Callable] = []
+        # files of the project baked into the handler. Calls ship them along with their own files so every function
+        # runs on the one baked tree, and a container switching trees does not forget the imports preloaded there.
+        self._preloaded_files: Optional[FrozenSet[str]] = None
+        # observes the duration of invocations per memory size and, when it switches, picks the size calls run with.
+        self.tuner = tuner
+        # deployed version per function name, the builder's function and its variants.
+        self.deployed_versions: Dict[str, str] = {}
+        self._lambda_client = lambda_client
+        self._engine: Optional[InvocationEngine] = None
+        self._engine_lock = threading.Lock()
+        self._deploy_lock = threading.Lock()
+
+    # the engine, and with it the boto3 client, is created on first use.
+    @property
+    def engine(self) -> InvocationEngine:
+        if self._engine is None:
+            with self._engine_lock:
+                if self._engine is None:
+                    # thread_count_per_lambda caps the invokes this builder has in flight in this process, see
+                    # InvocationEngine. invoke_rate/invoke_burst optionally rate limit invokes with a token bucket.
+                    # invokes wait for the longest timeout of the profiles calls may run with.
+                    self._engine = InvocationEngine(self.region, self.thread_count, self.invoke_rate,
+                                                    self.invoke_burst, client=self._lambda_client,
+                                                    read_timeout=self._max_timeout() + READ_TIMEOUT_MARGIN)
+        return self._engine
+
+    @engine.setter
+    def engine(self, engine: InvocationEngine) -> None:
+        self._engine = engine
+
+    def _max_timeout(self) -> int:
+        return max(resources.timeout for resources in [self.resources, *self._function_resources.values()])
+
+    @property
+    def lambda_client(self) -> Any:
+        return self.engine.client
+
+    def _resolve_requirements(self) -> Dict[str, str]:
+        requirements = self.manifest.requirements(get_project_reqs) if self.requirements is None \
+            else dict(self.requirements)
+        return requirements | {"dill": "0.3.6"}
+
+    def _deployment_record(self, resources: ResourceProfile) -> Dict[str, Any]:
+        return {
+            "package_hash": self.package_hash,
+            "layer_key": self.layer_key,
+            "handler": hash_file(os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda_function.py")),
+            "runtime": self.runtime,
+            "region": self.region,
+            "memory_size": resources.memory_size,
+            "timeout": resources.timeout,
+            "preload": self.preload,
+            "preload_project": self.preload_project,
+        }
+
+    # The project tree baked into the handler with preload_project: the files every decorated function imports, shared
+    # by all of them, with the decorated functions.
+    def _preload_project(self) -> Optional[Tuple[ProjectDelta, List[PreparedFunction]]]:
+        if not self.preload_project or not self._functions:
+            return None
+        prepared = [self._prepare_function(func) for func in self._functions]
+        files = None if any(function.files is None for function in prepared) else \
+            frozenset().union(*(function.files for function in prepared))
+        self._preloaded_files = files
+        return prepared[0].snapshot.delta(None, files), prepared
+
+    # the files shipped with a call of the function: its own, and with preload_project the files of the baked tree.
+    def _project_files(self, prepared: PreparedFunction) -> Optional[FrozenSet[str]]:
+        if prepared.files is None or self._preloaded_files is None:
+            return prepared.files
+        return prepared.files | self._preloaded_files
+
+    # Files baked into the handler package next to lambda_function.py. The preload file lists the modules imported in
+    # the init phase of a container and, with preload_project, the project and the contexts of the decorated functions
+    # at the time of the deploy, see preload in lambda_function. Deploys happen when the environment, the handler or
+    # the configuration change, editing the project does not redeploy and the baked project only gets stale: calls
+    # ship what changed since, and the imports it triggered are still made in the init phase.
+    def handler_files(self) -> Dict[str, bytes]:
+        if not self.preload and not self.preload_project:
+            return {}
+        spec: Dict[str, Any] = {"modules": self.preload}
+        preloaded = self._preload_project()
+        if preloaded is not None:
+            project, functions = preloaded
+            spec["project"] = encode(project, AUTO_CODEC)
+            spec["functions"] = [{"function": [function.context_digest, function.func_name],
+                                  "context": self._encode_context(function, AUTO_CODEC)}
+                                 for function in functions]
+            # containers start with this tree, calls send what changed since.
+            self.remote_project_digest = project["digest"]
+        return {PRELOAD_FILE: json.dumps(spec).encode()}
+
+    # name of the lambda function running calls with the given resources: the builder's function for its own profile,
+    # a variant of it named after the configuration otherwise.
+    def function_name_for(self, resources: Optional[ResourceProfile]) -> str:
+        if resources is None or resources == self.resources:
+            return self.lambda_function_name
+        return variant_name(self.lambda_function_name, resources)
+
+    # versions are numbered per function, nested calls stay on the version running them only when they call the
+    # function running them, calls to other variants go through their live alias.
+    def qualifier_for(self, function_name: str) -> str:
+        return self.qualifier if function_name == os.environ.get("AWS_LAMBDA_FUNCTION_NAME") else LIVE_ALIAS
+
+    # Builds the environment and deploys the function unless the local manifest shows this exact environment, handler
+    # and configuration were already deployed under this function name, in which case no control plane call is made.
+    # Called on the first invoke, can be called explicitly to deploy ahead of time. Inside a lambda there is nothing to
+    # deploy, lambdas can only invoke they cannot create lambdas. The variants of every resource profile given to a
+    # decorator so far are deployed along with the function, so calls made from inside lambdas find them. Given
+    # resources, only the function for that profile is deployed. Returns the version of the first function deployed.
+    def deploy(self, force: bool = False, resources: Optional[ResourceProfile] = None) -> Optional[str]:
+        with self._deploy_lock:
+            if self.mock_mode or is_in_aws_lambda() or not self.backend.needs_deploy:
+                return None
+            profiles = [resources] if resources is not None else [self.resources, *self._function_resources.values()]
+            return [self._deploy_profile(profile, force) for profile in dict.fromkeys(profiles)][0]
+
+    def _deploy_profile(self, resources: ResourceProfile, force: bool) -> str:
+        function_name = self.function_name_for(resources)
+        if function_name in self.deployed_versions and not force:
+            return self.deployed_versions[function_name]
+        requirements = self._resolve_requirements()
+        self.package_hash = hash_env(requirements)
+        self.layer_key = layer_key(self.package_hash, self.prune_rules, self.runtime if self.compile_pyc else None)
+        record = self._deployment_record(resources)
+        layer_zip_path = os.path.join(self.package_dir, f"{self.layer_key}.layer.zip")
+        deployed = self.manifest.get(function_name)
+        if not force and not self.force_rebuild and os.path.exists(layer_zip_path) and deployed is not None \
+                and {key: deployed.get(key) for key in record} == record:
+            self.deployed_versions[function_name] = deployed["version"]
+            # containers start with the project baked into the deployed handler, when it is still the current one.
+            preloaded = self._preload_project() if self.remote_project_digest is None else None
+            if preloaded is not None and preloaded[0]["digest"] == deployed.get("preload_digest"):
+                self.remote_project_digest = deployed["preload_digest"]
+            return deployed["version"]
+
+        was_package_built = os.path.exists(f"{self.package_dir}/{self.package_hash}")
+        if self.force_rebuild and was_package_built:
+            shutil.rmtree(f"{self.package_dir}/{self.package_hash}")
+        # the environment is installed once per package hash and archived once per layer key, other archive options
+        # archive the installed environment again. A previous archive is kept on rebuilds, unchanged members are
+        # copied from it instead of recompressed.
+        if not was_package_built or not os.path.exists(layer_zip_path) or self.force_rebuild:
+            print("building python environment")
+            build_env(self.package_hash, requirements=requirements, package_dir=self.package_dir,
+                      runtime=self.runtime, wheelhouse=self.wheelhouse, offline=self.offline_build,
+                      prune_rules=self.prune_rules, compile_pyc=self.compile_pyc, archive_name=self.layer_key)
+            print("finished creating python environment")
+            self.force_rebuild = False
+        # the dependencies are published once as a layer, the handler is updated in place and the live alias is
+        # moved to a new version, warm containers of the previous version keep serving invocations in flight.
+        deployer = Deployer(self.lambda_client, function_name, lambda: get_role_arn(self.role_name),
+                            runtime=self.runtime, memory_size=resources.memory_size, timeout=resources.timeout,
+                            s3_bucket=self.s3_bucket)
+        version = deployer.deploy(self.layer_key, layer_zip_path,
+                                  build_handler_archive(self.package_dir, self.handler_files()))
+        self.manifest.record(function_name, {**record, "version": version,
+                                             "preload_digest": self.remote_project_digest if self.preload_project
+                                             else None})
+        self.deployed_versions[function_name] = version
+        return version
 
     def list_lambda_functions(self) -> Dict[str, Dict[str, Union[str, int, Dict]]]:
-        return {i['FunctionName']: i for i in self.lambda_client.list_functions()['Functions']}
+        functions = {}
+        params = {}
+        while True:
+            response = self.lambda_client.list_functions(**params)
+            functions |= {i['FunctionName']: i for i in response['Functions']}
+            if not response.get('NextMarker'):
+                return functions
+            params['Marker'] = response['NextMarker']
+
+    def _invoke_with_project(self, prepared: PreparedFunction, request: Dict[str, Any], codec: str,
+                             calls: int = 1) -> Dict[str, Any]:
+        # only the files that changed since the digest the container last reported are sent. When the container
+        # handling the call does not hold that base, it answers with missing_project and the full tree is sent.
+        # A container that cannot load the compiled context answers with unsupported_context, source is sent instead.
+        files = self._project_files(prepared)
+        project = self._encode(prepared.snapshot.delta(self.remote_project_digest, files), codec)
+        for _ in range(3):
+            response = self._invoke({**request, "project": project}, prepared, calls)
+            if "missing_project" in response:
+                project = self._encode(prepared.snapshot.delta(None, files), codec)
+            elif "unsupported_context" in response:
+                print(f"lambda runtime cannot load code compiled by python {platform.python_version()}, "
+                      f"sending source instead")
+                self.ship_compiled_contexts = False
+                request = {**request, "context": self._encode_context(prepared, codec)}
+            else:
+                self.remote_project_digest = response["project"]
+                return response
+        raise Exception(f"invocation of {prepared.func_name} kept being rejected: {response}")
+
+    def _encode(self, value: Any, codec: str) -> Envelope:
+        return encode(value, codec, self.blob_store, self.offload_threshold)
+
+    def _prepare_function(self, func: Callable) -> PreparedFunction:
+        # the project of python files is passed to the invocation as a content addressed snapshot,
+        # files are only re-read when they change on disk.
+        snapshot = get_project_snapshot(os.getcwd())
+        if self.include:
+            snapshot.track(self.include)
+        snapshot.refresh()
+
+        # relevant function name is passed to the lambda.
+        func_name = func.__name__
+
+        # The logic below is used to grab the source of the file in which the function above is located.
+        # this source is passed to the invocation. Functions whose code does not point at a file (notebooks, exec)
+        # are looked up in the symbol index of the project.
+        file_path = inspect.getabsfile(func)
+        if not os.path.isfile(file_path):
+            file_path = os.path.join(os.getcwd(), get_symbol_index(snapshot).find(func))
+        content = get_file(file_path)
+        relative_path = os.path.relpath(file_path, os.getcwd()).replace(os.sep, "/")
+        files = get_import_graph(snapshot).closure(relative_path, self.include) if self.slice_imports else None
+        return PreparedFunction(snapshot, hashlib.sha256(content).hexdigest(), func_name, content.decode("utf-8"),
+                                relative_path, files, self._function_resources.get(func),
+                                self._function_retries.get(func), self._function_hedges.get(func))
+
+    def _encode_context(self, prepared: PreparedFunction, codec: str) -> Envelope:
+        # each version of a file is compiled and encoded once, repeat calls reuse the envelope.
+        key = (prepared.context_digest, self.ship_compiled_contexts, codec)
+        with self._contexts_lock:
+            if key in self._contexts:
+                self._contexts.move_to_end(key)
+                return self._contexts[key]
+        envelope = encode(make_context(prepared.source, prepared.filename, self.ship_compiled_contexts), codec)
+        with self._contexts_lock:
+            self._contexts[key] = envelope
+            while len(self._contexts) > MAX_CACHED_CONTEXTS:
+                self._contexts.popitem(last=False)
+        return envelope
+
+    def _build_request(self, prepared: PreparedFunction, codec: str) -> Dict[str, Any]:
+        # the context is encoded on its own so a warm container that already executed it can skip it.
+        return {
+            "function": [prepared.context_digest, prepared.func_name],
+            "context": self._encode_context(prepared, codec),
+            "response_codec": codec,
+            "blob_store": self.blob_store.spec() if self.blob_store is not None else None,
+            "offload_threshold": self.offload_threshold,
+            "depth": get_next_depth()
+        }
+
+    def _build_call_request(self, prepared: PreparedFunction, args: Tuple, kwargs: Dict[str, Any],
+                            codec: str) -> Dict[str, Any]:
+        call, offloaded = encode_call(args, kwargs, codec, self.blob_store, self.offload_threshold)
+        return {**self._build_request(prepared, codec), "call": call, "offloaded": offloaded}
+
+    # the profile a call runs with: its decorator's or the builder's, with the memory size the tuner picked when it
+    # switches sizes. Calls made inside lambdas are not tuned, the variants they would go to may not be deployed.
+    def _resources_for(self, func_name: str, resources: Optional[ResourceProfile]) -> ResourceProfile:
+        resources = resources or self.resources
+        if self.tuner is None or is_in_aws_lambda():
+            return resources
+        return resources.with_memory_size(self.tuner.next_memory_size(func_name, resources.memory_size))
+
+    # calls is the number of elements of a map chunk. Exceptions raised in the lambda, and failures of the lambda,
+    # are raised as RemoteError once the retry policy gives up on them.
+    def _invoke(self, request: Dict[str, Any], prepared: PreparedFunction, calls: int = 1) -> Dict[str, Any]:
+        func_name = request["function"][1]
+        resources = self._resources_for(func_name, prepared.resources)
+        if self.auto_deploy:
+            self.deploy()
+            self.deploy(resources=resources)
+        trace = request_trace()
+        if trace is not None:
+            request = {**request, "trace": trace}
+        if self.tuner is not None:
+            request = {**request, "usage": True}
+        # retries and hedged duplicates run the call under the same key, see get_idempotency_key.
+        request = {**request, "idempotency_key": uuid.uuid4().hex}
+        payload = json.dumps(request).encode('utf-8')
+        record_size("request_bytes", len(payload))
+        retry = prepared.retry or self.retry
+        # streams write their chunks as they run, they are not hedged and only retried when they did not run.
+        is_stream = "stream" in request
+        hedge = None if is_stream else prepared.hedge or self.hedge
+        retried: Dict[str, int] = {}
+        while True:
+            try:
+                with stage("invoke"):
+                    response_payload = self._send(payload, resources, func_name, hedge, calls)
+                response = json.loads(response_payload)
+                if "errorMessage" in response:
+                    raise RemoteError.from_payload(response)
+                break
+            except Exception as e:
+                delay = retry.next_delay(e, retried, not is_stream) if retry is not None else None
+                if delay is None:
+                    raise
+                time.sleep(delay)
+        record_size("response_bytes", len(response_payload))
+        if "trace" in response:
+            record_response_trace(response.pop("trace"))
+        usage = response.pop("usage", None)
+        # answers asking for the project or the source did not run the function.
+        if usage is not None and usage["memory_size"] is not None and "project" in response:
+            self.tuner.record(func_name, usage["memory_size"], usage["duration_ms"], usage["calls"])
+        return response
+
+    # Sends an invocation. Hedged calls wait for the answer for the hedge delay of the function, then fire a duplicate,
+    # see HedgePolicy. Invocations of hedged calls run on threads of their own so the caller can take the first answer.
+    def _send(self, payload: bytes, resources: ResourceProfile, func_name: str, hedge: Optional[HedgePolicy],
+              calls: int) -> bytes:
+        delay = hedge.delay(func_name, calls) if hedge is not None else None
+        start = time.monotonic()
+        if delay is None:
+            response_payload = self.backend.invoke(payload, resources)
+            if hedge is not None:
+                hedge.observe(func_name, time.monotonic() - start, calls)
+            return response_payload
+        with self._engine_lock:
+            if self._hedge_executor is None:
+                self._hedge_executor = ThreadPoolExecutor(max_workers=self.thread_count * 2,
+                                                          thread_name_prefix="bauplan-hedge")
+        invocations = [self._hedge_executor.submit(contextvars.copy_context().run, self.backend.invoke, payload,
+                                                   resources)]
+        pending = set(invocations)
+        error: Optional[BaseException] = None
+        while pending:
+            done, pending = wait(pending, delay if len(invocations) <= hedge.max_hedges else None, FIRST_COMPLETED)
+            if not done:
+                invocations.append(self._hedge_executor.submit(contextvars.copy_context().run, self.backend.invoke,
+                                                               payload, resources))
+                pending.add(invocations[-1])
+                continue
+            for invocation in done:
+                if invocation.exception() is None:
+                    hedge.observe(func_name, time.monotonic() - start, calls)
+                    hedge.record_hedges(len(invocations) - 1, invocation is not invocations[0])
+                    return invocation.result()
+                error = invocation.exception()
+        hedge.record_hedges(len(invocations) - 1, False)
+        raise error
+
+    def _should_run_in_process(self, policy: Optional[ExecutionPolicy], args: Tuple, kwargs: Dict[str, Any]) -> bool:
+        if self.backend.runs_nested_calls_in_process():
+            return True
+        policy = policy or self.policy
+        return policy is not None and not policy.should_run_remotely(args, kwargs)
+
+    def _should_run_chunk_in_process(self, policy: Optional[ExecutionPolicy],
+                                     chunk: List[Tuple[Tuple, Dict[str, Any]]]) -> bool:
+        policy = policy or self.policy
+        return policy is not None and not policy.should_run_chunk_remotely(chunk)
+
+    @staticmethod
+    def _call_key(prepared: PreparedFunction, args: Tuple, kwargs: Dict[str, Any]) -> str:
+        return call_key(prepared.context_digest, prepared.func_name, prepared.snapshot.digest, args, kwargs)
+
+    def _invoke_function(self, func: Callable, prepared: Optional[PreparedFunction], args: Tuple,
+                         kwargs: Dict[str, Any], payload_codec: str) -> Any:
+        with span(func.__name__, "client", self.tracer, depth=get_next_depth()):
+            with stage("prepare"):
+                prepared = prepared or self._prepare_function(func)
+            with stage("encode_call"):
+                request = self._build_call_request(prepared, args, kwargs, payload_codec)
+            response = self._invoke_with_project(prepared, request, payload_codec)
+            with stage("decode_result"):
+                return decode(response["result"], self.blob_store)
+
+    def _call_in_process(self, func: Callable, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+        with span(func.__name__, "in_process", self.tracer, depth=get_next_depth() - 1):
+            return func(*args, **kwargs)
+
+    async def _aio_call_in_process(self, func: Callable, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+        with span(func.__name__, "in_process", self.tracer, depth=get_next_depth() - 1):
+            return await func(*args, **kwargs)
+
+    # options given to a function's decorator, _prepare_function looks them up.
+    def _register(self, func: Callable, resources: Optional[ResourceProfile], retry: Optional[RetryPolicy],
+                  hedge: Optional[HedgePolicy]) -> None:
+        self._functions.append(func)
+        if resources is not None:
+            self._function_resources[func] = resources
+            # functions decorated after the first call.
+            if self._engine is not None:
+                self._engine.ensure_read_timeout(resources.timeout)
+        if retry is not None:
+            self._function_retries[func] = retry
+        if hedge is not None:
+            self._function_hedges[func] = hedge
+
+    # resources runs the function's calls on a variant of the builder's function deployed with that memory size and
+    # timeout, see function_name_for. retry and hedge override the builder's policies, see RetryPolicy and HedgePolicy.
+    def cloud_execute(self, local=False, codec: Optional[str] = None, policy: Optional[ExecutionPolicy] = None,
+                      cache: Union[ResultCache, bool, None] = None, coalesce: bool = False,
+                      resources: Optional[ResourceProfile] = None, retry: Optional[RetryPolicy] = None,
+                      hedge: Optional[HedgePolicy] = None):
+        result_cache = ResultCache() if cache is True else cache or None
+        # identical calls in flight at the same time share one invocation when coalesce is set.
+        single_flight = SingleFlight() if coalesce else None
 
-    def cloud_execute(self, local=False):
         def inner(func: Callable[[...], Any]) -> Callable[[...], Any]:
             if inspect.iscoroutinefunction(func):
                 raise Exception("cloud_execute cannot decorated on async functions.")
+            self._register(func, resources, retry, hedge)
+            if inspect.isgeneratorfunction(func):
+                return self._stream_decorator(func, local, codec, policy, cache, coalesce, read_stream)
 
-            def result(*args, force_local: bool = False, **kwargs) -> Any:
+            @functools.wraps(func)
+            def result(*args, force_local: bool = False, payload_codec: Optional[str] = None, **kwargs) -> Any:
                 # once a function is invoked, that function is not called locally but is called on a lambda with an
                 # identical environment. On that lambda the function will be called locally so a force_local
                 # parameter is passed to the decorated function to indicate that.
@@ -101,101 +619,296 @@ class LambdaBuilder:
                     # del kwargs["force_local"]
                     return func(*args, **kwargs)
 
-                else:
-                    # the entire project of python files is passed to the invocation.
-                    python_project_files = get_python_project_structure(os.getcwd(),
-                                                                        ["venv", "__pycache__", "packages"], r"^\..*")
-
-                    # relevant function name is passed to the lambda.
-                    func_name = func.__name__
-
-                    # The logic below is used to grab an ast tree of the file in which the function above is located.
-                    # this ast tree is passed to the invocation.
-                    file_path = inspect.getabsfile(func)
-                    if not os.path.isdir(file_path):
-                        context = get_context_from_file(file_path)
+                prepared, key = None, None
+                if result_cache is not None or single_flight is not None:
+                    prepared = self._prepare_function(func)
+                    key = self._call_key(prepared, args, kwargs)
+                if result_cache is not None:
+                    hit, value = result_cache.get(key)
+                    if hit:
+                        return value
+
+                def call() -> Any:
+                    # inside a lambda the execution policy can keep a nested call in process.
+                    if self._should_run_in_process(policy, args, kwargs):
+                        value = self._call_in_process(func, args, kwargs)
                     else:
-                        file_path = f"{os.getcwd()}/{find_file_with_function(func_name, python_project_files)}"
-                        if file_path is None:
-                            raise Exception(f"function with name: {func_name} could not be found")
-                        context = get_context_from_file(file_path)
-
-                    # this code is the compressed data that is passed to the lambda.
-                    serialized_data = base64.b85encode(
-                        lzma.compress(
-                            pickle.dumps(
-                                (python_project_files, context, func_name, args, kwargs)
-                            )
-                        )
-                    ).decode('utf-8')
-                    response = self.lambda_client.invoke(
-                        FunctionName=self.lambda_function_name,
-                        Payload=json.dumps({"data": serialized_data}).encode('utf-8'),
-                        InvocationType="RequestResponse"
-                    )
-                    return pickle.loads(
-                        lzma.decompress(
-                            base64.b85decode(
-                                json.loads(
-                                    response['Payload'].read()
-                                )['data']
-                            )
-                        )
-                    )
+                        value = self._invoke_function(func, prepared, args, kwargs,
+                                                      payload_codec or codec or self.codec)
+                    if result_cache is not None:
+                        result_cache.set(key, value)
+                    return value
 
+                return single_flight.do(key, call) if single_flight is not None else call()
+
+            result.codec = codec
+            result.local = local
+            result.policy = policy
+            result.cache = result_cache
+            result.single_flight = single_flight
             return result
 
         return inner
 
     # quick and dirty async version of the above decorator.
     # mostly uses identical and copied logic.
-    def aio_cloud_execute(self, local=False):
+    def aio_cloud_execute(self, local=False, codec: Optional[str] = None, policy: Optional[ExecutionPolicy] = None,
+                          cache: Union[ResultCache, bool, None] = None, coalesce: bool = False,
+                          resources: Optional[ResourceProfile] = None, retry: Optional[RetryPolicy] = None,
+                          hedge: Optional[HedgePolicy] = None):
+        result_cache = ResultCache() if cache is True else cache or None
+        single_flight = SingleFlight() if coalesce else None
+
         def inner(func: Callable[[...], Awaitable[Any]]) -> Union[Callable[[...], Awaitable[Any]]]:
-            if not inspect.iscoroutinefunction(func):
+            if not inspect.iscoroutinefunction(func) and not inspect.isasyncgenfunction(func):
                 raise Exception("Incorrect decoration, can only decorate async functions with aio_cloud_execute")
+            self._register(func, resources, retry, hedge)
+            if inspect.isasyncgenfunction(func):
+                return self._stream_decorator(func, local, codec, policy, cache, coalesce, aio_read_stream)
 
-            async def result(*args, force_local=False, **kwargs) -> Awaitable[Any]:
+            @functools.wraps(func)
+            async def result(*args, force_local=False, payload_codec: Optional[str] = None, **kwargs) -> Awaitable[Any]:
                 if local or self.mock_mode or force_local:
                     return await func(*args, **kwargs)
-                else:
-                    python_project_files = get_python_project_structure(os.getcwd(),
-                                                                        ["venv", "__pycache__", "packages"], r"^\..*")
-                    func_name = func.__name__
-                    file_path = inspect.getabsfile(func)
-                    if not os.path.isdir(file_path):
-                        context = get_context_from_file(file_path)
+
+                prepared, key = None, None
+                if result_cache is not None or single_flight is not None:
+                    prepared = self._prepare_function(func)
+                    key = self._call_key(prepared, args, kwargs)
+                if result_cache is not None:
+                    # cache tiers may touch the disk or s3, lookups run on the default executor of the loop rather than
+                    # queue behind the invocations in flight on the engine's threads.
+                    hit, value = await asyncio.to_thread(result_cache.get, key)
+                    if hit:
+                        return value
+
+                async def call() -> Any:
+                    if self._should_run_in_process(policy, args, kwargs):
+                        value = await self._aio_call_in_process(func, args, kwargs)
                     else:
-                        file_path = find_file_with_function(func_name, python_project_files)
-                        if file_path is None:
-                            raise Exception(f"function with name: {func_name} could not be found")
-                        context = get_context_from_file(file_path)
-
-                    serialized_data = base64.b85encode(
-                        lzma.compress(
-                            pickle.dumps(
-                                (python_project_files, context, func_name, args, kwargs)
-                            )
-                        )
-                    ).decode('utf-8')
-
-                    invoke_params = {
-                        "FunctionName": self.lambda_function_name,
-                        "Payload": json.dumps({"data": serialized_data}).encode('utf-8'),
-                        "InvocationType": "RequestResponse"
-                    }
-                    invokation_function = lambda _: self.lambda_client.invoke(**invoke_params)
-                    response = await asyncio.get_event_loop() \
-                        .run_in_executor(ThreadPoolExecutor(max_workers=self.thread_count), invokation_function, None)
-                    return pickle.loads(
-                        lzma.decompress(
-                            base64.b85decode(
-                                json.loads(
-                                    response['Payload'].read()
-                                )['data']
-                            )
-                        )
-                    )
+                        value = await self.engine.run(self._invoke_function, func, prepared, args, kwargs,
+                                                      payload_codec or codec or self.codec)
+                    if result_cache is not None:
+                        await asyncio.to_thread(result_cache.set, key, value)
+                    return value
 
+                return await (single_flight.aio_do(key, call) if single_flight is not None else call())
+
+            result.codec = codec
+            result.local = local
+            result.policy = policy
+            result.cache = result_cache
+            result.single_flight = single_flight
             return result
 
         return inner
+
+    # Generator functions stream: a call returns an iterator, an async iterator for async generators, yielding items
+    # while the lambda is still producing them, see StreamWriter. Results of a stream are not cached or shared.
+    def _stream_decorator(self, func: Callable, local: bool, codec: Optional[str], policy: Optional[ExecutionPolicy],
+                          cache: Union[ResultCache, bool, None], coalesce: bool,
+                          read: Callable[[StreamReader], Any]) -> Callable:
+        if cache or coalesce:
+            raise Exception(f"cache and coalesce cannot be used with generator function {func.__name__}")
+
+        @functools.wraps(func)
+        def result(*args, force_local: bool = False, payload_codec: Optional[str] = None, **kwargs) -> Any:
+            if local or self.mock_mode or force_local:
+                return func(*args, **kwargs)
+            if self._should_run_in_process(policy, args, kwargs):
+                return func(*args, **kwargs)
+            if self.result_store is None:
+                raise Exception(f"streaming {func.__name__} needs a result store, pass result_store, s3_bucket or "
+                                f"blob_store")
+            prefix = f"stream-{self.job_session}-{uuid.uuid4().hex}"
+            invocation = self.engine.submit(self._invoke_stream, func, args, kwargs,
+                                            payload_codec or codec or self.codec,
+                                            {"store": self.result_store.spec(), "prefix": prefix})
+            return read(StreamReader(self.result_store, prefix, invocation, self.blob_store))
+
+        result.codec = codec
+        result.local = local
+        result.policy = policy
+        result.cache = None
+        result.single_flight = None
+        return result
+
+    # the invocation behind a stream, returns the number of chunks written.
+    def _invoke_stream(self, func: Callable, args: Tuple, kwargs: Dict[str, Any], payload_codec: str,
+                       stream: Dict[str, Any]) -> int:
+        with span(func.__name__, "client", self.tracer, depth=get_next_depth(), stream=True):
+            with stage("prepare"):
+                prepared = self._prepare_function(func)
+            with stage("encode_call"):
+                request = {**self._build_call_request(prepared, args, kwargs, payload_codec), "stream": stream}
+            response = self._invoke_with_project(prepared, request, payload_codec)
+            if "stream" not in response:
+                raise Exception(f"stream of {func.__name__} failed: {response}")
+            return response["stream"]
+
+    # Fire and forget. The call is sent as an asynchronous invocation and a Job handle is returned right away, the
+    # lambda writes the outcome to the result store where the handle polls for it. A driver can keep any number of
+    # jobs in flight without a connection or thread per job. See jobs.as_completed to wait for many jobs.
+    def submit(self, func: Callable, *args, **kwargs) -> Job:
+        codec = func.codec or self.codec
+        if func.local or self.mock_mode:
+            try:
+                response = {"result": encode(self._call_locally(func, args, kwargs), codec)}
+            except Exception as e:
+                response = {"error": encode_exception(e)}
+            return Job(self, func.__name__, None, args, kwargs, codec, self.job_session, response)
+        if self.result_store is None:
+            raise Exception("submit needs a result store, pass result_store, s3_bucket or blob_store")
+        job = Job(self, func.__name__, self._prepare_function(func.__wrapped__), args, kwargs, codec,
+                  self.job_session)
+        self._submit_job(job)
+        return job
+
+    def _submit_job(self, job: Job) -> None:
+        # nobody is there to answer missing_project, jobs carry the full project. It is encoded once per version and
+        # offloaded to the blob store when large, so many jobs share one upload.
+        prepared = job.prepared
+        files = self._project_files(prepared)
+        key = (prepared.snapshot.digest, files, job.codec)
+        cached = self._job_project
+        if cached is None or cached[0] != key:
+            cached = (key, self._encode(prepared.snapshot.delta(None, files), job.codec))
+            self._job_project = cached
+        store = self.result_store.spec()
+        job_spec = {"store": store, "result": job.result_key, "start": job.start_key}
+        request = {**self._build_call_request(prepared, job.args, job.kwargs, job.codec), "project": cached[1],
+                   "job": job_spec, "idempotency_key": job.id}
+        payload = json.dumps(request).encode('utf-8')
+        if len(payload) > EVENT_PAYLOAD_LIMIT:
+            self.result_store.write(job.request_key, payload)
+            payload = json.dumps({"job": {**job_spec, "request": job.request_key},
+                                  "idempotency_key": job.id}).encode('utf-8')
+        resources = self._resources_for(prepared.func_name, prepared.resources)
+        if self.auto_deploy:
+            self.deploy()
+            self.deploy(resources=resources)
+        self.backend.submit(payload, resources)
+
+    # Batched fan out. Elements are grouped into chunks and every chunk is a single invocation, the lambda loops over
+    # the chunk, so invocation, serialization and project shipping overhead is paid once per chunk instead of once per
+    # element. func is a function decorated with cloud_execute or aio_cloud_execute of this builder.
+    def map(self, func: Callable, iterable: Iterable[Any], chunksize: Optional[int] = None,
+            max_concurrency: Optional[int] = None, ordered: bool = True) -> Iterator[Any]:
+        return self.starmap(func, ((element,) for element in iterable), chunksize, max_concurrency, ordered)
+
+    def starmap(self, func: Callable, iterable: Iterable[Tuple], chunksize: Optional[int] = None,
+                max_concurrency: Optional[int] = None, ordered: bool = True) -> Iterator[Any]:
+        calls = ((tuple(args), {}) for args in iterable)
+        if func.local or self.mock_mode or self.backend.runs_nested_calls_in_process():
+            return (self._call_locally(func, args, kwargs) for args, kwargs in calls)
+        return self._map_chunks(func, calls, chunksize, max_concurrency, ordered)
+
+    def aio_map(self, func: Callable, iterable: Iterable[Any], chunksize: Optional[int] = None,
+                max_concurrency: Optional[int] = None, ordered: bool = True) -> AsyncIterator[Any]:
+        return self.aio_starmap(func, ((element,) for element in iterable), chunksize, max_concurrency, ordered)
+
+    async def aio_starmap(self, func: Callable, iterable: Iterable[Tuple], chunksize: Optional[int] = None,
+                          max_concurrency: Optional[int] = None, ordered: bool = True) -> AsyncIterator[Any]:
+        calls = ((tuple(args), {}) for args in iterable)
+        if func.local or self.mock_mode or self.backend.runs_nested_calls_in_process():
+            for args, kwargs in calls:
+                result = func(*args, force_local=True, **kwargs)
+                yield await result if inspect.isawaitable(result) else result
+            return
+        # chunks are submitted lazily, at most max_concurrency are in flight at any time.
+        chunk_iterator = self._chunk_calls(func, calls, chunksize)
+        in_flight: Deque[asyncio.Future] = deque(
+            asyncio.ensure_future(self.engine.run(invoke_chunk))
+            for invoke_chunk in itertools.islice(chunk_iterator, max_concurrency or self.thread_count))
+        try:
+            while in_flight:
+                if ordered:
+                    results = await in_flight.popleft()
+                else:
+                    done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    done_future = done.pop()
+                    in_flight.remove(done_future)
+                    results = done_future.result()
+                invoke_chunk = next(chunk_iterator, None)
+                if invoke_chunk is not None:
+                    in_flight.append(asyncio.ensure_future(self.engine.run(invoke_chunk)))
+                for result in results:
+                    yield result
+        finally:
+            for future in in_flight:
+                future.cancel()
+
+    @staticmethod
+    def _call_locally(func: Callable, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+        result = func(*args, force_local=True, **kwargs)
+        return asyncio.run(result) if inspect.isawaitable(result) else result
+
+    def _chunk_calls(self, func: Callable, calls: Iterator[Tuple[Tuple, Dict[str, Any]]],
+                     chunksize: Optional[int]) -> Iterator[Callable[[], List[Any]]]:
+        # yields one callable per chunk, chunk sizes adapt to the latency observed on completed chunks unless chunksize
+        # is given. The iterable is consumed lazily so very long inputs are never materialized. Inside a lambda the
+        # function's execution policy decides for each chunk, as it is submitted, whether it is shipped or run in
+        # process.
+        prepared = self._prepare_function(func.__wrapped__)
+        payload_codec = func.codec or self.codec
+        base_request = self._build_request(prepared, payload_codec)
+        sizer = ChunkSizer(chunksize)
+
+        def invoke_chunk(chunk: List[Tuple[Tuple, Dict[str, Any]]]) -> List[Any]:
+            start = time.monotonic()
+            with span(prepared.func_name, "client", self.tracer, depth=get_next_depth(), elements=len(chunk)):
+                with stage("encode_call"):
+                    request = {**base_request, "calls": self._encode(chunk, payload_codec)}
+                response = self._invoke_with_project(prepared, request, payload_codec, len(chunk))
+                with stage("decode_result"):
+                    results = decode(response["results"], self.blob_store)
+            sizer.observe(len(chunk), time.monotonic() - start)
+            return results
+
+        def run_chunk_in_process(chunk: List[Tuple[Tuple, Dict[str, Any]]]) -> List[Any]:
+            with span(prepared.func_name, "in_process", self.tracer, depth=get_next_depth() - 1, elements=len(chunk)):
+                return [self._call_locally(func, args, kwargs) for args, kwargs in chunk]
+
+        while True:
+            chunk = list(itertools.islice(calls, sizer.next_chunksize()))
+            if not chunk:
+                return
+            if self._should_run_chunk_in_process(func.policy, chunk):
+                yield functools.partial(run_chunk_in_process, chunk)
+            else:
+                yield functools.partial(invoke_chunk, chunk)
+
+    def _map_chunks(self, func: Callable, calls: Iterator[Tuple[Tuple, Dict[str, Any]]], chunksize: Optional[int],
+                    max_concurrency: Optional[int], ordered: bool) -> Iterator[Any]:
+        max_concurrency = max_concurrency or self.thread_count
+        chunk_iterator = self._chunk_calls(func, calls, chunksize)
+        in_flight: Deque[Future] = deque(self.engine.submit(invoke_chunk)
+                                         for invoke_chunk in itertools.islice(chunk_iterator, max_concurrency))
+        try:
+            while in_flight:
+                if ordered:
+                    results = in_flight.popleft().result()
+                else:
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    done_future = done.pop()
+                    in_flight.remove(done_future)
+                    results = done_future.result()
+                invoke_chunk = next(chunk_iterator, None)
+                if invoke_chunk is not None:
+                    in_flight.append(self.engine.submit(invoke_chunk))
+                yield from results
+        finally:
+            # chunks not yet started are dropped when the consumer stops early or a chunk fails.
+            for future in in_flight:
+                future.cancel()
+
+    # releases the builder's invocation threads, calls made afterwards raise.
+    def shutdown(self, wait: bool = True) -> None:
+        if self.tuner is not None:
+            self.tuner.save()
+        if self._engine is not None:
+            self._engine.shutdown(wait)
+        if self._hedge_executor is not None:
+            self._hedge_executor.shutdown(wait)
+        self.backend.shutdown(wait)
+
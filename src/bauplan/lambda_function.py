@@ -1,24 +1,26 @@
 import asyncio
+import importlib.util
 import inspect
+import json
+import marshal
 import os
+import platform
 import shutil
 import lzma
+import zlib
+import pickle as std_pickle
 import dill as pickle
-from typing import Union, Dict
+from collections import OrderedDict
+from types import CodeType
+from typing import Union, Dict, Optional, Set, NamedTuple, Any, Callable, Tuple, List
 import base64
+import hashlib
 import sys
-
-
-def delete_all_in_directory(directory: str) -> None:
-    for filename in os.listdir(directory):
-        file_path = os.path.join(directory, filename)
-        try:
-            if os.path.isfile(file_path) or os.path.islink(file_path):
-                os.unlink(file_path)  # remove file or symbolic link
-            elif os.path.isdir(file_path):
-                shutil.rmtree(file_path)  # remove directory
-        except Exception as e:
-            print(f'Failed to delete {file_path}. Reason: {e}')
+import threading
+import time
+import traceback
+import uuid
+from contextlib import contextmanager
 
 
 def write_file(path: str, data: bytes) -> None:
@@ -26,52 +28,903 @@ def write_file(path: str, data: bytes) -> None:
         file.write(data)
 
 
-FileStructure = Dict[str, Union[bytes, 'FileStructure']]
+# Payload codecs. This module is deployed on its own as the lambda handler, so the encoding shared by the client and
+# the lambda lives here and the client imports it from this file. Every envelope records the id of the codec that
+# produced it so both sides agree on how to decode it.
+#
+# envelope: {"codec": <id>, "data": <base64 pickle>, "buffers": [<base64 out of band buffer>, ...]}
+#       or: {"codec": <id>, "blob": <key>, "buffer_blobs": [<key>, ...]} when offloaded to a blob store.
+#
+# Values are pickled with protocol 5, objects exposing their memory (numpy arrays, PickleBuffer) are handed out of band
+# and compressed straight from their memory instead of being copied into the pickle stream first.
+Envelope = Dict[str, Union[str, List[str]]]
+
+# Stage timings. A StageTimer activated for the current thread collects the milliseconds spent in named stages and the
+# sizes of what passed through them, encode and decode report pickling, compression and blob transfers into it. Stages
+# nest, "decode_args" includes the "decompress" and "unpickle" time spent decoding the arguments. With no active timer
+# a stage costs a thread local lookup. Used by the handler and by traced calls on the client.
+class StageTimer:
+    def __init__(self):
+        self.stages: Dict[str, float] = {}
+        self.sizes: Dict[str, int] = {}
+
+    def add(self, name: str, milliseconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + milliseconds
+
+    def add_size(self, name: str, size: int) -> None:
+        self.sizes[name] = self.sizes.get(name, 0) + size
+
+
+active_timers = threading.local()
+
+
+def get_active_timer() -> Optional[StageTimer]:
+    return getattr(active_timers, "timer", None)
+
+
+@contextmanager
+def activate_timer(timer: Optional[StageTimer]):
+    previous = get_active_timer()
+    active_timers.timer = timer
+    try:
+        yield timer
+    finally:
+        active_timers.timer = previous
+
+
+@contextmanager
+def stage(name: str):
+    timer = get_active_timer()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, (time.perf_counter() - start) * 1000)
+
+
+def record_size(name: str, size: int) -> None:
+    timer = get_active_timer()
+    if timer is not None:
+        timer.add_size(name, size)
+
+
+CODECS: Dict[str, Tuple[Callable[[Any], bytes], Callable[[bytes], bytes]]] = {
+    "raw": (lambda data: data, lambda data: data),
+    "zlib": (lambda data: zlib.compress(data, 1), zlib.decompress),
+    "lzma": (lambda data: lzma.compress(data, preset=1), lzma.decompress),
+}
+AUTO_CODEC = "auto"
+# below this size compressing costs more than the bytes it saves.
+RAW_CODEC_THRESHOLD = 4 * 1024
+# above this size a sample is compressed first, data that does not compress (compressed images, random floats) is
+# sent raw rather than paying zlib's time on every byte of it.
+PROBE_THRESHOLD = 64 * 1024
+PROBE_BYTES = 64 * 1024
+# a sample compressing to more than this fraction of its size is not worth compressing.
+MAX_COMPRESSED_RATIO = 0.9
+
+
+def is_compressible(data: Any) -> bool:
+    sample = bytes(memoryview(data).cast("B")[:PROBE_BYTES])
+    return len(zlib.compress(sample, 1)) < len(sample) * MAX_COMPRESSED_RATIO
+
+
+# auto picks raw or zlib, lzma compresses better but is an order of magnitude slower on large payloads and is only
+# used when asked for. sample is the largest part of the payload, probed when the payload is large.
+def choose_codec(codec: str, size: int, sample: Any = None) -> str:
+    if codec != AUTO_CODEC:
+        if codec not in CODECS:
+            raise Exception(f"unknown codec: {codec}, expected one of {[AUTO_CODEC, *CODECS]}")
+        return codec
+    if size < RAW_CODEC_THRESHOLD:
+        return "raw"
+    if size >= PROBE_THRESHOLD and sample is not None and not is_compressible(sample):
+        return "raw"
+    return "zlib"
+
+
+# Blob stores hold values too large to be inlined in the invoke payload (capped at 6MB for synchronous calls). Blobs
+# are content addressed, so identical values fanned out to many lambdas are uploaded once.
+class BlobStore:
+    def put(self, data: Any) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        if not self.exists(key):
+            self.write(key, data)
+        return key
+
+    def exists(self, key: str) -> bool:
+        raise NotImplementedError
+
+    def write(self, key: str, data: Any) -> None:
+        raise NotImplementedError
+
+    # writes the key unless it exists, returns whether it was written. Duplicates of an invocation (retries, hedges,
+    # lambda's redeliveries of asynchronous events) use it so the first outcome written is the one kept.
+    def create(self, key: str, data: Any) -> bool:
+        if self.exists(key):
+            return False
+        self.write(key, data)
+        return True
+
+    def get(self, key: str) -> bytes:
+        raise NotImplementedError
+
+    # removes the key when it exists. Only job and stream keys are deleted, content addressed blobs may be shared.
+    def delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    # keys starting with prefix, used to poll for many job results with one listing.
+    def list_keys(self, prefix: str) -> List[str]:
+        raise NotImplementedError
+
+    # the lambda opens the same store from this description, see blob_store_from_spec.
+    def spec(self) -> Dict[str, str]:
+        raise NotImplementedError
+
+
+class LocalBlobStore(BlobStore):
+    def __init__(self, directory: str):
+        self.directory = os.path.abspath(directory)
+        os.makedirs(self.directory, exist_ok=True)
+
+    def exists(self, key: str) -> bool:
+        return os.path.exists(os.path.join(self.directory, key))
+
+    def write(self, key: str, data: Any) -> None:
+        # written under a temporary name and renamed so readers never observe a partial blob.
+        partial_path = os.path.join(self.directory, f".{key}.{os.getpid()}.{time.monotonic_ns()}")
+        write_file(partial_path, data)
+        os.replace(partial_path, os.path.join(self.directory, key))
+
+    def create(self, key: str, data: Any) -> bool:
+        partial_path = os.path.join(self.directory, f".{key}.{os.getpid()}.{time.monotonic_ns()}")
+        write_file(partial_path, data)
+        try:
+            # linking fails when the key exists, unlike a rename.
+            os.link(partial_path, os.path.join(self.directory, key))
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(partial_path)
+
+    def get(self, key: str) -> bytes:
+        with open(os.path.join(self.directory, key), 'rb') as file:
+            return file.read()
+
+    def delete(self, key: str) -> None:
+        try:
+            os.remove(os.path.join(self.directory, key))
+        except FileNotFoundError:
+            pass
+
+    def list_keys(self, prefix: str) -> List[str]:
+        return [name for name in os.listdir(self.directory) if name.startswith(prefix) and not name.startswith(".")]
+
+    def spec(self) -> Dict[str, str]:
+        return {"type": "local", "directory": self.directory}
+
+
+class S3BlobStore(BlobStore):
+    def __init__(self, bucket: str, prefix: str = "bauplan/blobs/", cache_directory: Optional[str] = None):
+        self.bucket = bucket
+        self.prefix = prefix
+        self._client = None
+        self._client_lock = threading.Lock()
+        # keys known to exist remotely, so repeated uploads of the same value skip the HEAD request as well.
+        self.known_keys: Set[str] = set()
+        # inside a lambda, fetched blobs are kept in /tmp so a warm container downloads each blob once.
+        self.cache_directory = cache_directory
+        if cache_directory is not None:
+            os.makedirs(cache_directory, exist_ok=True)
+
+    # created on first use, constructing a store makes no aws calls.
+    @property
+    def client(self) -> Any:
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    import boto3  # available in the lambda runtime, only imported when an s3 store is used.
+                    self._client = boto3.client("s3")
+        return self._client
+
+    def exists(self, key: str) -> bool:
+        if key in self.known_keys:
+            return True
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")
+        except self.client.exceptions.ClientError:
+            return False
+        self.known_keys.add(key)
+        return True
+
+    def write(self, key: str, data: Any) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=f"{self.prefix}{key}", Body=bytes(data))
+        self.known_keys.add(key)
+
+    # a conditional put, s3 answers 412 when the key exists and 409 when a concurrent conditional put won. Runtimes
+    # shipping a boto3 without conditional puts check for the key first.
+    def create(self, key: str, data: Any) -> bool:
+        from botocore.exceptions import ParamValidationError
+        try:
+            self.client.put_object(Bucket=self.bucket, Key=f"{self.prefix}{key}", Body=bytes(data), IfNoneMatch="*")
+        except ParamValidationError:
+            return super().create(key, data)
+        except self.client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("PreconditionFailed", "ConditionalRequestConflict"):
+                return False
+            raise
+        self.known_keys.add(key)
+        return True
+
+    def get(self, key: str) -> bytes:
+        cache_path = os.path.join(self.cache_directory, key) if self.cache_directory is not None else None
+        if cache_path is not None and os.path.exists(cache_path):
+            with open(cache_path, 'rb') as file:
+                return file.read()
+        data = self.client.get_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")["Body"].read()
+        if cache_path is not None:
+            write_file(cache_path, data)
+        return data
+
+    # s3 answers deletes of missing keys with success as well.
+    def delete(self, key: str) -> None:
+        self.client.delete_object(Bucket=self.bucket, Key=f"{self.prefix}{key}")
+        self.known_keys.discard(key)
+        if self.cache_directory is not None:
+            try:
+                os.remove(os.path.join(self.cache_directory, key))
+            except FileNotFoundError:
+                pass
+
+    def list_keys(self, prefix: str) -> List[str]:
+        keys = []
+        params = {"Bucket": self.bucket, "Prefix": f"{self.prefix}{prefix}"}
+        while True:
+            response = self.client.list_objects_v2(**params)
+            keys += [item["Key"][len(self.prefix):] for item in response.get("Contents", [])]
+            if not response.get("IsTruncated"):
+                return keys
+            params["ContinuationToken"] = response["NextContinuationToken"]
+
+    def spec(self) -> Dict[str, str]:
+        return {"type": "s3", "bucket": self.bucket, "prefix": self.prefix}
 
 
-def write_python_file_structure(path: str, file_structure: FileStructure) -> None:
-    for name, value in file_structure.items():
-        if isinstance(value, bytes):
-            write_file(os.path.join(path, name), value)
-        elif isinstance(value, Dict):
-            write_python_file_structure(os.path.join(path, name), value)
+blob_stores: Dict[Tuple[Tuple[str, str], ...], BlobStore] = {}
+
+
+def blob_store_from_spec(spec: Optional[Dict[str, str]], cache_directory: Optional[str] = None) -> Optional[BlobStore]:
+    if spec is None:
+        return None
+    key = tuple(sorted(spec.items()))
+    if key not in blob_stores:
+        if spec["type"] == "local":
+            blob_stores[key] = LocalBlobStore(spec["directory"])
+        elif spec["type"] == "s3":
+            blob_stores[key] = S3BlobStore(spec["bucket"], spec["prefix"], cache_directory)
         else:
-            raise Exception("Logic error with write_python_file_structure")
+            raise Exception(f"unknown blob store type: {spec['type']}")
+    return blob_stores[key]
+
+
+# values whose compressed size exceeds this are written to the blob store, when one is configured, and only their key
+# travels in the payload. Call arguments are offloaded on their pickled size, see encode_call.
+OFFLOAD_THRESHOLD = 1024 * 1024
+
+# a pickled value: its body and its out of band buffers.
+Pickled = Tuple[bytes, List[std_pickle.PickleBuffer]]
+
+
+def pickle_value(value: Any) -> Pickled:
+    buffers: List[std_pickle.PickleBuffer] = []
+    body = pickle.dumps(value, protocol=5, buffer_callback=buffers.append)
+    return body, buffers
+
+
+# None stands for an offloaded argument.
+def unpickle(pickled: Optional[Pickled]) -> Any:
+    return None if pickled is None else pickle.loads(pickled[0], buffers=pickled[1])
+
+
+def pickled_size(pickled: Pickled) -> int:
+    body, buffers = pickled
+    return len(body) + sum(buffer.raw().nbytes for buffer in buffers)
+
+
+def compress_pickled(pickled: Pickled, codec: str) -> Tuple[str, bytes, List[bytes]]:
+    body, buffers = pickled
+    views = [buffer.raw() for buffer in buffers]
+    codec = choose_codec(codec, pickled_size(pickled), max([body, *views], key=lambda part: memoryview(part).nbytes))
+    compress, _ = CODECS[codec]
+    with stage("compress"):
+        return codec, compress(body), [compress(view) for view in views]
+
+
+def offload(codec: str, body: bytes, views: List[bytes], blob_store: BlobStore) -> Envelope:
+    record_size("blob_put_bytes", len(body) + sum(len(view) for view in views))
+    with stage("blob_put"):
+        envelope: Envelope = {"codec": codec, "blob": blob_store.put(body)}
+        if views:
+            envelope["buffer_blobs"] = [blob_store.put(view) for view in views]
+    return envelope
+
+
+def encode(value: Any, codec: str = AUTO_CODEC, blob_store: Optional[BlobStore] = None,
+           offload_threshold: int = OFFLOAD_THRESHOLD) -> Envelope:
+    with stage("pickle"):
+        pickled = pickle_value(value)
+    codec, body, views = compress_pickled(pickled, codec)
+    if blob_store is not None and len(body) + sum(len(view) for view in views) > offload_threshold:
+        return offload(codec, body, views, blob_store)
+    envelope = {"codec": codec, "data": base64.b64encode(body).decode('ascii')}
+    if views:
+        envelope["buffers"] = [base64.b64encode(view).decode('ascii') for view in views]
+    return envelope
+
+
+def is_offloaded(envelope: Envelope) -> bool:
+    return "blob" in envelope
+
+
+def decode(envelope: Envelope, blob_store: Optional[BlobStore] = None) -> Any:
+    _, decompress = CODECS[envelope["codec"]]
+    if is_offloaded(envelope):
+        if blob_store is None:
+            raise Exception(f"payload was offloaded to blob {envelope['blob']} but no blob store is configured")
+        with stage("blob_get"):
+            body = blob_store.get(envelope["blob"])
+            buffers = [blob_store.get(key) for key in envelope.get("buffer_blobs", [])]
+        record_size("blob_get_bytes", len(body) + sum(len(buffer) for buffer in buffers))
+    else:
+        body = base64.b64decode(envelope["data"])
+        buffers = [base64.b64decode(buffer) for buffer in envelope.get("buffers", [])]
+    with stage("decompress"):
+        body = decompress(body)
+        buffers = [decompress(buffer) for buffer in buffers]
+    with stage("unpickle"):
+        return pickle.loads(body, buffers=buffers)
+
+
+# Arguments are pickled one by one so a large value shared by many calls is uploaded once and deduplicated, while the
+# small arguments next to it stay inline. Each argument is pickled once: arguments whose pickle exceeds the offload
+# threshold are compressed and offloaded on their own, the pickles of the others are embedded in the call, which is
+# compressed as a whole. Offloaded arguments are left as None in the call and listed in the returned mapping, keyed by
+# position for args and by name for kwargs.
+OffloadedArguments = Dict[str, Dict[str, Envelope]]
+
 
+def encode_call(args: Tuple, kwargs: Dict[str, Any], codec: str = AUTO_CODEC, blob_store: Optional[BlobStore] = None,
+                offload_threshold: int = OFFLOAD_THRESHOLD) -> Tuple[Envelope, OffloadedArguments]:
+    offloaded: OffloadedArguments = {"args": {}, "kwargs": {}}
+    with stage("pickle"):
+        pickled_args = [pickle_value(value) for value in args]
+        pickled_kwargs = {name: pickle_value(value) for name, value in kwargs.items()}
+    if blob_store is not None:
+        for group, values in (("args", enumerate(pickled_args)), ("kwargs", pickled_kwargs.items())):
+            for name, pickled in values:
+                if pickled_size(pickled) > offload_threshold:
+                    offloaded[group][str(name)] = offload(*compress_pickled(pickled, codec), blob_store)
+        for index in offloaded["args"]:
+            pickled_args[int(index)] = None
+        for name in offloaded["kwargs"]:
+            pickled_kwargs[name] = None
+    return encode((pickled_args, pickled_kwargs), codec), offloaded
 
-def function(data: bytes) -> Dict[str, bytes]:
-    project_files, context, func_name, args, kwargs = pickle.loads(
-        lzma.decompress(base64.b85decode(data)))
-    write_python_file_structure(os.getcwd(), project_files)
+
+# offloaded arguments are only fetched once the function is about to be called, and each blob is fetched once per
+# container when the store caches to /tmp.
+def decode_call(envelope: Envelope, offloaded: OffloadedArguments,
+                blob_store: Optional[BlobStore] = None) -> Tuple[Tuple, Dict[str, Any]]:
+    pickled_args, pickled_kwargs = decode(envelope)
+    with stage("unpickle"):
+        args = [unpickle(pickled) for pickled in pickled_args]
+        kwargs = {name: unpickle(pickled) for name, pickled in pickled_kwargs.items()}
+    for index, argument in offloaded["args"].items():
+        args[int(index)] = decode(argument, blob_store)
+    for name, argument in offloaded["kwargs"].items():
+        kwargs[name] = decode(argument, blob_store)
+    return tuple(args), kwargs
+
+
+def write_project_files(path: str, files: Dict[str, bytes]) -> None:
+    for relative_path, content in files.items():
+        full_path = os.path.join(path, relative_path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        write_file(full_path, content)
+
+
+# unchanged files are hard linked from the base tree, so building a new tree only writes the files that changed.
+def link_project_tree(source: str, destination: str, skip: Set[str], relative: str = "") -> None:
+    os.makedirs(destination, exist_ok=True)
+    with os.scandir(source) as entries:
+        for entry in entries:
+            relative_path = f"{relative}{entry.name}"
+            target = os.path.join(destination, entry.name)
+            if entry.is_dir():
+                link_project_tree(entry.path, target, skip, f"{relative_path}/")
+            elif entry.name != COMPLETE_MARKER and relative_path not in skip:
+                try:
+                    os.link(entry.path, target)
+                except OSError:
+                    shutil.copy2(entry.path, target)
+
+
+# project trees are kept in /tmp keyed by digest so a warm container only receives the files that changed.
+PROJECTS_DIR = "projects"
+COMPLETE_MARKER = ".complete"
+MAX_PROJECT_TREES = 8
+
+
+def is_project_tree_complete(tree: str) -> bool:
+    return os.path.exists(os.path.join(tree, COMPLETE_MARKER))
+
+
+def evict_project_trees(projects_dir: str, keep: str) -> None:
+    trees = [os.path.join(projects_dir, name) for name in os.listdir(projects_dir)]
+    trees = [tree for tree in trees if is_project_tree_complete(tree) and tree != keep]
+    trees.sort(key=lambda tree: os.path.getmtime(os.path.join(tree, COMPLETE_MARKER)))
+    for tree in trees[:max(0, len(trees) - (MAX_PROJECT_TREES - 1))]:
+        shutil.rmtree(tree, ignore_errors=True)
+
+
+# returns the directory holding the project with the requested digest or None when the delta was computed against a
+# base this container does not have, in which case the client resends the full tree.
+def materialize_project(root: str, project: Dict) -> Optional[str]:
+    projects_dir = os.path.join(root, PROJECTS_DIR)
+    tree = os.path.join(projects_dir, project["digest"])
+    if is_project_tree_complete(tree):
+        os.utime(os.path.join(tree, COMPLETE_MARKER))
+        return tree
+    base = project["base"]
+    if base is not None and not is_project_tree_complete(os.path.join(projects_dir, base)):
+        return None
+    staging = f"{tree}.{os.getpid()}.{time.monotonic_ns()}"
+    if base is not None:
+        link_project_tree(os.path.join(projects_dir, base), staging, set(project["files"]) | set(project["deleted"]))
+    os.makedirs(staging, exist_ok=True)
+    write_project_files(staging, project["files"])
+    write_file(os.path.join(staging, COMPLETE_MARKER), b"")
+    try:
+        os.rename(staging, tree)
+    except OSError:  # another invocation finished the same tree first.
+        shutil.rmtree(staging, ignore_errors=True)
+    evict_project_trees(projects_dir, tree)
+    return tree
+
+
+active_project_dir: Optional[str] = None
+
+
+# puts a project tree on sys.path exactly once, and forgets modules imported from the previously active tree so
+# they are re-imported from the new one.
+def activate_project(tree: str) -> None:
+    global active_project_dir
+    os.chdir(tree)
+    if active_project_dir == tree:
+        return
+    if active_project_dir is not None:
+        if active_project_dir in sys.path:
+            sys.path.remove(active_project_dir)
+        stale_modules = [name for name, module in sys.modules.items()
+                         if (getattr(module, "__file__", None) or "").startswith(active_project_dir + os.sep)]
+        for name in stale_modules:
+            del sys.modules[name]
+    sys.path.append(tree)
+    active_project_dir = tree
+
+
+# Function contexts. The file defining a called function is shipped as a marshalled code object when the client runs
+# the same python version as the lambda, and as source otherwise. Marshalled code is only readable by the interpreter
+# version that produced it, so it is tagged with the importlib magic number: a container that cannot load it answers
+# with unsupported_context and the client falls back to sending source.
+CONTEXT_MAGIC = importlib.util.MAGIC_NUMBER.hex()
+
+
+def make_context(source: str, filename: str, compiled: bool) -> Dict[str, Any]:
+    # filename is the path relative to the project root, tracebacks point at the real file.
+    if compiled:
+        code = compile(source, filename, "exec", dont_inherit=True)
+        return {"filename": filename, "magic": CONTEXT_MAGIC, "python": platform.python_version(),
+                "code": marshal.dumps(code)}
+    return {"filename": filename, "source": source}
+
+
+def is_context_supported(context: Dict[str, Any]) -> bool:
+    return "code" not in context or context["magic"] == CONTEXT_MAGIC
+
+
+def load_context(context: Dict[str, Any]) -> CodeType:
+    if "code" in context:
+        return marshal.loads(context["code"])
+    return compile(context["source"], context["filename"], "exec", dont_inherit=True)
+
+
+class ExecutionContext(NamedTuple):
+    code: CodeType
+    namespace: Dict[str, Any]
+    func: Callable
+
+
+# warm containers keep the compiled and executed context of recently called functions so repeat calls go straight from
+# unpickling the arguments to calling the function. Keyed by (project digest, context digest, function name), bounded
+# so that several projects sharing one lambda function cannot grow it without limit. Code objects are cached on their
+# own by context digest, a file shared by several projects or functions is only loaded once.
+MAX_CACHED_EXECUTION_CONTEXTS = 32
+execution_cache: "OrderedDict[Tuple[str, str, str], ExecutionContext]" = OrderedDict()
+MAX_CACHED_CODE_OBJECTS = 64
+code_cache: "OrderedDict[str, CodeType]" = OrderedDict()
+
+
+def get_code(context_digest: str, context_envelope: Envelope) -> Optional[CodeType]:
+    if context_digest in code_cache:
+        code_cache.move_to_end(context_digest)
+        return code_cache[context_digest]
+    context = decode(context_envelope)
+    if not is_context_supported(context):
+        return None
+    code = load_context(context)
+    code_cache[context_digest] = code
+    while len(code_cache) > MAX_CACHED_CODE_OBJECTS:
+        code_cache.popitem(last=False)
+    return code
+
+
+# returns None when the context is compiled for a python version this container cannot load.
+def get_execution_context(key: Tuple[str, str, str], context_envelope: Envelope) -> Optional[ExecutionContext]:
+    if key in execution_cache:
+        execution_cache.move_to_end(key)
+        return execution_cache[key]
+    _, context_digest, func_name = key
+    code = get_code(context_digest, context_envelope)
+    if code is None:
+        return None
     locals_copy = {"__name__": "LambdaExecutor"}
 
-    # ast of a file relevant to the function being called is compiled and executed so that
+    # the code of a file relevant to the function being called is executed so that
     # this changes the state of the program so it's in the right context such that I can grab the function.
-    code = compile(context, filename="", mode="exec")
     exec(code, locals_copy, locals_copy)
-    locals().update(locals_copy)
-    func = locals()[func_name]
+    execution_context = ExecutionContext(code, locals_copy, locals_copy[func_name])
+    execution_cache[key] = execution_context
+    while len(execution_cache) > MAX_CACHED_EXECUTION_CONTEXTS:
+        execution_cache.popitem(last=False)
+    return execution_context
+
+
+# State of the invocation this container is handling. Decorated functions making nested calls read it through
+# current_invocation to decide whether a nested call is shipped to another lambda or run in process (ExecutionPolicy).
+class InvocationState:
+    def __init__(self, depth: int, context: Any, trace: Optional[Dict[str, str]] = None,
+                 idempotency_key: Optional[str] = None):
+        # number of lambda hops from the local driver, the first lambda runs at depth 1.
+        self.depth = depth
+        self.context = context
+        # shared by every invocation running the same call: retries, hedged duplicates, redelivered jobs.
+        self.idempotency_key = idempotency_key
+        self.remote_calls = 0
+        # {"trace_id", "span_id"} of the handler span when the caller traces, nested calls become its children and
+        # their spans are collected in spans to be returned with the response.
+        self.trace = trace
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def add_span(self, span: Dict[str, Any]) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def remaining_ms(self) -> Optional[int]:
+        get_remaining_time = getattr(self.context, "get_remaining_time_in_millis", None)
+        return get_remaining_time() if get_remaining_time is not None else None
+
+    # counts a nested remote call against a budget, returns False once the budget is spent.
+    def take_remote_call(self, budget: Optional[int]) -> bool:
+        with self._lock:
+            if budget is not None and self.remote_calls >= budget:
+                return False
+            self.remote_calls += 1
+            return True
+
+
+current_invocation: Optional[InvocationState] = None
 
+
+# generator functions return their generator, it is drained by stream_results.
+def call_function(func: Callable, args: Tuple, kwargs: Dict[str, Any]) -> Any:
     if inspect.iscoroutinefunction(func):
-        data = asyncio.run(func(*args, force_local=True, **kwargs))
+        return asyncio.run(func(*args, force_local=True, **kwargs))
+    return func(*args, force_local=True, **kwargs)
+
+
+# a chunk of a map is run in one invocation, coroutine functions run concurrently on one event loop.
+def call_function_batch(func: Callable, calls: List[Tuple[Tuple, Dict[str, Any]]]) -> List[Any]:
+    if inspect.iscoroutinefunction(func):
+        async def gather_calls() -> List[Any]:
+            return list(await asyncio.gather(*[func(*args, force_local=True, **kwargs) for args, kwargs in calls]))
+
+        return asyncio.run(gather_calls())
+    return [func(*args, force_local=True, **kwargs) for args, kwargs in calls]
+
+
+# Items yielded by a generator function are written to the stream's store in chunks as they are produced, so the
+# caller can consume them before the function returns. A chunk is flushed once it holds STREAM_CHUNK_ITEMS items or its
+# first item is STREAM_FLUSH_SECONDS old. The caller writes the number of chunks it consumed to the ack key, and the
+# writer stays at most STREAM_MAX_AHEAD chunks ahead of it: the generator is not resumed until the caller catches up,
+# which bounds what is held in the store and in memory. An ack of "closed" means the caller stopped reading, the
+# generator is closed.
+# event["stream"]: {"store": spec, "prefix": key prefix, chunk i is "{prefix}-{i}", the ack key is "{prefix}-ack"}
+STREAM_CHUNK_ITEMS = 64
+STREAM_FLUSH_SECONDS = 0.25
+STREAM_MAX_AHEAD = 16
+STREAM_CLOSED = "closed"
+
+
+class StreamWriter:
+    def __init__(self, spec: Dict[str, Any], root: str, codec: str, blob_store: Optional[BlobStore],
+                 offload_threshold: int):
+        self.store = blob_store_from_spec(spec["store"], os.path.join(root, "blobs"))
+        self.prefix = spec["prefix"]
+        self.codec = codec
+        self.blob_store = blob_store
+        self.offload_threshold = offload_threshold
+        self.items: List[Any] = []
+        self.chunk_start = 0.0
+        self.chunks = 0
+        self.is_closed = False
+
+    def _acked(self) -> Optional[int]:
+        key = f"{self.prefix}-ack"
+        if not self.store.exists(key):
+            return 0
+        ack = self.store.get(key).decode()
+        return None if ack == STREAM_CLOSED else int(ack)
+
+    # returns False once the caller stopped reading.
+    def add(self, item: Any) -> bool:
+        if not self.items:
+            self.chunk_start = time.monotonic()
+        self.items.append(item)
+        if len(self.items) >= STREAM_CHUNK_ITEMS or time.monotonic() - self.chunk_start >= STREAM_FLUSH_SECONDS:
+            return self.flush()
+        return not self.is_closed
+
+    def flush(self) -> bool:
+        delay = 0.02
+        while True:
+            acked = self._acked()
+            if acked is None:
+                self.is_closed = True
+                return False
+            if self.chunks - acked < STREAM_MAX_AHEAD:
+                break
+            time.sleep(delay)
+            delay = min(1.0, delay * 2)
+        if self.items:
+            envelope = encode(self.items, self.codec, self.blob_store, self.offload_threshold)
+            self.store.write(f"{self.prefix}-{self.chunks}", json.dumps(envelope).encode())
+            self.chunks += 1
+            self.items = []
+        return True
+
+
+# items yielded before the generator raised are flushed before the exception propagates.
+def stream_results(values: Any, writer: StreamWriter) -> int:
+    try:
+        if inspect.isasyncgen(values):
+            async def drain() -> None:
+                async for item in values:
+                    # store requests block, the generator's other tasks keep running meanwhile.
+                    if not await asyncio.get_running_loop().run_in_executor(None, writer.add, item):
+                        await values.aclose()
+                        return
+
+            asyncio.run(drain())
+        else:
+            for item in values:
+                if not writer.add(item):
+                    values.close()
+                    break
+    finally:
+        if not writer.is_closed:
+            writer.flush()
+    return writer.chunks
+
+
+# event: {"project": envelope, "function": [context digest, name], "context": envelope, "call": envelope,
+#         "offloaded": offloaded arguments, "response_codec": codec id, "blob_store": spec, "offload_threshold": int,
+#         "depth": int, "trace": {"trace_id", "parent_id"} when the caller traces, "stream": see StreamWriter,
+#         "usage": true to be answered with the invocation's duration and memory size,
+#         "idempotency_key": shared by the retries and duplicates of a call, see InvocationState}
+# a batched map sends "calls": envelope of [(args, kwargs), ...] instead of call and is answered with "results".
+# the project is decoded and activated before the call so arguments referencing project modules can be unpickled.
+def function(event: Dict[str, Any], root: str) -> Dict[str, Any]:
+    blob_store = blob_store_from_spec(event.get("blob_store"), os.path.join(root, "blobs"))
+    with stage("decode_project"):
+        project = decode(event["project"], blob_store)
+    record_size("project_files", len(project["files"]))
+    with stage("materialize_project"):
+        project_dir = materialize_project(root, project)
+    if project_dir is None:
+        return {"missing_project": project["digest"]}
+    activate_project(project_dir)
+    context_digest, func_name = event["function"]
+    with stage("load_context"):
+        execution_context = get_execution_context((project["digest"], context_digest, func_name), event["context"])
+    if execution_context is None:
+        return {"unsupported_context": CONTEXT_MAGIC}
+    func = execution_context.func
+    response_codec = event.get("response_codec", AUTO_CODEC)
+    offload_threshold = event.get("offload_threshold", OFFLOAD_THRESHOLD)
+
+    if "calls" in event:
+        with stage("decode_args"):
+            calls = decode(event["calls"], blob_store)
+        with stage("call"):
+            results = call_function_batch(func, calls)
+        with stage("encode_result"):
+            return {"results": encode(results, response_codec, blob_store, offload_threshold),
+                    "project": project["digest"], "calls": len(calls)}
+    with stage("decode_args"):
+        args, kwargs = decode_call(event["call"], event.get("offloaded", {"args": {}, "kwargs": {}}), blob_store)
+    if "stream" in event:
+        writer = StreamWriter(event["stream"], root, response_codec, blob_store, offload_threshold)
+        with stage("call"):
+            chunks = stream_results(call_function(func, args, kwargs), writer)
+        return {"stream": chunks, "project": project["digest"]}
+    with stage("call"):
+        data = call_function(func, args, kwargs)
+    with stage("encode_result"):
+        return {"result": encode(data, response_codec, blob_store, offload_threshold), "project": project["digest"]}
+
+
+# an exception the way lambda reports an unhandled one.
+def encode_exception(error: Exception) -> Dict[str, Any]:
+    return {"errorMessage": str(error), "errorType": type(error).__name__,
+            "stackTrace": traceback.format_tb(error.__traceback__)}
+
+
+# contents of a job's start key, written once by whichever of the lambda starting the job and the caller cancelling it
+# comes first.
+JOB_STARTED = b"started"
+JOB_CANCELLED = b"cancelled"
+
+
+# A job submitted with an asynchronous invocation: nobody waits for the response, it is written to the job's result key
+# in the job's store instead, exceptions included. The start key is created before the job runs, a job the caller
+# cancelled first is not run, and once it is created the job can no longer be cancelled, see Job.cancel. Requests too
+# large for an asynchronous invocation are read from the store. Lambda may deliver an asynchronous event more than
+# once, a job whose result exists is not run again and only the first result written is kept.
+# event["job"]: {"store": spec, "result": key, "start": key, "request": key of the request when stored}
+def run_job(event: Dict[str, Any], root: str) -> None:
+    job = event["job"]
+    store = blob_store_from_spec(job["store"], os.path.join(root, "blobs"))
+    if store.exists(job["result"]):
+        return
+    # a redelivery of a job that started and did not finish (a timeout, a crashed runtime) runs it again.
+    if not store.create(job["start"], JOB_STARTED) and store.get(job["start"]) == JOB_CANCELLED:
+        response = {"cancelled": True}
     else:
-        data = func(*args, force_local=True, **kwargs)
-    return {"data": base64.b85encode(lzma.compress(pickle.dumps(data)))}
+        if "request" in job:
+            event = {**json.loads(store.get(job["request"])), "job": job}
+        try:
+            response = function(event, root)
+        except Exception as e:
+            response = {"error": encode_exception(e)}
+    store.create(job["result"], json.dumps(response).encode())
+
+
+def new_span_id() -> str:
+    return uuid.uuid4().hex[:16]
+
 
+# a container is cold for the first invocation after the handler module was imported.
+CONTAINER_ID = new_span_id()
+is_cold_container = True
 
-# /tmp dir can be written to, I change context to this dir, and have python search in this directory for imports.
+
+# memory size of the function running the handler, None outside a lambda.
+def get_memory_size() -> Optional[int]:
+    memory_size = os.environ.get("AWS_LAMBDA_FUNCTION_MEMORY_SIZE")
+    return int(memory_size) if memory_size is not None else None
+
+
+# /tmp dir can be written to, project trees are unpacked below it and the active one is put on the import path.
+# /tmp survives between invocations of a warm container, so it is no longer wiped on every call.
+# When the caller traces, the handler's stage timings, whether the container was cold and the spans of nested calls
+# are returned under "trace".
 def lambda_handler(event, context, dir: str = "/tmp"):
-    delete_all_in_directory(dir)
-    os.chdir(dir)
-    sys.path.append(os.getcwd())
-    return function(event["data"])
+    global current_invocation, is_cold_container
+    is_cold, is_cold_container = is_cold_container, False
+    # restored afterwards, when the handler runs in process (tests) the calling invocation may be the handler too.
+    previous_invocation = current_invocation
+    caller_trace = event.get("trace")
+    trace = {"trace_id": caller_trace["trace_id"], "span_id": new_span_id()} if caller_trace is not None else None
+    current_invocation = InvocationState(event.get("depth", 1), context, trace, event.get("idempotency_key"))
+    timer = StageTimer() if trace is not None else None
+    start_time, start = time.time(), time.perf_counter()
+    try:
+        if "job" in event:
+            run_job(event, os.path.abspath(dir))
+            return {"job": event["job"]["result"]}
+        with activate_timer(timer):
+            response = function(event, os.path.abspath(dir))
+        duration_ms = (time.perf_counter() - start) * 1000
+        calls = response.pop("calls", 1)
+        memory_size = get_memory_size()
+        # what the invocation was billed for, reported to callers that tune memory sizes, see MemoryTuner.
+        if event.get("usage"):
+            response["usage"] = {"duration_ms": duration_ms, "memory_size": memory_size, "calls": calls}
+        if trace is not None:
+            response["trace"] = {
+                **trace, "parent_id": caller_trace["parent_id"], "name": event["function"][1], "kind": "handler",
+                "start": start_time, "duration_ms": duration_ms, "cold": is_cold, "container": CONTAINER_ID,
+                "depth": current_invocation.depth, "memory_size": memory_size, "calls": calls, "stages": timer.stages,
+                "sizes": timer.sizes, "spans": current_invocation.spans,
+            }
+            # the first invocation of a container reports what the init phase did before it, see preload.
+            if is_cold:
+                response["trace"]["init_stages"] = init_stages
+        return response
+    finally:
+        current_invocation = previous_invocation
+
+
+# Init phase preloading. A deployment may bake a preload file next to this module, see LambdaBuilder.handler_files:
+#   {"modules": [module names], "project": envelope of a project tree,
+#    "functions": [{"function": [context digest, name], "context": envelope}]}
+# Lambda runs module level code in the init phase, with boosted cpu, before the first invocation of a container. The
+# modules are imported then, the project tree is unpacked and the contexts of the functions are executed in it so their
+# imports run as well. Every preloaded function shares that one tree, calls ship its files too, and the first
+# invocation of each finds its imports in sys.modules and its context in the execution cache. A preload that
+# fails only costs the time it took, invocations do the work again. Stage timings are kept in init_stages.
+PRELOAD_FILE = "bauplan_preload.json"
+init_stages: Dict[str, float] = {}
+
+
+def preload(root: str) -> None:
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), PRELOAD_FILE)
+    if not os.path.exists(path):
+        return
+    timer = StageTimer()
+    with activate_timer(timer):
+        with open(path) as file:
+            spec = json.load(file)
+        digest = None
+        if "project" in spec:
+            with stage("init_project"):
+                try:
+                    project = decode(spec["project"])
+                    activate_project(materialize_project(root, project))
+                    digest = project["digest"]
+                except Exception as e:
+                    print(f"preloading the project failed: {type(e).__name__}: {e}")
+                    spec["functions"] = []
+        with stage("init_imports"):
+            for module in spec["modules"]:
+                try:
+                    importlib.import_module(module)
+                except Exception as e:
+                    print(f"preloading {module} failed: {type(e).__name__}: {e}")
+        with stage("init_contexts"):
+            for function in spec.get("functions", []):
+                try:
+                    get_execution_context((digest, *function["function"]), function["context"])
+                except Exception as e:
+                    print(f"preloading {function['function'][1]} failed: {type(e).__name__}: {e}")
+    init_stages.update(timer.stages)
+
+
+# TMPDIR is set when the handler runs in a local container, it is the dir the container passes to lambda_handler.
+preload(os.environ.get("TMPDIR", "/tmp"))
 
 # below is for debug purposes. This file is executed on a lambda, I can simulate the execution locally by grabbing
 # the serialized data and pasting it below to test you must uncomment the below find the is_in_aws() function and
 # run it. you can find the serialized data by setting break points on the request object before invocation. copy and
-# paste it here.
+# paste the json payload here.
 
 # if __name__ == "__main__":
-#   event = { "data": <placed serialized_data here> }
+#   event = <placed json payload here>
 #   os.mkdir(".scratch")
 #   print(lambda_handler(event, {}, ".scratch"))
@@ -0,0 +1,406 @@
+import copy
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+from botocore.exceptions import ClientError
+
+from src.bauplan.deploy import LIVE_ALIAS, code_sha256
+
+# runs inside a container process: the handler package and layers are put on the import path the way lambda lays them
+# out (/var/task and /opt/python), then invocations are read from stdin and answered on the original stdout, one json
+# document per line. Anything the handler prints goes to stderr. Handlers taking a dir argument, like lambda_function's,
+# are given the container's own tmp directory instead of the /tmp every container on the machine shares.
+CONTAINER_BOOTSTRAP = """
+import importlib, inspect, json, os, sys, time, traceback
+task_dir, layer_dir, tmp_dir, handler = sys.argv[1:5]
+sys.path[:0] = [task_dir, os.path.join(layer_dir, "python")]
+protocol = os.fdopen(os.dup(1), "w")
+os.dup2(2, 1)
+module_name, function_name = handler.rsplit(".", 1)
+handler = getattr(importlib.import_module(module_name), function_name)
+handler_kwargs = {"dir": tmp_dir} if "dir" in inspect.signature(handler).parameters else {}
+
+class Context:
+    def __init__(self, deadline, arn, version):
+        self.deadline = deadline
+        self.invoked_function_arn = arn
+        self.function_version = version
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self.deadline - time.time()) * 1000))
+
+for line in sys.stdin:
+    request = json.loads(line)
+    context = Context(request["deadline"], request["arn"], os.environ.get("AWS_LAMBDA_FUNCTION_VERSION", "$LATEST"))
+    try:
+        response = {"payload": handler(request["event"], context, **handler_kwargs)}
+    except Exception as e:
+        response = {"error": {"errorMessage": str(e), "errorType": type(e).__name__,
+                              "stackTrace": traceback.format_tb(e.__traceback__)}}
+    protocol.write(json.dumps(response) + "\\n")
+    protocol.flush()
+"""
+
+
+def not_found(operation: str, message: str) -> ClientError:
+    return ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": message}}, operation)
+
+
+def throttled(message: str) -> ClientError:
+    return ClientError({"Error": {"Code": "TooManyRequestsException", "Message": message}}, "Invoke")
+
+
+def extract(data: bytes, directory: str) -> None:
+    with zipfile.ZipFile(io.BytesIO(data)) as archive:
+        archive.extractall(directory)
+
+
+class LocalWaiter:
+    def wait(self, **params) -> None:
+        # every operation of the local api completes before it returns.
+        pass
+
+
+# one warm container: a python process with its own copy of the version's code and its own tmp directory, running in
+# its task directory like lambda runs in /var/task, handling one invocation at a time.
+class LocalContainer:
+    def __init__(self, directory: str, handler: str, environment: Dict[str, str]):
+        tmp_dir = os.path.join(directory, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        self.process = subprocess.Popen(
+            [sys.executable, "-c", CONTAINER_BOOTSTRAP, os.path.join(directory, "task"), os.path.join(directory, "opt"),
+             tmp_dir, handler],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, cwd=os.path.join(directory, "task"),
+            env={**os.environ, "TMPDIR": tmp_dir, **environment}, text=True)
+        self.last_used = time.monotonic()
+
+    def invoke(self, event: Any, deadline: float, arn: str) -> Dict[str, Any]:
+        self.process.stdin.write(json.dumps({"event": event, "deadline": deadline, "arn": arn}) + "\n")
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        self.last_used = time.monotonic()
+        if not line:
+            raise Exception(f"local lambda container exited with code {self.process.wait()}")
+        return json.loads(line)
+
+    def stop(self) -> None:
+        self.process.stdin.close()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+# Stand-in for the parts of the boto3 lambda client used to deploy and invoke functions: functions, published
+# versions, aliases and layers are kept in memory and invocations run the deployed handler in local container
+# processes, kept warm per version like lambda does. Errors are raised as the same ClientErrors boto3 raises, so
+# Deployer and InvocationEngine run unchanged against it. Only inline zip files are supported as code.
+# Containers idle for longer than idle_timeout seconds are stopped, the next invocation starts a new one and pays
+# cold_start_delay seconds on top of starting the process, standing in for lambda's init. Invocations beyond
+# max_concurrency running at once are throttled with the error lambda returns when a function's concurrency is used up.
+# Event invocations are queued and run in the background, throttled ones are retried like lambda retries them.
+class LocalLambdaClient:
+    def __init__(self, root: str, region: str = "local", account: str = "000000000000",
+                 max_concurrency: Optional[int] = None, idle_timeout: Optional[float] = None,
+                 cold_start_delay: float = 0.0):
+        self.root = os.path.abspath(root)
+        self.arn_prefix = f"arn:aws:lambda:{region}:{account}"
+        self.max_concurrency = max_concurrency
+        self.idle_timeout = idle_timeout
+        self.cold_start_delay = cold_start_delay
+        self.functions: Dict[str, Dict[str, Any]] = {}
+        self.layers: Dict[str, List[Dict[str, Any]]] = {}
+        self.idle_containers: Dict[str, List[LocalContainer]] = {}
+        self.invocations: Dict[str, int] = {}
+        self.cold_starts = 0
+        self.running = 0
+        self.throttles = 0
+        # payload bytes sent to and received from containers, as they would travel over the wire.
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self._events: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.RLock()
+
+    def get_waiter(self, name: str) -> LocalWaiter:
+        return LocalWaiter()
+
+    # layers
+
+    def publish_layer_version(self, LayerName: str, Content: Dict[str, Any], CompatibleRuntimes: List[str] = (),
+                              Description: str = "", **params) -> Dict[str, Any]:
+        with self._lock:
+            versions = self.layers.setdefault(LayerName, [])
+            version = len(versions) + 1
+            layer = {"LayerVersionArn": f"{self.arn_prefix}:layer:{LayerName}:{version}", "Version": version,
+                     "Description": Description, "CompatibleRuntimes": list(CompatibleRuntimes),
+                     "Content": {"CodeSha256": code_sha256(self._zip_file(Content))}, "data": self._zip_file(Content)}
+            versions.append(layer)
+            return self._public(layer)
+
+    def list_layer_versions(self, LayerName: str, CompatibleRuntime: Optional[str] = None,
+                            **params) -> Dict[str, Any]:
+        with self._lock:
+            return {"LayerVersions": [self._public(layer) for layer in self.layers.get(LayerName, [])
+                                      if CompatibleRuntime is None or CompatibleRuntime in layer["CompatibleRuntimes"]]}
+
+    def _layer_data(self, arn: str) -> bytes:
+        name, version = arn[len(f"{self.arn_prefix}:layer:"):].rsplit(":", 1)
+        versions = self.layers.get(name, [])
+        if not 0 < int(version) <= len(versions):
+            raise not_found("GetLayerVersion", f"layer version {arn} does not exist")
+        return versions[int(version) - 1]["data"]
+
+    # functions
+
+    def create_function(self, FunctionName: str, Runtime: str, Role: str, Handler: str, Code: Dict[str, Any],
+                        Description: str = "", Timeout: int = 3, MemorySize: int = 128, Layers: List[str] = (),
+                        Publish: bool = False, **params) -> Dict[str, Any]:
+        with self._lock:
+            if FunctionName in self.functions:
+                raise ClientError({"Error": {"Code": "ResourceConflictException",
+                                             "Message": f"function already exist: {FunctionName}"}}, "CreateFunction")
+            for layer in Layers:
+                self._layer_data(layer)
+            data = self._zip_file(Code)
+            latest = {"FunctionName": FunctionName, "FunctionArn": f"{self.arn_prefix}:function:{FunctionName}",
+                      "Runtime": Runtime, "Role": Role, "Handler": Handler, "Description": Description,
+                      "Timeout": Timeout, "MemorySize": MemorySize, "Layers": [{"Arn": arn} for arn in Layers],
+                      "CodeSha256": code_sha256(data), "Version": "$LATEST", "State": "Active", "data": data}
+            self.functions[FunctionName] = {"versions": {"$LATEST": latest}, "aliases": {}, "next_version": 1}
+            if Publish:
+                return self.publish_version(FunctionName)
+            return self._public(latest)
+
+    def get_function(self, FunctionName: str, Qualifier: Optional[str] = None) -> Dict[str, Any]:
+        with self._lock:
+            return {"Configuration": self._public(self._resolve(FunctionName, Qualifier, "GetFunction"))}
+
+    def list_functions(self, **params) -> Dict[str, Any]:
+        with self._lock:
+            return {"Functions": [self._public(function["versions"]["$LATEST"])
+                                  for function in self.functions.values()]}
+
+    def update_function_code(self, FunctionName: str, ZipFile: Optional[bytes] = None, Publish: bool = False,
+                             **params) -> Dict[str, Any]:
+        with self._lock:
+            latest = self._resolve(FunctionName, None, "UpdateFunctionCode")
+            data = self._zip_file({"ZipFile": ZipFile, **params})
+            latest.update({"data": data, "CodeSha256": code_sha256(data)})
+            if Publish:
+                return self.publish_version(FunctionName)
+            return self._public(latest)
+
+    def update_function_configuration(self, FunctionName: str, Layers: Optional[List[str]] = None,
+                                      **changes) -> Dict[str, Any]:
+        with self._lock:
+            latest = self._resolve(FunctionName, None, "UpdateFunctionConfiguration")
+            if Layers is not None:
+                for layer in Layers:
+                    self._layer_data(layer)
+                latest["Layers"] = [{"Arn": arn} for arn in Layers]
+            latest.update(changes)
+            return self._public(latest)
+
+    def publish_version(self, FunctionName: str, **params) -> Dict[str, Any]:
+        with self._lock:
+            function = self._function(FunctionName, "PublishVersion")
+            version = str(function["next_version"])
+            function["next_version"] += 1
+            function["versions"][version] = {**copy.deepcopy(function["versions"]["$LATEST"]), "Version": version,
+                                             "FunctionArn": f"{self.arn_prefix}:function:{FunctionName}:{version}"}
+            return self._public(function["versions"][version])
+
+    def list_versions_by_function(self, FunctionName: str, **params) -> Dict[str, Any]:
+        with self._lock:
+            function = self._function(FunctionName, "ListVersionsByFunction")
+            return {"Versions": [self._public(version) for version in function["versions"].values()]}
+
+    def delete_function(self, FunctionName: str, Qualifier: Optional[str] = None) -> None:
+        with self._lock:
+            function = self._function(FunctionName, "DeleteFunction")
+            if Qualifier is None:
+                del self.functions[FunctionName]
+                return
+            if Qualifier in {alias for alias in function["aliases"].values()}:
+                raise ClientError({"Error": {"Code": "ResourceConflictException",
+                                             "Message": f"version {Qualifier} is used by an alias"}}, "DeleteFunction")
+            self._resolve(FunctionName, Qualifier, "DeleteFunction")
+            del function["versions"][Qualifier]
+
+    # aliases
+
+    def create_alias(self, FunctionName: str, Name: str, FunctionVersion: str, **params) -> Dict[str, Any]:
+        with self._lock:
+            function = self._function(FunctionName, "CreateAlias")
+            self._resolve(FunctionName, FunctionVersion, "CreateAlias")
+            function["aliases"][Name] = FunctionVersion
+            return {"Name": Name, "FunctionVersion": FunctionVersion}
+
+    def update_alias(self, FunctionName: str, Name: str, FunctionVersion: str, **params) -> Dict[str, Any]:
+        with self._lock:
+            self.get_alias(FunctionName, Name)
+            return self.create_alias(FunctionName, Name, FunctionVersion)
+
+    def get_alias(self, FunctionName: str, Name: str) -> Dict[str, Any]:
+        with self._lock:
+            function = self._function(FunctionName, "GetAlias")
+            if Name not in function["aliases"]:
+                raise not_found("GetAlias", f"alias {FunctionName}:{Name} does not exist")
+            return {"Name": Name, "FunctionVersion": function["aliases"][Name]}
+
+    # invocations
+
+    def invoke(self, FunctionName: str, Payload: bytes, InvocationType: str = "RequestResponse",
+               Qualifier: Optional[str] = None, **params) -> Dict[str, Any]:
+        if InvocationType == "Event":
+            with self._lock:
+                self._resolve(FunctionName, Qualifier, "Invoke")
+                if self._events is None:
+                    self._events = ThreadPoolExecutor(max_workers=self.max_concurrency or 32,
+                                                      thread_name_prefix="local-lambda-events")
+                self._events.submit(self._run_event, FunctionName, Payload, Qualifier)
+            return {"StatusCode": 202, "Payload": io.BytesIO(b"")}
+        if InvocationType != "RequestResponse":
+            raise Exception(f"local lambda does not support invocation type {InvocationType}")
+        with self._lock:
+            configuration = self._resolve(FunctionName, Qualifier, "Invoke")
+            if self.max_concurrency is not None and self.running >= self.max_concurrency:
+                self.throttles += 1
+                raise throttled("Rate Exceeded.")
+            self.running += 1
+            version = configuration["Version"]
+            key = f"{FunctionName}:{version}"
+            self.invocations[key] = self.invocations.get(key, 0) + 1
+            self.bytes_sent += len(Payload)
+            expired_containers = []
+            idle_containers = self.idle_containers.setdefault(key, [])
+            container = idle_containers.pop() if idle_containers else None
+            while container is not None and self.idle_timeout is not None \
+                    and time.monotonic() - container.last_used > self.idle_timeout:
+                expired_containers.append(container)
+                container = idle_containers.pop() if idle_containers else None
+        try:
+            for expired_container in expired_containers:
+                expired_container.stop()
+            if container is None:
+                container = self._start_container(configuration)
+            response = container.invoke(json.loads(Payload), time.time() + configuration["Timeout"],
+                                        configuration["FunctionArn"])
+        finally:
+            with self._lock:
+                self.running -= 1
+        with self._lock:
+            self.idle_containers.setdefault(key, []).append(container)
+        result = {"StatusCode": 200, "ExecutedVersion": version}
+        if "error" in response:
+            payload = json.dumps(response["error"]).encode()
+            result = {**result, "FunctionError": "Unhandled"}
+        else:
+            payload = json.dumps(response["payload"]).encode()
+        with self._lock:
+            self.bytes_received += len(payload)
+        return {**result, "Payload": io.BytesIO(payload)}
+
+    def _run_event(self, function_name: str, payload: bytes, qualifier: Optional[str]) -> None:
+        while True:
+            try:
+                self.invoke(FunctionName=function_name, Payload=payload, Qualifier=qualifier)
+                return
+            except ClientError as e:
+                if e.response["Error"]["Code"] != "TooManyRequestsException":
+                    raise
+            time.sleep(0.05)
+
+    def _start_container(self, configuration: Dict[str, Any]) -> LocalContainer:
+        with self._lock:
+            self.cold_starts += 1
+            directory = os.path.join(self.root, configuration["FunctionName"], configuration["Version"],
+                                     str(self.cold_starts))
+        extract(configuration["data"], os.path.join(directory, "task"))
+        if self.cold_start_delay:
+            time.sleep(self.cold_start_delay)
+        # layers are extracted in order into the same directory, later layers overwrite files of earlier ones.
+        for layer in configuration["Layers"]:
+            extract(self._layer_data(layer["Arn"]), os.path.join(directory, "opt"))
+        return LocalContainer(directory, configuration["Handler"], {
+            "AWS_LAMBDA_FUNCTION_NAME": configuration["FunctionName"],
+            "AWS_LAMBDA_FUNCTION_VERSION": configuration["Version"],
+            "AWS_LAMBDA_FUNCTION_MEMORY_SIZE": str(configuration["MemorySize"]),
+        })
+
+    def shutdown(self) -> None:
+        if self._events is not None:
+            self._events.shutdown()
+        with self._lock:
+            containers = [container for idle in self.idle_containers.values() for container in idle]
+            self.idle_containers.clear()
+        for container in containers:
+            container.stop()
+
+    # helpers
+
+    def _function(self, name: str, operation: str) -> Dict[str, Any]:
+        if name not in self.functions:
+            raise not_found(operation, f"function not found: {name}")
+        return self.functions[name]
+
+    def _resolve(self, name: str, qualifier: Optional[str], operation: str) -> Dict[str, Any]:
+        function = self._function(name, operation)
+        qualifier = function["aliases"].get(qualifier, qualifier) if qualifier is not None else "$LATEST"
+        if qualifier not in function["versions"]:
+            raise not_found(operation, f"function not found: {name}:{qualifier}")
+        return function["versions"][qualifier]
+
+    @staticmethod
+    def _zip_file(code: Dict[str, Any]) -> bytes:
+        if code.get("ZipFile") is None:
+            raise Exception("local lambda only supports inline zip files as code")
+        return code["ZipFile"]
+
+    @staticmethod
+    def _public(configuration: Dict[str, Any]) -> Dict[str, Any]:
+        return {key: value for key, value in configuration.items() if key != "data"}
+
+
+# files are put next to the handler, see build_handler_archive.
+def handler_package(files: Optional[Dict[str, bytes]] = None) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as archive:
+        archive.write(os.path.join(os.path.dirname(os.path.abspath(__file__)), "lambda_function.py"),
+                      "lambda_function.py")
+        for name, data in (files or {}).items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
+
+
+# LocalLambdaClient with the handler of this checkout already deployed under function_name, behind the live alias,
+# so a builder created with auto_deploy=False invokes it without building an environment. Containers import
+# dependencies from the local interpreter instead of a layer. Used by the benchmarks and anywhere the real client path
+# should run offline. Without a root the containers live in a temporary directory, which nests inside the container's
+# own tmp directory when the fake is created by code running in a container.
+class FakeLambdaClient(LocalLambdaClient):
+    def __init__(self, root: Optional[str] = None, function_name: str = "bauplan", memory_size: int = 256,
+                 timeout: int = 300, **params):
+        super().__init__(root if root is not None else tempfile.mkdtemp(prefix="bauplan-lambda-"), **params)
+        runtime = f"python{sys.version_info.major}.{sys.version_info.minor}"
+        self.function_name = function_name
+        self.create_function(FunctionName=function_name, Runtime=runtime,
+                             Role=f"arn:aws:iam::000000000000:role/{function_name}",
+                             Handler="lambda_function.lambda_handler", Code={"ZipFile": handler_package()},
+                             Timeout=timeout, MemorySize=memory_size, Publish=True)
+        self.create_alias(FunctionName=function_name, Name=LIVE_ALIAS, FunctionVersion="1")
+
+    # publishes the handler with files next to it and moves the live alias to it, the way a deploy would. Used to run
+    # a builder's preload offline: client.publish_handler(builder.handler_files()).
+    def publish_handler(self, files: Dict[str, bytes]) -> str:
+        version = self.update_function_code(FunctionName=self.function_name, ZipFile=handler_package(files),
+                                            Publish=True)["Version"]
+        self.update_alias(FunctionName=self.function_name, Name=LIVE_ALIAS, FunctionVersion=version)
+        return version
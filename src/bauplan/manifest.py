@@ -0,0 +1,63 @@
+import json
+import os
+import site
+import sys
+import threading
+from typing import Any, Callable, Dict, List, Optional
+
+# Local record of what was deployed. Each function name maps to the environment hash, the digest of the handler and
+# the configuration it was last deployed with, plus the version the live alias was moved to. A builder whose state
+# matches its entry skips every control plane call. The requirements discovered with pip freeze are cached as well,
+# keyed by the modification times of the site-packages directories: installing or removing a package adds or removes
+# an entry in them, which changes their mtime.
+DEFAULT_MANIFEST_PATH = os.path.join(".bauplan", "deployments.json")
+
+
+def site_packages_stamp() -> List[Any]:
+    directories = site.getsitepackages() + [site.getusersitepackages()]
+    return [sys.prefix] + [[directory, os.stat(directory).st_mtime_ns] for directory in directories
+                           if os.path.isdir(directory)]
+
+
+class DeploymentManifest:
+    def __init__(self, path: str = DEFAULT_MANIFEST_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Any]:
+        try:
+            with open(self.path) as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _update(self, update: Callable[[Dict[str, Any]], None]) -> None:
+        with self._lock:
+            manifest = self._load()
+            update(manifest)
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            partial_path = f"{self.path}.{os.getpid()}.partial"
+            with open(partial_path, "w") as file:
+                json.dump(manifest, file, indent=2, sort_keys=True)
+            os.replace(partial_path, self.path)
+
+    def get(self, function_name: str) -> Optional[Dict[str, Any]]:
+        return self._load().get("deployments", {}).get(function_name)
+
+    def record(self, function_name: str, deployment: Dict[str, Any]) -> None:
+        self._update(lambda manifest: manifest.setdefault("deployments", {}).__setitem__(function_name, deployment))
+
+    def forget(self, function_name: str) -> None:
+        self._update(lambda manifest: manifest.get("deployments", {}).pop(function_name, None))
+
+    def requirements(self, discover: Callable[[], Dict[str, str]]) -> Dict[str, str]:
+        stamp = site_packages_stamp()
+        cached = self._load().get("requirements")
+        if cached is not None and cached["stamp"] == stamp:
+            return cached["requirements"]
+        requirements = discover()
+        self._update(lambda manifest: manifest.__setitem__("requirements",
+                                                           {"stamp": stamp, "requirements": requirements}))
+        return requirements
@@ -0,0 +1,75 @@
+import sys
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+# the handler module is imported as lambda_function on aws, and from the package when the handler runs locally.
+HANDLER_MODULE_NAMES = ("lambda_function", "src.bauplan.lambda_function")
+
+
+# returns the InvocationState of the invocation this process is handling, None when not running inside a handler
+# (for instance on the local driver).
+def get_current_invocation() -> Optional[Any]:
+    for name in HANDLER_MODULE_NAMES:
+        module = sys.modules.get(name)
+        invocation = getattr(module, "current_invocation", None) if module is not None else None
+        if invocation is not None:
+            return invocation
+    return None
+
+
+# Key of the call the running invocation handles, the same for every invocation running it: retries, hedged
+# duplicates and redelivered jobs. Functions with side effects beyond their result, writing to a database or a bucket,
+# can use it to apply them once. None outside a lambda.
+def get_idempotency_key() -> Optional[str]:
+    invocation = get_current_invocation()
+    return invocation.idempotency_key if invocation is not None else None
+
+
+# depth of the invocation a call made now would start.
+def get_next_depth() -> int:
+    invocation = get_current_invocation()
+    return 1 if invocation is None else invocation.depth + 1
+
+
+# Decides, for a call made from inside a lambda, whether it is shipped to another lambda or run in process. Calls from
+# the local driver are always shipped. A call runs in process as soon as one of the configured limits is hit:
+#   max_depth: the invocation making the call is already this many lambda hops deep.
+#   min_cost: cost(args, kwargs) estimates the work of the call, calls cheaper than min_cost run in process.
+#   min_remaining_ms: less than this is left of the invocation's time, there is no time to pay for another invoke.
+#   max_remote_calls: the invocation already shipped this many nested calls.
+# With recursive divide and conquer this fans out the top few levels and runs the leaves in process, a call that runs
+# in process makes its own nested calls through the same policy.
+class ExecutionPolicy:
+    def __init__(self,
+                 max_depth: Optional[int] = None,
+                 min_cost: Optional[float] = None,
+                 cost: Optional[Callable[..., float]] = None,
+                 min_remaining_ms: Optional[int] = None,
+                 max_remote_calls: Optional[int] = None):
+        if min_cost is not None and cost is None:
+            raise Exception("min_cost requires a cost function estimating the cost of a call from its arguments")
+        self.max_depth = max_depth
+        self.min_cost = min_cost
+        self.cost = cost
+        self.min_remaining_ms = min_remaining_ms
+        self.max_remote_calls = max_remote_calls
+
+    def should_run_remotely(self, args: Tuple, kwargs: Dict[str, Any]) -> bool:
+        return self._should_run_remotely(lambda: self.cost(*args, **kwargs))
+
+    # a chunk of a map is a single invocation: it costs the sum of its calls and counts as one remote call.
+    def should_run_chunk_remotely(self, calls: List[Tuple[Tuple, Dict[str, Any]]]) -> bool:
+        return self._should_run_remotely(lambda: sum(self.cost(*args, **kwargs) for args, kwargs in calls))
+
+    def _should_run_remotely(self, cost: Callable[[], float]) -> bool:
+        invocation = get_current_invocation()
+        if invocation is None:
+            return True
+        if self.max_depth is not None and invocation.depth >= self.max_depth:
+            return False
+        if self.min_cost is not None and cost() < self.min_cost:
+            return False
+        if self.min_remaining_ms is not None:
+            remaining_ms = invocation.remaining_ms()
+            if remaining_ms is not None and remaining_ms < self.min_remaining_ms:
+                return False
+        return invocation.take_remote_call(self.max_remote_calls)
@@ -0,0 +1,174 @@
+import json
+import math
+import os
+import statistics
+import threading
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+# lambda's x86 prices, per GB-second of billed duration and per request.
+PRICE_PER_GB_SECOND = 0.0000166667
+PRICE_PER_REQUEST = 0.0000002
+
+# memory sizes the tuner tries. Lambda allocates cpu in proportion to memory, a function gets a full vcpu at 1769MB.
+DEFAULT_MEMORY_SIZES = (128, 256, 512, 1024, 1769, 3008)
+
+OBJECTIVES = ("cost", "latency")
+
+# lambda function names are at most 64 characters.
+MAX_FUNCTION_NAME = 64
+
+
+# Memory and timeout of the lambda function a decorated function's calls go to. Calls of functions decorated with
+# resources=ResourceProfile(...) run on a variant of the builder's function deployed with that configuration, the
+# same environment and handler under another function name. See LambdaBuilder.function_name_for.
+class ResourceProfile(NamedTuple):
+    memory_size: int = 256
+    timeout: int = 300
+
+    def with_memory_size(self, memory_size: int) -> "ResourceProfile":
+        return self._replace(memory_size=memory_size)
+
+
+# name of the function deployed for a profile, suffixed with its configuration. Long base names are cut so the suffix
+# fits.
+def variant_name(function_name: str, resources: ResourceProfile) -> str:
+    suffix = f"-{resources.memory_size}mb-{resources.timeout}s"
+    return function_name[:MAX_FUNCTION_NAME - len(suffix)] + suffix
+
+
+# billed cost of one invocation, lambda bills the duration rounded up to the millisecond.
+def invocation_cost(memory_size: int, duration_ms: float, price_per_gb_second: float = PRICE_PER_GB_SECOND,
+                    price_per_request: float = PRICE_PER_REQUEST) -> float:
+    return memory_size / 1024 * math.ceil(duration_ms) / 1000 * price_per_gb_second + price_per_request
+
+
+# Picks the memory size minimizing the objective among those with at least min_samples observations: the mean billed
+# cost per call for "cost", the median duration per call for "latency". Ties go to the faster size for cost and to the
+# cheaper one for latency. summaries are MemoryTuner.summary's, None when no size has enough samples.
+def choose_memory_size(summaries: Dict[int, Dict[str, float]], objective: str = "cost",
+                       min_samples: int = 1) -> Optional[int]:
+    if objective not in OBJECTIVES:
+        raise Exception(f"unknown objective {objective}, expected one of {', '.join(OBJECTIVES)}")
+    candidates = [(memory_size, summary) for memory_size, summary in summaries.items()
+                  if summary["samples"] >= min_samples]
+    if not candidates:
+        return None
+    if objective == "cost":
+        def order(candidate: Tuple[int, Dict[str, float]]) -> Tuple[float, ...]:
+            return candidate[1]["cost_per_call"], candidate[1]["ms_per_call"], candidate[0]
+    else:
+        def order(candidate: Tuple[int, Dict[str, float]]) -> Tuple[float, ...]:
+            return candidate[1]["ms_per_call"], candidate[1]["cost_per_call"], candidate[0]
+    return min(candidates, key=order)[0]
+
+
+# Opt in memory tuning, LambdaBuilder(..., tuner=MemoryTuner()). Lambdas report the duration of every invocation and the
+# memory size they ran with, the tuner keeps the last max_samples observations per (function, memory size) and
+# recommends the size minimizing the objective. With switch set the builder routes calls according to the tuner:
+# every size in memory_sizes is tried on min_samples calls, then calls go to the recommended size. Variants are
+# deployed as they are first used. Without switch calls are only observed, see report. The decision only depends on the
+# recorded observations, from_records builds a tuner from timings recorded elsewhere, such as handler spans of a
+# JsonlSink (see records_from_spans), to tune offline. Observations are kept in path when one is given, see save.
+class MemoryTuner:
+    def __init__(self,
+                 memory_sizes: Iterable[int] = DEFAULT_MEMORY_SIZES,
+                 objective: str = "cost",
+                 min_samples: int = 5,
+                 max_samples: int = 200,
+                 switch: bool = False,
+                 path: Optional[str] = None,
+                 price_per_gb_second: float = PRICE_PER_GB_SECOND,
+                 price_per_request: float = PRICE_PER_REQUEST):
+        if objective not in OBJECTIVES:
+            raise Exception(f"unknown objective {objective}, expected one of {', '.join(OBJECTIVES)}")
+        self.memory_sizes = sorted(memory_sizes)
+        self.objective = objective
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self.switch = switch
+        self.path = path
+        self.price_per_gb_second = price_per_gb_second
+        self.price_per_request = price_per_request
+        # function name -> memory size -> [(duration ms, calls)], calls is the number of elements of a map chunk.
+        self.observations: Dict[str, Dict[int, List[Tuple[float, int]]]] = {}
+        self._lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    @classmethod
+    def from_records(cls, records: Iterable[Dict[str, Any]], **params) -> "MemoryTuner":
+        tuner = cls(**params)
+        for record in records:
+            tuner.record(record["function"], record["memory_size"], record["duration_ms"], record.get("calls", 1))
+        return tuner
+
+    def record(self, function: str, memory_size: int, duration_ms: float, calls: int = 1) -> None:
+        with self._lock:
+            samples = self.observations.setdefault(function, {}).setdefault(memory_size, [])
+            samples.append((duration_ms, max(calls, 1)))
+            del samples[:-self.max_samples]
+
+    def cost(self, memory_size: int, duration_ms: float) -> float:
+        return invocation_cost(memory_size, duration_ms, self.price_per_gb_second, self.price_per_request)
+
+    # per memory size: samples, median duration per call and mean billed cost per call.
+    def summary(self, function: str) -> Dict[int, Dict[str, float]]:
+        with self._lock:
+            observed = {memory_size: list(samples)
+                        for memory_size, samples in self.observations.get(function, {}).items()}
+        return {memory_size: {
+            "samples": len(samples),
+            "ms_per_call": statistics.median(duration_ms / calls for duration_ms, calls in samples),
+            "cost_per_call": statistics.fmean(self.cost(memory_size, duration_ms) / calls
+                                              for duration_ms, calls in samples),
+        } for memory_size, samples in observed.items() if samples}
+
+    def recommend(self, function: str) -> Optional[int]:
+        return choose_memory_size(self.summary(function), self.objective, self.min_samples)
+
+    # the memory size the next call of function goes to. Sizes short of min_samples are explored first, the least
+    # observed one each time.
+    def next_memory_size(self, function: str, default: int) -> int:
+        if not self.switch:
+            return default
+        with self._lock:
+            observed = self.observations.get(function, {})
+            counts = {memory_size: len(observed.get(memory_size, ())) for memory_size in self.memory_sizes}
+        least_observed = min(counts, key=lambda memory_size: (counts[memory_size], memory_size))
+        if counts[least_observed] < self.min_samples:
+            return least_observed
+        recommended = self.recommend(function)
+        return recommended if recommended is not None else default
+
+    def report(self) -> None:
+        for function in sorted(self.observations):
+            summaries = self.summary(function)
+            print(f"{function}: recommended memory size {self.recommend(function)}MB ({self.objective})")
+            for memory_size, summary in sorted(summaries.items()):
+                print(f"  {memory_size:>6}MB {summary['samples']:>5} samples {summary['ms_per_call']:>10.1f}ms "
+                      f"${summary['cost_per_call']:.10f} per call")
+
+    def save(self, path: Optional[str] = None) -> None:
+        path = path or self.path
+        if path is None:
+            return
+        with self._lock:
+            data = {function: {str(memory_size): samples for memory_size, samples in sizes.items()}
+                    for function, sizes in self.observations.items()}
+        with open(path, "w") as file:
+            json.dump(data, file)
+
+    def load(self, path: str) -> None:
+        with open(path) as file:
+            data = json.load(file)
+        for function, sizes in data.items():
+            for memory_size, samples in sizes.items():
+                for duration_ms, calls in samples:
+                    self.record(function, int(memory_size), duration_ms, calls)
+
+
+# observations in the handler spans of a trace, e.g. the lines of a JsonlSink file, for MemoryTuner.from_records.
+def records_from_spans(spans: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    return [{"function": span["name"], "memory_size": span["memory_size"], "duration_ms": span["duration_ms"],
+             "calls": span.get("calls", 1)}
+            for span in spans if span.get("kind") == "handler" and span.get("memory_size") is not None]
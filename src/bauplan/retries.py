@@ -0,0 +1,129 @@
+import math
+import random
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, Iterable, List, Optional
+
+from botocore.exceptions import ClientError, ConnectionError as BotocoreConnectionError, HTTPClientError
+
+from src.bauplan.engine import is_throttle_error
+
+# error types lambda reports for failures of the platform rather than of the function: timeouts, crashed or out of
+# memory runtimes.
+PLATFORM_ERROR_PREFIXES = ("Runtime.", "Sandbox.")
+
+
+# An exception raised by the function in the lambda, or a failure of the lambda running it, re-raised on the caller
+# with the type, message and traceback the lambda reported.
+class RemoteError(Exception):
+    def __init__(self, error_type: str, message: str, stack_trace: List[str]):
+        super().__init__(f"{error_type}: {message}")
+        self.error_type = error_type
+        self.message = message
+        self.stack_trace = stack_trace
+
+    # error payload of an unhandled exception, the way lambda and encode_exception report it. Timeouts may come without
+    # an error type.
+    @classmethod
+    def from_payload(cls, error: Dict[str, Any]) -> "RemoteError":
+        return cls(error.get("errorType", "Sandbox.Timedout"), error.get("errorMessage", ""),
+                   error.get("stackTrace") or [])
+
+    @property
+    def is_platform_error(self) -> bool:
+        return self.error_type.startswith(PLATFORM_ERROR_PREFIXES)
+
+    def __str__(self) -> str:
+        if not self.stack_trace:
+            return f"{self.error_type}: {self.message}"
+        return f"{self.error_type}: {self.message}\n\nRemote traceback (most recent call last):\n" \
+               f"{''.join(self.stack_trace)}"
+
+
+# "throttle": lambda refused the invoke, the function did not run. "transport": the request or its response was lost
+# on the way, the function may or may not have run. "platform": the lambda failed around the function (timeout, crash).
+# "user": the function raised. None for anything else, which is never retried.
+def classify_error(error: Exception) -> Optional[str]:
+    if isinstance(error, RemoteError):
+        return "platform" if error.is_platform_error else "user"
+    if is_throttle_error(error):
+        return "throttle"
+    if isinstance(error, (BotocoreConnectionError, HTTPClientError, ConnectionError, TimeoutError)):
+        return "transport"
+    if isinstance(error, ClientError) and error.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0) >= 500:
+        return "transport"
+    return None
+
+
+# How many times a failed invoke is retried, per kind of error, see classify_error. Throttles the engine gave up on
+# are retried here on top of its own retries. Retrying anything but a throttle may run the function again, calls carry
+# an idempotency key shared by their retries for code with side effects to detect that, see get_idempotency_key. User
+# errors are not retried unless user_retries is set, only those whose type is in retry_on when it is given. Retries
+# back off exponentially with full jitter.
+class RetryPolicy:
+    def __init__(self,
+                 transport_retries: int = 2,
+                 throttle_retries: int = 4,
+                 platform_retries: int = 0,
+                 user_retries: int = 0,
+                 retry_on: Iterable[str] = (),
+                 base_backoff: float = 0.1,
+                 max_backoff: float = 10.0):
+        self.retries = {"transport": transport_retries, "throttle": throttle_retries, "platform": platform_retries,
+                        "user": user_retries}
+        self.retry_on = set(retry_on)
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+
+    # seconds to wait before retrying after error, None when it is not retried. retried counts the retries made so far
+    # per kind of error and is updated. Calls that must not run twice (streams) are only retried on throttles.
+    def next_delay(self, error: Exception, retried: Dict[str, int], repeatable: bool = True) -> Optional[float]:
+        category = classify_error(error)
+        if category is None or (category != "throttle" and not repeatable):
+            return None
+        if category == "user" and self.retry_on and error.error_type not in self.retry_on:
+            return None
+        attempt = retried.get(category, 0)
+        if attempt >= self.retries[category]:
+            return None
+        retried[category] = attempt + 1
+        return random.uniform(0, min(self.max_backoff, self.base_backoff * 2 ** attempt))
+
+
+# Opt in hedging against stragglers. Invoke latencies are recorded per function, once a function has min_samples of
+# them a call still unanswered after the percentile of its recent latencies (at least min_delay seconds) fires a
+# duplicate invocation, up to max_hedges of them, and the first answer wins. The others run to completion and are
+# ignored, hedged calls run their function more than once, see get_idempotency_key. Latencies of map chunks are
+# recorded per element. hedged and won count duplicates fired and duplicates that answered first.
+class HedgePolicy:
+    def __init__(self, percentile: float = 0.95, min_samples: int = 20, window: int = 200, max_hedges: int = 1,
+                 min_delay: float = 0.0):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.window = window
+        self.max_hedges = max_hedges
+        self.min_delay = min_delay
+        self.latencies: Dict[str, Deque[float]] = {}
+        self.hedged = 0
+        self.won = 0
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, seconds: float, calls: int = 1) -> None:
+        with self._lock:
+            self.latencies.setdefault(name, deque(maxlen=self.window)).append(seconds / max(calls, 1))
+
+    # seconds to wait for an answer before hedging a call of name, None while too few latencies were recorded.
+    def delay(self, name: str, calls: int = 1) -> Optional[float]:
+        with self._lock:
+            latencies = sorted(self.latencies.get(name, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        # nearest rank.
+        rank = max(1, math.ceil(self.percentile * len(latencies)))
+        return max(self.min_delay, latencies[rank - 1] * max(calls, 1))
+
+    # counts the duplicates a call fired, won when one of them answered first.
+    def record_hedges(self, hedges: int, won: bool) -> None:
+        with self._lock:
+            self.hedged += hedges
+            self.won += won
@@ -0,0 +1,57 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Tuple
+
+
+# Coalesces identical calls that are in flight at the same time: the first caller for a key runs the call, every caller
+# arriving before it finishes waits for the same result or exception. Nothing is kept once the call finishes, see
+# ResultCache for persistent memoization. Sync and async callers share the in flight calls.
+class SingleFlight:
+    def __init__(self):
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.saved = 0
+
+    def _join(self, key: str) -> Tuple[Future, bool]:
+        with self._lock:
+            self.calls += 1
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.saved += 1
+                return future, False
+            future = Future()
+            self._in_flight[key] = future
+            return future, True
+
+    def _finish(self, key: str, future: Future, fn: Callable[[], Any]) -> None:
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Any:
+        future, is_leader = self._join(key)
+        if is_leader:
+            self._finish(key, future, fn)
+        return future.result()
+
+    async def aio_do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future, is_leader = self._join(key)
+        if is_leader:
+            try:
+                future.set_result(await fn())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self._lock:
+                    del self._in_flight[key]
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"calls": self.calls, "saved": self.saved, "in_flight": len(self._in_flight)}
@@ -0,0 +1,133 @@
+import fnmatch
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import AbstractSet, Dict, Iterable, List, Optional, Tuple, Union, Set
+
+from src.bauplan.utils import get_file
+
+# the default exclusions used when the working directory is shipped to a lambda.
+DEFAULT_EXCLUDED_FILE_NAMES = ["venv", "__pycache__", "packages"]
+DEFAULT_EXCLUDE_REG_EXP = r"^\..*"
+
+# sent to the lambda instead of the whole source tree. files only holds what changed relative to base,
+# base being the last digest a warm container reported holding. base None means files is the full tree.
+ProjectDelta = Dict[str, Union[str, None, Dict[str, bytes], List[str]]]
+
+
+def tree_digest(file_digests: Dict[str, str]) -> str:
+    tree_hash = hashlib.sha256()
+    for relative_path in sorted(file_digests):
+        tree_hash.update(f"{relative_path}\0{file_digests[relative_path]}\n".encode())
+    return tree_hash.hexdigest()
+
+
+# An incremental, content addressed view of the python files under a directory, plus any other files matching the
+# tracked data patterns. Files are only re-read when their (mtime, size) changes, every file is hashed once per change
+# and the tree digest is derived from the per file digests so it is cheap to recompute. A bounded history of previous
+# trees is kept so a delta can be computed against whatever digest a lambda container reports holding. Deltas can be
+# restricted to a subset of the files, such as the import closure of a function, each subset is a tree of its own.
+class ProjectSnapshot:
+    def __init__(self,
+                 root: str,
+                 excluded_file_names: Union[List[str], Set[str]] = tuple(DEFAULT_EXCLUDED_FILE_NAMES),
+                 exclude_reg_exp: str = DEFAULT_EXCLUDE_REG_EXP,
+                 history_size: int = 16):
+        self.root = root
+        self.excluded_file_names = set(excluded_file_names)
+        self.exclude_reg_exp = re.compile(exclude_reg_exp)
+        self.history_size = history_size
+        # relative path patterns of non python files that are part of the project, e.g. "config/*.json".
+        self.data_patterns: Set[str] = set()
+        self.digest: Optional[str] = None
+        self._stats: Dict[str, Tuple[int, int]] = {}
+        self._contents: Dict[str, bytes] = {}
+        self._file_digests: Dict[str, str] = {}
+        self._history: "OrderedDict[str, Dict[str, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _walk(self, path: str, relative: str, acc: Dict[str, Tuple[int, int]]) -> None:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name in self.excluded_file_names or self.exclude_reg_exp.match(entry.name) is not None:
+                    continue
+                relative_path = f"{relative}{entry.name}"
+                if entry.is_dir():
+                    self._walk(entry.path, f"{relative_path}/", acc)
+                elif entry.name[-3:] == ".py" or any(fnmatch.fnmatch(relative_path, pattern)
+                                                     for pattern in self.data_patterns):
+                    stat = entry.stat()
+                    acc[relative_path] = (stat.st_mtime_ns, stat.st_size)
+
+    def refresh(self) -> str:
+        with self._lock:
+            stats: Dict[str, Tuple[int, int]] = {}
+            self._walk(self.root, "", stats)
+            for relative_path in [p for p in self._stats if p not in stats]:
+                del self._contents[relative_path]
+                del self._file_digests[relative_path]
+            for relative_path, stat in stats.items():
+                if self._stats.get(relative_path) != stat:
+                    content = get_file(os.path.join(self.root, relative_path))
+                    self._contents[relative_path] = content
+                    self._file_digests[relative_path] = hashlib.sha256(content).hexdigest()
+            self._stats = stats
+            self.digest = tree_digest(self._file_digests)
+            self._remember(self.digest, dict(self._file_digests))
+            return self.digest
+
+    def _remember(self, digest: str, file_digests: Dict[str, str]) -> None:
+        self._history[digest] = file_digests
+        self._history.move_to_end(digest)
+        while len(self._history) > self.history_size:
+            self._history.popitem(last=False)
+
+    def track(self, data_patterns: Iterable[str]) -> None:
+        # files matching the patterns are picked up on the next refresh.
+        with self._lock:
+            self.data_patterns |= set(data_patterns)
+
+    # delta of the current tree, or of the given subset of it, against base.
+    def delta(self, base: Optional[str] = None, paths: Optional[AbstractSet[str]] = None) -> ProjectDelta:
+        with self._lock:
+            file_digests = self._file_digests
+            digest = self.digest
+            if paths is not None:
+                file_digests = {relative_path: file_digest for relative_path, file_digest in file_digests.items()
+                                if relative_path in paths}
+                digest = tree_digest(file_digests)
+                self._remember(digest, file_digests)
+            base_files = self._history.get(base) if base is not None else None
+            if base_files is None:
+                return {"digest": digest, "base": None, "deleted": [],
+                        "files": {relative_path: self._contents[relative_path] for relative_path in file_digests}}
+            changed = {relative_path: self._contents[relative_path]
+                       for relative_path, file_digest in file_digests.items()
+                       if base_files.get(relative_path) != file_digest}
+            deleted = [relative_path for relative_path in base_files if relative_path not in file_digests]
+            return {"digest": digest, "base": base, "files": changed, "deleted": deleted}
+
+    def file_digest(self, relative_path: str) -> Optional[str]:
+        return self._file_digests.get(relative_path)
+
+    def content(self, relative_path: str) -> bytes:
+        return self._contents.get(relative_path, b"")
+
+    def paths(self) -> Set[str]:
+        with self._lock:
+            return set(self._contents)
+
+
+_snapshots: Dict[str, ProjectSnapshot] = {}
+_snapshots_lock = threading.Lock()
+
+
+# snapshots are shared per root so that every LambdaBuilder in a process walks the project once.
+def get_project_snapshot(root: str) -> ProjectSnapshot:
+    root = os.path.realpath(root)
+    with _snapshots_lock:
+        if root not in _snapshots:
+            _snapshots[root] = ProjectSnapshot(root)
+        return _snapshots[root]
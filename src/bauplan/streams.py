@@ -0,0 +1,99 @@
+import asyncio
+import json
+import time
+from concurrent.futures import Future
+from typing import Any, AsyncIterator, Iterator, List, Optional
+
+from src.bauplan.lambda_function import STREAM_CLOSED, BlobStore, decode
+
+# polling backs off from the first interval to the last while no chunk arrives.
+MIN_POLL_SECONDS = 0.02
+MAX_POLL_SECONDS = 0.5
+
+# returned by StreamReader.next_chunk once every chunk was read.
+END = object()
+
+
+# Client side of a streamed call, see StreamWriter. The invocation runs in the background while chunks are read from
+# the store in order, one at a time, each acknowledged once it was handed out so the writer can move on. Only the chunk
+# being consumed is held in memory. Exceptions of the invocation are raised after the chunks written before them.
+# Chunks are deleted once read, the acknowledgement and the chunks never read once the invocation is over.
+class StreamReader:
+    def __init__(self, store: BlobStore, prefix: str, invocation: Future, blob_store: Optional[BlobStore]):
+        self.store = store
+        self.prefix = prefix
+        self.invocation = invocation
+        self.blob_store = blob_store
+        self.index = 0
+        self.is_finished = False
+        self.is_closed = False
+
+    # the next chunk's items, None when it was not written yet, END when the stream is over.
+    def next_chunk(self) -> Any:
+        key = f"{self.prefix}-{self.index}"
+        if not self.store.exists(key):
+            if not self.invocation.done():
+                return None
+            # raises the invocation's exception. Chunks are written before the response, once it is there a missing
+            # chunk means the stream is over.
+            chunks = self.invocation.result()
+            if self.index >= chunks:
+                self.is_finished = True
+                return END
+        items = decode(json.loads(self.store.get(key)), self.blob_store)
+        self.store.delete(key)
+        self.index += 1
+        self.store.write(f"{self.prefix}-ack", str(self.index).encode())
+        return items
+
+    # tells the writer the caller stopped reading, the generator in the lambda is closed. The writer may still be
+    # flushing a chunk, the keys are deleted once the invocation returned.
+    def close(self) -> None:
+        if self.is_closed:
+            return
+        self.is_closed = True
+        if not self.is_finished:
+            self.store.write(f"{self.prefix}-ack", STREAM_CLOSED.encode())
+        self.invocation.add_done_callback(lambda _: self._delete_keys())
+
+    def _delete_keys(self) -> None:
+        for key in self.store.list_keys(f"{self.prefix}-"):
+            self.store.delete(key)
+
+
+def read_stream(reader: StreamReader) -> Iterator[Any]:
+    delay = MIN_POLL_SECONDS
+    try:
+        while True:
+            items: Optional[List[Any]] = reader.next_chunk()
+            if items is END:
+                return
+            if items is None:
+                time.sleep(delay)
+                delay = min(MAX_POLL_SECONDS, delay * 2)
+                continue
+            delay = MIN_POLL_SECONDS
+            yield from items
+    finally:
+        reader.close()
+
+
+# Store requests block, they run on the event loop's default executor. Not on the engine's threads: the invocations
+# behind streams hold those until their stream ends, with as many streams as threads no reader would get one to
+# acknowledge chunks and every writer would wait on its reader forever.
+async def aio_read_stream(reader: StreamReader) -> AsyncIterator[Any]:
+    delay = MIN_POLL_SECONDS
+    try:
+        while True:
+            items: Optional[List[Any]] = await asyncio.to_thread(reader.next_chunk)
+            if items is END:
+                return
+            if items is None:
+                await asyncio.sleep(delay)
+                delay = min(MAX_POLL_SECONDS, delay * 2)
+                continue
+            delay = MIN_POLL_SECONDS
+            for item in items:
+                yield item
+    finally:
+        await asyncio.to_thread(reader.close)
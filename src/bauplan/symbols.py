@@ -0,0 +1,125 @@
+import ast
+import json
+import os
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from src.bauplan.snapshot import ProjectSnapshot
+
+# qualified name -> line the definition starts on, decorators included, which is what co_firstlineno reports.
+FileSymbols = Dict[str, int]
+
+
+def parse_symbols(source: bytes) -> FileSymbols:
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return {}
+    symbols: FileSymbols = {}
+
+    def visit(node: ast.AST, prefix: str) -> None:
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef)):
+                qualname = f"{prefix}{child.name}"
+                symbols[qualname] = min([child.lineno] + [decorator.lineno for decorator in child.decorator_list])
+                visit(child, f"{qualname}.<locals>.")
+            elif isinstance(child, ast.ClassDef):
+                visit(child, f"{prefix}{child.name}.")
+            else:
+                visit(child, prefix)
+
+    visit(tree, "")
+    return symbols
+
+
+def module_name(relative_path: str) -> str:
+    module = relative_path[:-3] if relative_path.endswith(".py") else relative_path
+    module = module[:-len("/__init__")] if module.endswith("/__init__") else module
+    return module.replace("/", ".")
+
+
+# Index of the functions defined in a project snapshot, mapping qualified names to the files defining them. Files are
+# parsed once per version: the snapshot only re-reads a file when its mtime or size changes, and the parsed symbols
+# are persisted by file digest so a new process only parses files that changed since the last run. Used to locate the
+# file of a function whose code does not point at one, e.g. functions defined in a notebook or through exec.
+class SymbolIndex:
+    def __init__(self, snapshot: ProjectSnapshot, cache_path: Optional[str] = None):
+        self.snapshot = snapshot
+        self.cache_path = cache_path
+        # relative path -> (file digest, symbols)
+        self._files: Dict[str, Tuple[str, FileSymbols]] = self._load()
+        self._by_name: Dict[str, List[Tuple[str, int]]] = {}
+        self._indexed_digest: Optional[str] = None
+        self._lock = threading.Lock()
+
+    def _load(self) -> Dict[str, Tuple[str, FileSymbols]]:
+        if self.cache_path is None:
+            return {}
+        try:
+            with open(self.cache_path) as file:
+                return {path: (entry[0], entry[1]) for path, entry in json.load(file).items()}
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def _save(self) -> None:
+        directory = os.path.dirname(self.cache_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        partial_path = f"{self.cache_path}.{os.getpid()}.partial"
+        with open(partial_path, "w") as file:
+            json.dump({path: list(entry) for path, entry in self._files.items()}, file)
+        os.replace(partial_path, self.cache_path)
+
+    def _update(self) -> None:
+        # re-parses only files whose digest changed, then rebuilds the name lookup. Runs once per snapshot digest.
+        if self._indexed_digest == self.snapshot.digest:
+            return
+        paths = {path for path in self.snapshot.paths() if path.endswith(".py")}
+        is_changed = False
+        for path in [path for path in self._files if path not in paths]:
+            del self._files[path]
+            is_changed = True
+        for path in paths:
+            file_digest = self.snapshot.file_digest(path)
+            if path not in self._files or self._files[path][0] != file_digest:
+                self._files[path] = (file_digest, parse_symbols(self.snapshot.content(path)))
+                is_changed = True
+        by_name: Dict[str, List[Tuple[str, int]]] = {}
+        for path, (_, symbols) in self._files.items():
+            for qualname, lineno in symbols.items():
+                by_name.setdefault(qualname, []).append((path, lineno))
+        self._by_name = by_name
+        self._indexed_digest = self.snapshot.digest
+        if is_changed and self.cache_path is not None:
+            self._save()
+
+    # relative path of the file defining func. Functions with the same qualified name in several files are told apart
+    # by module name, then by the line the definition starts on.
+    def find(self, func: Callable) -> str:
+        with self._lock:
+            self._update()
+            candidates = self._by_name.get(func.__qualname__, [])
+        if len(candidates) > 1:
+            candidates = [candidate for candidate in candidates
+                          if module_name(candidate[0]) == func.__module__] or candidates
+        if len(candidates) > 1:
+            first_line = getattr(getattr(func, "__code__", None), "co_firstlineno", None)
+            candidates = [candidate for candidate in candidates if candidate[1] == first_line] or candidates
+        if not candidates:
+            raise Exception(f"function with name: {func.__qualname__} could not be found")
+        if len(candidates) > 1:
+            raise Exception(f"function {func.__qualname__} is defined in several files: "
+                            f"{', '.join(sorted(path for path, _ in candidates))}")
+        return candidates[0][0]
+
+
+_indexes: Dict[str, SymbolIndex] = {}
+_indexes_lock = threading.Lock()
+
+
+# one index per snapshot root, shared by every decorator and LambdaBuilder in a process.
+def get_symbol_index(snapshot: ProjectSnapshot) -> SymbolIndex:
+    with _indexes_lock:
+        if snapshot.root not in _indexes or _indexes[snapshot.root].snapshot is not snapshot:
+            _indexes[snapshot.root] = SymbolIndex(snapshot, os.path.join(snapshot.root, ".bauplan", "symbols.json"))
+        return _indexes[snapshot.root]
@@ -0,0 +1,139 @@
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Dict, Iterator, List, Optional
+
+from src.bauplan.lambda_function import StageTimer, activate_timer, new_span_id
+from src.bauplan.policy import get_current_invocation
+
+# Spans of decorated calls. Every remote call records a client span with its stage timings (prepare, pickle, compress,
+# invoke, decompress, unpickle...) and payload sizes, and the lambda answering it returns a handler span with its own
+# stages, whether the container was cold and the spans of the calls it made in turn. The trace id and parent span id
+# travel with every invoke, so a nested chain of lambdas comes back as one tree. Spans are plain dicts:
+#   {"trace_id", "span_id", "parent_id", "name", "kind", "start", "duration_ms", "cold", "stages", "sizes", ...}
+# kind is "client" for a call shipped to a lambda, "handler" for the lambda side of it and "in_process" for a call an
+# ExecutionPolicy kept in process. Finished spans go to the builder's sink, or back to the caller when made inside a
+# traced lambda.
+
+
+class SpanSink:
+    def export(self, span: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class MemorySink(SpanSink):
+    def __init__(self):
+        self.spans: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def export(self, span: Dict[str, Any]) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def traces(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            traces: Dict[str, List[Dict[str, Any]]] = {}
+            for span in self.spans:
+                traces.setdefault(span["trace_id"], []).append(span)
+            return traces
+
+
+# one json document per line, appended as spans finish.
+class JsonlSink(SpanSink):
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, span: Dict[str, Any]) -> None:
+        line = json.dumps(span) + "\n"
+        with self._lock:
+            with open(self.path, "a") as file:
+                file.write(line)
+
+
+class Tracer:
+    def __init__(self, sink: SpanSink):
+        self.sink = sink
+
+
+class Span:
+    def __init__(self, name: str, kind: str, trace_id: str, parent_id: Optional[str], tracer: Optional[Tracer],
+                 attributes: Dict[str, Any]):
+        self.name = name
+        self.kind = kind
+        self.trace_id = trace_id
+        self.span_id = new_span_id()
+        self.parent_id = parent_id
+        self.tracer = tracer
+        self.attributes = attributes
+        self.timer = StageTimer()
+        self.cold: Optional[bool] = None
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"trace_id": self.trace_id, "span_id": self.span_id, "parent_id": self.parent_id, "name": self.name,
+                "kind": self.kind, "start": self.start_time, "duration_ms": self.duration_ms, "cold": self.cold,
+                "stages": self.timer.stages, "sizes": self.timer.sizes, **self.attributes}
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar("bauplan_current_span", default=None)
+
+
+def export(span: Dict[str, Any], tracer: Optional[Tracer]) -> None:
+    invocation = get_current_invocation()
+    if invocation is not None and invocation.trace is not None:
+        invocation.add_span(span)
+    elif tracer is not None:
+        tracer.sink.export(span)
+
+
+# opens a span when the call is part of a trace: below another span, inside a traced lambda invocation or with a
+# tracer configured on the builder. Otherwise yields None and records nothing.
+@contextmanager
+def span(name: str, kind: str, tracer: Optional[Tracer], **attributes) -> Iterator[Optional[Span]]:
+    parent = current_span.get()
+    invocation = get_current_invocation()
+    if parent is not None:
+        trace_id, parent_id, tracer = parent.trace_id, parent.span_id, parent.tracer or tracer
+    elif invocation is not None and invocation.trace is not None:
+        trace_id, parent_id = invocation.trace["trace_id"], invocation.trace["span_id"]
+    elif tracer is not None:
+        trace_id, parent_id = uuid.uuid4().hex, None
+    else:
+        yield None
+        return
+    current = Span(name, kind, trace_id, parent_id, tracer, attributes)
+    token = current_span.set(current)
+    try:
+        with activate_timer(current.timer):
+            yield current
+    finally:
+        current.duration_ms = (time.perf_counter() - current.start) * 1000
+        current_span.reset(token)
+        export(current.to_dict(), current.tracer)
+
+
+# the trace fields of an invoke made now, None when the call is not traced.
+def request_trace() -> Optional[Dict[str, str]]:
+    current = current_span.get()
+    return {"trace_id": current.trace_id, "parent_id": current.span_id} if current is not None else None
+
+
+# exports the handler span a lambda returned, and the spans of the nested calls it made, as children of the current
+# client span.
+def record_response_trace(trace: Dict[str, Any]) -> None:
+    current = current_span.get()
+    if current is None:
+        return
+    nested_spans = trace.pop("spans", [])
+    current.cold = trace["cold"]
+    # time the invoke took beyond the handler, the network, the lambda service and a cold start's init.
+    current.attributes["overhead_ms"] = current.timer.stages.get("invoke", 0.0) - trace["duration_ms"]
+    for nested_span in nested_spans:
+        export(nested_span, current.tracer)
+    export(trace, current.tracer)
@@ -1,16 +1,21 @@
-import ast
 import hashlib
 import io
+import json
 import os
 import shutil
 import subprocess
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 import zipfile
-from typing import List, Union, Optional, Dict, Set, TextIO
+from typing import List, Optional, Dict, TextIO, Any, Tuple
 import re
 import docker
 
+from src.bauplan.archive import NO_PRUNING, PruneRules, build_archive, print_archive_report
+
 
 # for optimization these functions should be rewritten in C, C++ or Rust.
 # and accessed via ffi from python. All of this puts initialization overhead
@@ -21,12 +26,8 @@ import docker
 # in memory virtual filesystem so the actual filesystem is never touched for
 # a pretty good speed up here.
 
-def get_context_from_file(path: str) -> ast.Module:
-    current_file_path = os.path.realpath(path)
-    with open(current_file_path, 'r') as f:
-        file_content = f.read()
-        root_nodes = ast.parse(file_content)
-        return root_nodes
+def hash_file(path: str) -> str:
+    return hashlib.sha256(get_file(path)).hexdigest()
 
 
 @contextmanager
@@ -57,7 +58,14 @@ def failure_tracker() -> None:
 Requirements = Dict[str, str]
 
 
-def build_env(package_hash: str, requirements: Requirements, package_dir="packages") -> str:
+def build_env(package_hash: str, requirements: Requirements, package_dir="packages", runtime: str = "python3.10",
+              platforms: Optional[List[str]] = None, wheel_cache_dir: Optional[str] = None,
+              wheelhouse: Optional[str] = None, offline: bool = False, max_workers: int = 8,
+              prune_rules: Optional[PruneRules] = None, compile_pyc: bool = False,
+              archive_name: Optional[str] = None) -> str:
+    # the archive is named after archive_name, the layer key of the environment and its archive options, see
+    # layer_key. Archives built with other options sit next to it.
+    archive_name = archive_name or package_hash
     if not os.path.exists(package_dir):
         os.mkdir(package_dir)
     with change_directory(package_dir):
@@ -66,23 +74,293 @@ def build_env(package_hash: str, requirements: Requirements, package_dir="packag
         if not os.path.exists(package_hash):
             package_does_not_exist = True
             os.mkdir(package_hash)
-        if not os.path.exists(f"{package_hash}.zip"):
+        if not os.path.exists(f"{archive_name}.layer.zip"):
             archive_does_not_exist = True
         with change_directory(package_hash):
             with failure_tracker() as did_previous_build_fail:
                 if did_previous_build_fail or package_does_not_exist:
-                    [install_package(package, version) for package, version in requirements.items()]
-                    with change_directory("../"):
-                        with change_directory("../"):
-                            filename = "lambda_function.py"
-                            pathname = os.path.join("", filename)
-                            shutil.copy2(pathname, os.path.join(f"{package_dir}/{package_hash}", filename))
-                if did_previous_build_fail or archive_does_not_exist or package_does_not_exist:
-                    with change_directory("../"):
-                        zip_directory(f"./{package_hash}", f"{package_hash}.zip")
+                    report = install_requirements(requirements, "./", runtime, platforms, wheel_cache_dir, wheelhouse,
+                                                  offline, max_workers)
+                    with open(f"../{package_hash}.build.json", "w") as file:
+                        json.dump(report, file, indent=2)
+                    print_build_report(report)
+        # archived once the failure marker is gone so it never ends up in the archive. The environment is deployed as
+        # a lambda layer, layers are unpacked into /opt and /opt/python is on the import path of python runtimes.
+        if did_previous_build_fail or archive_does_not_exist or package_does_not_exist:
+            report = build_archive(f"./{package_hash}", f"{archive_name}.layer.zip", prune_rules,
+                                   runtime if compile_pyc else None, prefix="python/")
+            print_archive_report(report)
     return package_hash
 
 
+# the handler is deployed on its own, apart from the dependency layer, so changing it uploads a few KB. The archive is
+# deterministic, its hash only changes when lambda_function.py does.
+# files are put next to the handler, e.g. the preload file of LambdaBuilder.handler_files.
+def build_handler_archive(package_dir: str = "packages", files: Optional[Dict[str, bytes]] = None) -> str:
+    handler_dir = os.path.join(package_dir, "handler")
+    if os.path.exists(handler_dir):
+        shutil.rmtree(handler_dir)
+    os.makedirs(handler_dir)
+    filename = "lambda_function.py"
+    shutil.copyfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), filename),
+                    os.path.join(handler_dir, filename))
+    for name, data in (files or {}).items():
+        with open(os.path.join(handler_dir, name), "wb") as file:
+            file.write(data)
+    output_path = os.path.join(package_dir, "handler.zip")
+    build_archive(handler_dir, output_path, NO_PRUNING)
+    return output_path
+
+
+# Environment builds resolve the whole requirement set once, then fetch and install every wheel in parallel. Wheels
+# are kept in a cache shared by every environment hash, keyed by (package, version, platform), so changing a single
+# version only fetches that one package. With a wheelhouse directory and offline=True nothing touches the network.
+WHEEL_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "bauplan", "wheels")
+DEFAULT_PLATFORMS = ["manylinux2014_x86_64"]
+
+
+def runtime_python_version(runtime: str) -> str:
+    # "python3.10" -> "3.10"
+    return runtime.replace("python", "")
+
+
+def canonical_package_name(name: str) -> str:
+    return re.sub(r"[-_.]+", "_", name).lower()
+
+
+def pip_index_options(wheel_cache_dir: str, wheelhouse: Optional[str], offline: bool) -> List[str]:
+    options = ["--find-links", wheel_cache_dir]
+    if wheelhouse is not None:
+        options += ["--find-links", wheelhouse]
+    if offline:
+        options += ["--no-index"]
+    return options
+
+
+def pip_platform_options(python_version: str, platforms: List[str]) -> List[str]:
+    options = ["--only-binary=:all:", "--python-version", python_version, "--implementation", "cp"]
+    for platform in platforms:
+        options += ["--platform", platform]
+    return options
+
+
+def resolve_requirements(requirements: Requirements, python_version: str, platforms: List[str], wheel_cache_dir: str,
+                         wheelhouse: Optional[str], offline: bool) -> Requirements:
+    # pip resolves the full set for the target platform without installing anything, the resolution of a requirement
+    # set is cached so a rebuild of the same set does not resolve again. The wheels a resolution could pick from are
+    # part of its key: the wheelhouse, its contents and whether the index was used.
+    resolutions_dir = os.path.join(wheel_cache_dir, "resolutions")
+    os.makedirs(resolutions_dir, exist_ok=True)
+    wheelhouse_files = sorted(os.listdir(wheelhouse)) if wheelhouse is not None and os.path.isdir(wheelhouse) else None
+    resolution_key = json.dumps([sorted(requirements.items()), python_version, platforms,
+                                 os.path.abspath(wheelhouse) if wheelhouse is not None else None, wheelhouse_files,
+                                 offline]).encode()
+    resolution_path = os.path.join(resolutions_dir, f"{hashlib.sha256(resolution_key).hexdigest()}.json")
+    if os.path.exists(resolution_path):
+        with open(resolution_path) as file:
+            return json.load(file)
+    with tempfile.TemporaryDirectory() as target:
+        command = [sys.executable, "-m", "pip", "install", "--dry-run", "--ignore-installed", "--quiet",
+                   "--report", "-", "--target", target,
+                   *pip_index_options(wheel_cache_dir, wheelhouse, offline),
+                   *[f"{package}=={version}" for package, version in requirements.items()]]
+        is_target_resolution = True
+        try:
+            output = subprocess.check_output(command + pip_platform_options(python_version, platforms),
+                                             stderr=subprocess.PIPE)
+        except subprocess.CalledProcessError:
+            # pip only resolves for another platform from wheels. A requirement published as a source distribution
+            # alone fails that, the set is resolved for this machine instead and fetch_wheel checks each package. The
+            # versions picked for this machine may differ from the target's, that resolution is not cached.
+            print(f"some requirements have no wheel for {', '.join(platforms)}, resolving them for this machine")
+            output = subprocess.check_output(command)
+            is_target_resolution = False
+        report = json.loads(output.decode('utf-8'))
+    resolved = {item["metadata"]["name"]: item["metadata"]["version"] for item in report["install"]}
+    if is_target_resolution:
+        with open(resolution_path, "w") as file:
+            json.dump(resolved, file)
+    return resolved
+
+
+# name, version and (python, abi, platform) tags of a wheel filename, None for anything else. Compressed tag sets
+# ("py2.py3", "manylinux_2_17_x86_64.manylinux2014_x86_64") are expanded.
+WheelTag = Tuple[str, str, str]
+
+
+def parse_wheel_filename(filename: str) -> Optional[Tuple[str, str, List[WheelTag]]]:
+    if not filename.endswith(".whl"):
+        return None
+    parts = filename[:-len(".whl")].split("-")
+    # name-version(-build)?-python-abi-platform
+    if len(parts) not in (5, 6):
+        return None
+    python_tags, abi_tags, platform_tags = parts[-3:]
+    tags = [(python_tag, abi_tag, platform_tag) for python_tag in python_tags.split(".")
+            for abi_tag in abi_tags.split(".") for platform_tag in platform_tags.split(".")]
+    return canonical_package_name(parts[0]), parts[1].lower(), tags
+
+
+# glibc version the legacy manylinux tags stand for.
+MANYLINUX_ALIASES = {"manylinux1": (2, 5), "manylinux2010": (2, 12), "manylinux2014": (2, 17)}
+
+
+def parse_manylinux_tag(platform_tag: str) -> Optional[Tuple[int, int, str]]:
+    match = re.match(r"manylinux_(\d+)_(\d+)_(.+)$", platform_tag)
+    if match is not None:
+        return int(match.group(1)), int(match.group(2)), match.group(3)
+    match = re.match(r"(manylinux1|manylinux2010|manylinux2014)_(.+)$", platform_tag)
+    if match is not None:
+        return (*MANYLINUX_ALIASES[match.group(1)], match.group(2))
+    return None
+
+
+# a manylinux wheel runs on any target of the same architecture with at least its glibc version.
+def is_platform_compatible(platform_tag: str, platforms: List[str]) -> bool:
+    if platform_tag == "any" or platform_tag in platforms:
+        return True
+    wheel_manylinux = parse_manylinux_tag(platform_tag)
+    if wheel_manylinux is None:
+        return False
+    for platform in platforms:
+        target_manylinux = parse_manylinux_tag(platform)
+        if target_manylinux is not None and target_manylinux[2] == wheel_manylinux[2] \
+                and wheel_manylinux[:2] <= target_manylinux[:2]:
+            return True
+    return False
+
+
+def is_tag_compatible(tag: WheelTag, python_version: str, platforms: List[str]) -> bool:
+    python_tag, abi_tag, platform_tag = tag
+    major, minor = python_version.split(".")[:2]
+    if python_tag in (f"py{major}", f"py{major}{minor}"):
+        python_compatible = abi_tag == "none"
+    elif python_tag == f"cp{major}{minor}":
+        python_compatible = abi_tag in ("none", "abi3", f"cp{major}{minor}")
+    else:
+        # stable abi wheels built for an older python run on newer ones.
+        match = re.match(rf"cp{major}(\d+)$", python_tag)
+        python_compatible = match is not None and int(match.group(1)) <= int(minor) and abi_tag == "abi3"
+    return python_compatible and is_platform_compatible(platform_tag, platforms)
+
+
+# the wheel of exactly package==version in directory that runs on the target python version and platforms.
+def find_cached_wheel(directory: str, package: str, version: str, python_version: str,
+                      platforms: List[str]) -> Optional[str]:
+    if not os.path.exists(directory):
+        return None
+    for filename in sorted(os.listdir(directory)):
+        parsed = parse_wheel_filename(filename)
+        if parsed is None:
+            continue
+        name, wheel_version, tags = parsed
+        if name == canonical_package_name(package) and wheel_version == version.lower() \
+                and any(is_tag_compatible(tag, python_version, platforms) for tag in tags):
+            return os.path.join(directory, filename)
+    return None
+
+
+def fetch_wheel(package: str, version: str, python_version: str, platforms: List[str], wheel_cache_dir: str,
+                wheelhouse: Optional[str], offline: bool) -> str:
+    platform_dir = os.path.join(wheel_cache_dir, f"cp{python_version.replace('.', '')}-{'.'.join(platforms)}")
+    wheel = find_cached_wheel(platform_dir, package, version, python_version, platforms)
+    if wheel is not None:
+        return wheel
+    os.makedirs(platform_dir, exist_ok=True)
+    wheel = find_cached_wheel(wheelhouse, package, version, python_version, platforms) \
+        if wheelhouse is not None else None
+    if wheel is not None:
+        shutil.copy2(wheel, platform_dir)
+        return os.path.join(platform_dir, os.path.basename(wheel))
+    index_options = pip_index_options(platform_dir, wheelhouse, offline)
+    command = [sys.executable, "-m", "pip", "download", "--no-deps", "--quiet", "--dest", platform_dir,
+               *pip_platform_options(python_version, platforms), *index_options, f"{package}=={version}"]
+    if subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE).returncode != 0:
+        build_wheel(package, version, python_version, platform_dir, index_options)
+    wheel = find_cached_wheel(platform_dir, package, version, python_version, platforms)
+    if wheel is None:
+        raise Exception(f"could not fetch a wheel for {package}=={version}")
+    return wheel
+
+
+# pure python wheels run anywhere, whatever machine built them.
+def is_pure_wheel(filename: str, python_version: str) -> bool:
+    parsed = parse_wheel_filename(filename)
+    return parsed is not None and any(is_tag_compatible(tag, python_version, []) for tag in parsed[2])
+
+
+# No wheel was published for the target platform, one is built from the source distribution. pip builds it for this
+# machine, so only a pure python wheel is kept, a package with compiled extensions needs a wheel built for the target
+# (in a lambda image, or by a ci job) put in the wheelhouse.
+def build_wheel(package: str, version: str, python_version: str, platform_dir: str, index_options: List[str]) -> None:
+    with tempfile.TemporaryDirectory() as build_dir:
+        command = [sys.executable, "-m", "pip", "wheel", "--no-deps", "--quiet", "--wheel-dir", build_dir,
+                   *index_options, f"{package}=={version}"]
+        result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            raise Exception(f"could not fetch or build a wheel for {package}=={version}:\n"
+                            f"{result.stderr.decode('utf-8', 'replace')}")
+        for filename in os.listdir(build_dir):
+            if not is_pure_wheel(filename, python_version):
+                raise Exception(f"{package}=={version} has no wheel for the target platform and its source "
+                                f"distribution builds {filename} for this machine. Put a wheel built for the target "
+                                f"in the wheelhouse.")
+            shutil.move(os.path.join(build_dir, filename), os.path.join(platform_dir, filename))
+
+
+def install_wheel(wheel_path: str, target: str) -> None:
+    # installing into a target directory is unpacking the wheel, the purelib and platlib parts of the .data directory
+    # belong at the root. Scripts, headers and data files are not needed on a lambda.
+    with zipfile.ZipFile(wheel_path) as wheel:
+        for member in wheel.infolist():
+            parts = member.filename.split("/")
+            if parts[0].endswith(".data"):
+                if len(parts) < 3 or parts[1] not in ("purelib", "platlib"):
+                    continue
+                relative_path = "/".join(parts[2:])
+            else:
+                relative_path = member.filename
+            if member.is_dir() or not relative_path:
+                continue
+            destination = os.path.join(target, relative_path)
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            with wheel.open(member) as source, open(destination, "wb") as file:
+                shutil.copyfileobj(source, file)
+
+
+def install_requirements(requirements: Requirements, target: str, runtime: str = "python3.10",
+                         platforms: Optional[List[str]] = None, wheel_cache_dir: Optional[str] = None,
+                         wheelhouse: Optional[str] = None, offline: bool = False,
+                         max_workers: int = 8) -> Dict[str, Any]:
+    python_version = runtime_python_version(runtime)
+    platforms = platforms or DEFAULT_PLATFORMS
+    wheel_cache_dir = wheel_cache_dir or WHEEL_CACHE_DIR
+    os.makedirs(wheel_cache_dir, exist_ok=True)
+
+    start = time.monotonic()
+    resolved = resolve_requirements(requirements, python_version, platforms, wheel_cache_dir, wheelhouse, offline)
+    resolve_seconds = time.monotonic() - start
+
+    def fetch_and_install(package: str, version: str) -> Dict[str, Any]:
+        fetch_start = time.monotonic()
+        wheel = fetch_wheel(package, version, python_version, platforms, wheel_cache_dir, wheelhouse, offline)
+        install_start = time.monotonic()
+        install_wheel(wheel, target)
+        return {"package": package, "version": version, "wheel": os.path.basename(wheel),
+                "fetch_seconds": install_start - fetch_start, "install_seconds": time.monotonic() - install_start}
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        packages = list(executor.map(lambda item: fetch_and_install(*item), resolved.items()))
+    return {"resolve_seconds": resolve_seconds, "total_seconds": time.monotonic() - start, "packages": packages}
+
+
+def print_build_report(report: Dict[str, Any]) -> None:
+    print(f"resolved in {report['resolve_seconds']:.2f}s, built in {report['total_seconds']:.2f}s")
+    for package in sorted(report["packages"], key=lambda p: -(p["fetch_seconds"] + p["install_seconds"])):
+        print(f"  {package['package']}=={package['version']}: fetch {package['fetch_seconds']:.2f}s, "
+              f"install {package['install_seconds']:.2f}s")
+
+
 def get_project_reqs() -> Dict[str, str]:
     command = [sys.executable, "-m", "pip", "freeze"]
     output_str = subprocess.check_output(command).decode('utf-8')
@@ -97,25 +375,6 @@ def hash_env(requirements: Requirements) -> str:
     return sha_signature
 
 
-def install_package(package_name: str, version: str) -> None:
-    command = [sys.executable, "-m", "pip", "install", "--target", f"./", f"{package_name}=={version}"]
-    p = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    for line in iter(p.stdout.readline, b''):
-        pass
-    #     # print(line.decode('utf-8'))
-    p.stdout.close()
-    p.wait()
-
-
-def zip_directory(directory_path: str, output_path: str) -> None:
-    with zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, _, files in os.walk(directory_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                arcname = os.path.relpath(file_path, directory_path)
-                zipf.write(file_path, arcname)
-
-
 def get_file(path: str) -> bytes:
     with open(path, 'rb') as file:
         return file.read()
@@ -126,60 +385,6 @@ def write_file(path: str, data: bytes) -> None:
         file.write(data)
 
 
-FileStructure = Dict[str, Union[bytes, 'FileStructure']]
-
-
-def get_python_project_structure(path: str, excluded_file_names: Union[List[str], Set[str]],
-                                 exclude_reg_exp: str) -> FileStructure:
-    excluded_file_names = set(excluded_file_names)
-    acc = {}
-    relevant_files = [filename for filename in os.listdir(path) if
-                      (os.path.isdir(os.path.join(path, filename)) or
-                       filename[-3:] == ".py") and
-                      filename not in excluded_file_names and
-                      re.match(exclude_reg_exp, filename) is None]
-    for filename in relevant_files:
-        full_path = os.path.join(path, filename)
-        if os.path.isdir(os.path.join(path, filename)):
-            acc[filename] = get_python_project_structure(full_path, excluded_file_names, exclude_reg_exp)
-        else:
-            acc[filename] = get_file(full_path)
-    return acc
-
-
-def is_function_in_file(file_bytes: bytes, func_name: str) -> bool:
-    tree = ast.parse(file_bytes.decode('utf-8'))
-    for node in ast.walk(tree):
-        if (isinstance(node, ast.FunctionDef) or isinstance(node, ast.AsyncFunctionDef)) and node.name == func_name:
-            return True
-    return False
-
-
-def find_file_with_function(func_name: str, file_structure: FileStructure) -> Optional[str]:
-    files = {name: file_bytes for name, file_bytes in file_structure.items() if isinstance(file_structure[name], bytes)}
-    for name, file_bytes in files.items():
-        if is_function_in_file(file_bytes, func_name):
-            return name
-    folders = {name: sub_structure for name, sub_structure in file_structure.items() if isinstance(sub_structure, Dict)}
-    for name, sub_structure in folders.items():
-        result = find_file_with_function(func_name, sub_structure)
-        if result is not None:
-            return f"{name}/{result}"
-    return None
-
-
-def write_python_file_structure(path: str, file_structure: FileStructure) -> None:
-    for name, value in file_structure.items():
-        if isinstance(value, bytes):
-            write_file(os.path.join(path, name), value)
-        elif isinstance(value, Dict):
-            folder = os.path.join(path, name)
-            os.mkdir(folder)
-            write_python_file_structure(folder, value)
-        else:
-            raise Exception("Logic error with write_python_file_structure")
-
-
 def is_in_aws_lambda() -> bool:
     return "AWS_LAMBDA_FUNCTION_NAME" in os.environ
     # return True #(for mocking)
@@ -0,0 +1,7 @@
+# executed by test_symbols the way a notebook runs a cell, its functions do not point at this file.
+from tests.test_symbols import env
+
+
+@env.cloud_execute()
+def notebook_triple(n: int) -> int:
+    return 3 * n
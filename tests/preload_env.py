@@ -0,0 +1,16 @@
+import builtins
+import os
+
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+
+# counts the imports of this module in the process, kept in builtins so it outlives the module being forgotten.
+builtins.bauplan_preload_env_imports = getattr(builtins, "bauplan_preload_env_imports", 0) + 1
+
+# the functions of preload_first and preload_second run in one warm fake lambda container.
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False, preload_project=True)
+
+
+def imports() -> int:
+    return builtins.bauplan_preload_env_imports
@@ -0,0 +1,6 @@
+from tests.preload_env import env, imports
+
+
+@env.cloud_execute()
+def first() -> int:
+    return imports()
@@ -0,0 +1,64 @@
+import importlib.util
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import zipfile
+
+from src.bauplan.archive import PruneRules, build_archive
+
+# boto3 and what it imports, copied from the local interpreter to stand in for a built environment.
+BOTO3_MODULES = ("boto3", "botocore", "s3transfer", "jmespath", "dateutil", "urllib3", "six")
+
+
+class PruneRulesTest(unittest.TestCase):
+    def test_non_package_directories_are_pruned(self):
+        rules = PruneRules()
+        self.assertFalse(rules.keeps("numpy/tests/test_core.py"))
+        self.assertFalse(rules.keeps("requests/docs/index.html"))
+        self.assertFalse(rules.keeps("six.pyi"))
+        self.assertTrue(rules.keeps("six.py"))
+
+    def test_packages_are_kept(self):
+        rules = PruneRules()
+        self.assertTrue(rules.keeps("botocore/docs/__init__.py", {"botocore", "botocore/docs"}))
+        self.assertFalse(rules.keeps("botocore/docs/__init__.py", {"botocore"}))
+        self.assertFalse(PruneRules(prune_packages=True).keeps("botocore/docs/__init__.py", {"botocore/docs"}))
+
+    def test_dist_info_keeps_metadata(self):
+        rules = PruneRules()
+        self.assertTrue(rules.keeps("six-1.16.0.dist-info/METADATA"))
+        self.assertFalse(rules.keeps("six-1.16.0.dist-info/RECORD"))
+
+
+class PrunedArchiveTest(unittest.TestCase):
+    def test_boto3_imports_from_pruned_archive(self):
+        with tempfile.TemporaryDirectory() as directory:
+            source = os.path.join(directory, "source")
+            os.makedirs(source)
+            for name in BOTO3_MODULES:
+                origin = importlib.util.find_spec(name).origin
+                if os.path.basename(origin) == "__init__.py":
+                    shutil.copytree(os.path.dirname(origin), os.path.join(source, name),
+                                    ignore=shutil.ignore_patterns("__pycache__"))
+                else:
+                    shutil.copy(origin, source)
+            archive = os.path.join(directory, "layer.zip")
+            report = build_archive(source, archive, PruneRules(), prefix="python/")
+            self.assertGreater(report["pruned_files"], 0)
+            unpacked = os.path.join(directory, "opt")
+            with zipfile.ZipFile(archive) as file:
+                file.extractall(unpacked)
+            python_dir = os.path.join(unpacked, "python")
+            code = ("import sys; sys.path.insert(0, sys.argv[1]); import boto3, botocore.docs; "
+                    "assert boto3.__file__.startswith(sys.argv[1]), boto3.__file__; "
+                    "boto3.client('s3', region_name='us-east-1')")
+            result = subprocess.run([sys.executable, "-c", code, python_dir], stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            self.assertEqual(result.returncode, 0, result.stderr.decode())
+
+
+if __name__ == "__main__":
+    unittest.main()
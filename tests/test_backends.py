@@ -0,0 +1,67 @@
+import os
+import tempfile
+import unittest
+
+from src.bauplan.backends import WORKER_VARIABLE, ProcessPoolBackend
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.lambda_function import LocalBlobStore
+from src.bauplan.retries import RemoteError
+
+backend = ProcessPoolBackend(max_workers=2)
+env = LambdaBuilder("role", "local", "pool", backend=backend,
+                    blob_store=LocalBlobStore(tempfile.mkdtemp(prefix="bauplan-pool-")))
+
+
+@env.cloud_execute()
+def where() -> tuple:
+    return os.getpid(), WORKER_VARIABLE in os.environ
+
+
+@env.cloud_execute()
+def nested() -> tuple:
+    return os.getpid(), where()
+
+
+@env.cloud_execute()
+def where_of(_: int) -> tuple:
+    return where()
+
+
+@env.cloud_execute()
+def fail() -> None:
+    raise KeyError("missing")
+
+
+class ProcessPoolTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+
+    def test_calls_run_in_workers(self):
+        pid, in_worker = where()
+        self.assertNotEqual(pid, os.getpid())
+        self.assertTrue(in_worker)
+
+    def test_nested_calls_run_in_the_calling_worker(self):
+        invocations = backend.invocations
+        pid, (nested_pid, _) = nested()
+        self.assertEqual(pid, nested_pid)
+        self.assertEqual(backend.invocations - invocations, 1)
+
+    def test_workers_are_reused(self):
+        pids = {pid for pid, _ in env.map(where_of, range(20), chunksize=1)}
+        self.assertLessEqual(len(pids), 2)
+        self.assertLessEqual(backend.workers_started, 2)
+
+    def test_exceptions(self):
+        with self.assertRaises(RemoteError) as raised:
+            fail()
+        self.assertEqual(raised.exception.error_type, "KeyError")
+
+    def test_jobs(self):
+        pid, in_worker = env.submit(where).result(30)
+        self.assertTrue(in_worker)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+from unittest import mock
+
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.resources import ResourceProfile
+
+
+class ConstructionTest(unittest.TestCase):
+    def test_construction_creates_no_clients(self):
+        with mock.patch("boto3.client") as client:
+            builder = LambdaBuilder("role", "us-east-1", "function", s3_bucket="bucket")
+            self.assertEqual(builder.blob_store.spec()["bucket"], "bucket")
+            self.assertEqual(builder.result_store.spec()["prefix"], "bauplan/jobs/")
+            client.assert_not_called()
+            builder.blob_store.client
+            client.assert_called_once_with("s3")
+
+
+class DecorationTest(unittest.TestCase):
+    def test_incorrect_decorations_register_nothing(self):
+        builder = LambdaBuilder("role", "us-east-1", "function")
+
+        def plain() -> None:
+            pass
+
+        async def coroutine() -> None:
+            pass
+
+        for decorate, func in ((builder.aio_cloud_execute, plain), (builder.cloud_execute, coroutine)):
+            with self.assertRaises(Exception):
+                decorate(resources=ResourceProfile(timeout=900))(func)
+        self.assertEqual(builder._functions, [])
+        self.assertEqual(builder._function_resources, {})
+
+    def test_async_generators(self):
+        builder = LambdaBuilder("role", "us-east-1", "function")
+
+        @builder.aio_cloud_execute()
+        async def numbers():
+            yield 1
+
+        self.assertEqual(builder._functions, [numbers.__wrapped__])
+
+
+class ReadTimeoutTest(unittest.TestCase):
+    def read_timeout(self, builder: LambdaBuilder) -> int:
+        with mock.patch("boto3.client") as client:
+            builder.engine.client
+        return client.call_args.kwargs["config"].read_timeout
+
+    def test_read_timeout_outlives_the_function_timeout(self):
+        self.assertEqual(self.read_timeout(LambdaBuilder("role", "us-east-1", "function")), 330)
+        self.assertEqual(self.read_timeout(LambdaBuilder("role", "us-east-1", "function", timeout=600)), 630)
+
+    def test_longest_profile_timeout(self):
+        builder = LambdaBuilder("role", "us-east-1", "function")
+
+        @builder.cloud_execute(resources=ResourceProfile(memory_size=1024, timeout=900))
+        def train() -> None:
+            pass
+
+        self.assertEqual(self.read_timeout(builder), 930)
+
+    def test_profiles_registered_after_the_first_call(self):
+        builder = LambdaBuilder("role", "us-east-1", "function")
+        self.assertEqual(self.read_timeout(builder), 330)
+
+        @builder.cloud_execute(resources=ResourceProfile(timeout=900))
+        def train() -> None:
+            pass
+
+        self.assertEqual(self.read_timeout(builder), 930)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import asyncio
+import os
+import tempfile
+import time
+import unittest
+import uuid
+from unittest import mock
+
+from src.bauplan.cache import DiskTier, MemoryTier, ResultCache, call_key
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False)
+
+
+@env.cloud_execute(cache=ResultCache([MemoryTier()]))
+def cube(n: int) -> int:
+    return n ** 3
+
+
+@env.cloud_execute(cache=ResultCache([MemoryTier()], ttl=0.3))
+def fresh(n: int) -> int:
+    return -n
+
+
+# a builder with a single invocation thread.
+single_env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False,
+                           thread_count_per_lambda=1)
+
+
+@single_env.aio_cloud_execute()
+async def aio_sleep(seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+@single_env.aio_cloud_execute(cache=ResultCache([MemoryTier()]))
+async def aio_cube(n: int) -> int:
+    return n ** 3
+
+
+class ResultCacheTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        single_env.shutdown()
+        client.shutdown()
+
+    def invocations(self) -> int:
+        return sum(client.invocations.values())
+
+    def test_hits_skip_the_invocation(self):
+        invocations = self.invocations()
+        stats = cube.cache.stats()
+        self.assertEqual([cube(2), cube(2), cube(3)], [8, 8, 27])
+        self.assertEqual(self.invocations() - invocations, 2)
+        self.assertEqual(cube.cache.stats()["hits"]["memory"] - stats["hits"]["memory"], 1)
+        self.assertEqual(cube.cache.stats()["misses"] - stats["misses"], 2)
+        self.assertEqual(cube.cache.stats()["sets"] - stats["sets"], 2)
+
+    def test_entries_expire(self):
+        invocations = self.invocations()
+        self.assertEqual([fresh(1), fresh(1)], [-1, -1])
+        self.assertEqual(self.invocations() - invocations, 1)
+        time.sleep(0.4)
+        self.assertEqual(fresh(1), -1)
+        self.assertEqual(self.invocations() - invocations, 2)
+
+    def test_changes_to_the_project_invalidate_entries(self):
+        self.assertEqual(cube(4), 64)
+        invocations = self.invocations()
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), f"scratch_{uuid.uuid4().hex}.py")
+        with open(path, "w") as file:
+            file.write("VALUE = 1\n")
+        self.addCleanup(os.remove, path)
+        self.assertEqual(cube(4), 64)
+        self.assertEqual(self.invocations() - invocations, 1)
+
+    def test_async_hits_do_not_wait_for_invocations_in_flight(self):
+        async def main():
+            await aio_cube(2)
+            sleeping = asyncio.ensure_future(aio_sleep(1.0))
+            await asyncio.sleep(0.1)
+            start = time.monotonic()
+            cubed = await aio_cube(2)
+            return cubed, time.monotonic() - start, await sleeping
+
+        cubed, seconds, _ = asyncio.run(main())
+        self.assertEqual(cubed, 8)
+        self.assertLess(seconds, 0.5)
+
+
+class TierTest(unittest.TestCase):
+    def test_hits_in_slower_tiers_fill_the_faster_ones(self):
+        disk = DiskTier(tempfile.mkdtemp(prefix="bauplan-cache-"))
+        ResultCache([disk]).set("key", [1, 2])
+        cache = ResultCache([MemoryTier(), disk])
+        self.assertEqual(cache.get("key"), (True, [1, 2]))
+        self.assertEqual(cache.get("key"), (True, [1, 2]))
+        self.assertEqual(cache.stats()["hits"], {"memory": 1, "disk": 1})
+
+    def test_cached_none_is_a_hit(self):
+        cache = ResultCache([MemoryTier()])
+        self.assertEqual(cache.get("key"), (False, None))
+        cache.set("key", None)
+        self.assertEqual(cache.get("key"), (True, None))
+
+    def test_memory_tier_bounds(self):
+        tier = MemoryTier(max_entries=2)
+        for key in "abc":
+            tier.set(key, key.encode(), None)
+        self.assertIsNone(tier.get("a"))
+        self.assertEqual(tier.get("c"), b"c")
+
+    def test_disk_tier_evicts_the_least_recently_used(self):
+        tier = DiskTier(tempfile.mkdtemp(prefix="bauplan-cache-"), max_bytes=100)
+        tier.set("old", b"x" * 60, None)
+        time.sleep(0.01)
+        tier.set("new", b"y" * 60, None)
+        self.assertIsNone(tier.get("old"))
+        self.assertEqual(tier.get("new"), b"y" * 60)
+
+    def test_disk_tier_directory_is_created_on_first_set(self):
+        directory = os.path.join(tempfile.mkdtemp(prefix="bauplan-cache-"), "cache")
+        tier = DiskTier(directory)
+        self.assertFalse(os.path.exists(directory))
+        self.assertIsNone(tier.get("key"))
+        tier.set("key", b"value", None)
+        self.assertEqual(tier.get("key"), b"value")
+
+    def test_default_disk_tier(self):
+        cwd = os.getcwd()
+        os.chdir(tempfile.mkdtemp(prefix="bauplan-cache-"))
+        self.addCleanup(os.chdir, cwd)
+        ResultCache()
+        self.assertEqual(os.listdir("."), [])
+        with mock.patch.dict(os.environ, {"AWS_LAMBDA_FUNCTION_NAME": "function"}):
+            self.assertEqual(DiskTier().directory, "/tmp/bauplan-cache")
+
+    def test_call_keys(self):
+        key = call_key("source", "f", "project", (1,), {"a": 2})
+        self.assertEqual(key, call_key("source", "f", "project", (1,), {"a": 2}))
+        self.assertNotEqual(key, call_key("edited", "f", "project", (1,), {"a": 2}))
+        self.assertNotEqual(key, call_key("source", "f", "edited", (1,), {"a": 2}))
+        self.assertNotEqual(key, call_key("source", "f", "project", (2,), {"a": 2}))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+from src.bauplan.lambda_function import LocalBlobStore, choose_codec, decode, decode_call, encode, encode_call
+
+
+class ChooseCodecTest(unittest.TestCase):
+    def test_small_payloads_are_raw(self):
+        self.assertEqual(choose_codec("auto", 100, b"a" * 100), "raw")
+
+    def test_large_compressible_payloads_use_zlib(self):
+        self.assertEqual(choose_codec("auto", 16 * 1024 * 1024, b"a" * 1024 * 1024), "zlib")
+
+    def test_large_incompressible_payloads_are_raw(self):
+        self.assertEqual(choose_codec("auto", 16 * 1024 * 1024, os.urandom(1024 * 1024)), "raw")
+
+    def test_lzma_is_only_used_when_asked_for(self):
+        self.assertEqual(choose_codec("lzma", 16 * 1024 * 1024), "lzma")
+
+    def test_unknown_codec(self):
+        with self.assertRaises(Exception):
+            choose_codec("brotli", 100)
+
+
+class EncodeTest(unittest.TestCase):
+    def test_round_trip(self):
+        for value in [1, "text" * 10_000, os.urandom(1024 * 1024), {"a": [1, 2, 3]}]:
+            envelope = encode(value)
+            self.assertEqual(decode(envelope), value)
+
+    def test_out_of_band_buffers_are_probed(self):
+        data = bytearray(os.urandom(1024 * 1024))
+        envelope = encode(pickle.PickleBuffer(data))
+        self.assertEqual(envelope["codec"], "raw")
+        self.assertEqual(bytes(decode(envelope)), bytes(data))
+
+
+# counts how many times it is pickled.
+class Counted:
+    pickled = 0
+
+    def __init__(self, size: int):
+        self.data = os.urandom(size)
+
+    def __reduce__(self):
+        Counted.pickled += 1
+        return Counted.restore, (self.data,)
+
+    @staticmethod
+    def restore(data: bytes) -> "Counted":
+        value = Counted(0)
+        value.data = data
+        return value
+
+
+class EncodeCallTest(unittest.TestCase):
+    def setUp(self):
+        self.store = LocalBlobStore(tempfile.mkdtemp(prefix="bauplan-codecs-"))
+
+    def test_round_trip_without_a_blob_store(self):
+        call, offloaded = encode_call((1, "two"), {"three": [3]})
+        self.assertEqual(offloaded, {"args": {}, "kwargs": {}})
+        self.assertEqual(decode_call(call, offloaded), ((1, "two"), {"three": [3]}))
+
+    def test_large_arguments_are_offloaded(self):
+        large = os.urandom(64 * 1024)
+        buffer = bytearray(os.urandom(64 * 1024))
+        call, offloaded = encode_call((1, large), {"small": "s", "buffer": buffer}, blob_store=self.store,
+                                      offload_threshold=32 * 1024)
+        self.assertEqual(set(offloaded["args"]), {"1"})
+        self.assertEqual(set(offloaded["kwargs"]), {"buffer"})
+        self.assertLess(len(call["data"]), 1024)
+        args, kwargs = decode_call(call, offloaded, self.store)
+        self.assertEqual(args, (1, large))
+        self.assertEqual(kwargs, {"small": "s", "buffer": buffer})
+
+    def test_offloaded_arguments_are_deduplicated(self):
+        large = os.urandom(64 * 1024)
+        _, first = encode_call((large, 1), {}, blob_store=self.store, offload_threshold=32 * 1024)
+        _, second = encode_call((large, 2), {}, blob_store=self.store, offload_threshold=32 * 1024)
+        self.assertEqual(first["args"]["0"]["blob"], second["args"]["0"]["blob"])
+        self.assertEqual(len(self.store.list_keys("")), 1)
+
+    def test_arguments_are_pickled_once(self):
+        Counted.pickled = 0
+        small, large = Counted(16), Counted(64 * 1024)
+        call, offloaded = encode_call((small,), {"large": large}, blob_store=self.store, offload_threshold=32 * 1024)
+        self.assertEqual(Counted.pickled, 2)
+        self.assertEqual(set(offloaded["kwargs"]), {"large"})
+        args, kwargs = decode_call(call, offloaded, self.store)
+        self.assertEqual((args[0].data, kwargs["large"].data), (small.data, large.data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import os
+import sys
+import unittest
+from unittest import mock
+
+from src.bauplan import lambda_builder
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.lambda_function import CONTEXT_MAGIC, is_context_supported, load_context, make_context
+from src.bauplan.local_lambda import FakeLambdaClient
+
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False)
+
+
+@env.cloud_execute()
+def negate(n: int) -> int:
+    return -n
+
+
+# compiled contexts as another interpreter version would tag them.
+def make_foreign_context(source: str, filename: str, compiled: bool) -> dict:
+    context = make_context(source, filename, compiled)
+    return {**context, "magic": "00000000"} if compiled else context
+
+
+class ContextTest(unittest.TestCase):
+    def test_compiled_contexts(self):
+        context = make_context("VALUE = 1\n", "module.py", True)
+        self.assertEqual(context["magic"], CONTEXT_MAGIC)
+        self.assertNotIn("source", context)
+        self.assertTrue(is_context_supported(context))
+        namespace = {}
+        exec(load_context(context), namespace)
+        self.assertEqual(namespace["VALUE"], 1)
+
+    def test_source_contexts(self):
+        context = make_context("VALUE = 2\n", "module.py", False)
+        self.assertTrue(is_context_supported({**context, "magic": "00000000"}))
+        self.assertEqual(load_context(context).co_filename, "module.py")
+
+    def test_foreign_compiled_contexts_are_not_supported(self):
+        self.assertFalse(is_context_supported(make_foreign_context("VALUE = 1\n", "module.py", True)))
+
+    def test_other_runtimes_get_source(self):
+        self.assertFalse(LambdaBuilder("role", "local", "bauplan", runtime="python2.7").ship_compiled_contexts)
+        runtime = f"python{sys.version_info.major}.{sys.version_info.minor}"
+        self.assertTrue(LambdaBuilder("role", "local", "bauplan", runtime=runtime).ship_compiled_contexts)
+
+
+class UnsupportedContextTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def test_falls_back_to_source(self):
+        env.ship_compiled_contexts = True
+        invocations = sum(client.invocations.values())
+        with mock.patch.object(lambda_builder, "make_context", make_foreign_context):
+            self.assertEqual(negate(3), -3)
+        # the container answered unsupported_context and the call was sent again with source.
+        self.assertEqual(sum(client.invocations.values()) - invocations, 2)
+        self.assertFalse(env.ship_compiled_contexts)
+        invocations = sum(client.invocations.values())
+        self.assertEqual(negate(4), -4)
+        self.assertEqual(sum(client.invocations.values()) - invocations, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import contextlib
+import io
+import json
+import os
+import tempfile
+import unittest
+import zipfile
+from typing import Dict
+
+from src.bauplan.archive import PruneRules
+from src.bauplan.deploy import LIVE_ALIAS, Deployer, layer_key
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import LocalLambdaClient
+from src.bauplan.manifest import DeploymentManifest
+from src.bauplan.utils import hash_env
+
+HANDLER = """
+import dependency
+
+def lambda_handler(event, context):
+    return {"handler": %r, "dependency": dependency.VERSION, "version": context.function_version}
+"""
+
+
+def make_zip(files: Dict[str, str]) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return buffer.getvalue()
+
+
+class DeployerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.client = LocalLambdaClient(os.path.join(self.directory, "lambda"))
+        self.addCleanup(self.client.shutdown)
+
+    def write(self, name: str, files: Dict[str, str]) -> str:
+        path = os.path.join(self.directory, name)
+        with open(path, "wb") as file:
+            file.write(make_zip(files))
+        return path
+
+    def deploy(self, handler: str = "v1", dependency: str = "1", memory_size: int = 256,
+               keep_versions: int = 3) -> str:
+        deployer = Deployer(self.client, "function", lambda: "arn:aws:iam::000000000000:role/local",
+                            memory_size=memory_size, keep_versions=keep_versions)
+        layer = self.write(f"layer-{dependency}.zip", {"python/dependency.py": f"VERSION = {dependency!r}\n"})
+        with contextlib.redirect_stdout(io.StringIO()):
+            return deployer.deploy(f"environment-{dependency}", layer,
+                                   self.write(f"handler-{handler}.zip", {"lambda_function.py": HANDLER % handler}))
+
+    def invoke(self) -> Dict[str, str]:
+        response = self.client.invoke(FunctionName="function", Qualifier=LIVE_ALIAS, Payload=b"{}")
+        return json.loads(response["Payload"].read())
+
+    def versions(self):
+        return [version["Version"] for version in
+                self.client.list_versions_by_function(FunctionName="function")["Versions"]]
+
+    def test_create(self):
+        self.assertEqual(self.deploy(), "1")
+        self.assertEqual(self.client.get_alias(FunctionName="function", Name=LIVE_ALIAS)["FunctionVersion"], "1")
+        self.assertEqual(self.invoke(), {"handler": "v1", "dependency": "1", "version": "1"})
+
+    def test_unchanged_deploy_publishes_nothing(self):
+        self.deploy()
+        self.assertEqual(self.deploy(), "1")
+        self.assertEqual(self.versions(), ["$LATEST", "1"])
+
+    def test_handler_update_flips_alias(self):
+        self.deploy()
+        self.assertEqual(self.invoke()["handler"], "v1")
+        self.assertEqual(self.deploy(handler="v2"), "2")
+        self.assertEqual(self.client.get_alias(FunctionName="function", Name=LIVE_ALIAS)["FunctionVersion"], "2")
+        self.assertEqual(self.invoke(), {"handler": "v2", "dependency": "1", "version": "2"})
+        # updated in place, the previous version is still there.
+        self.assertEqual(self.client.get_function(FunctionName="function", Qualifier="1")["Configuration"]["Version"],
+                         "1")
+
+    def test_configuration_and_layer_updates(self):
+        self.deploy()
+        self.assertEqual(self.deploy(memory_size=512), "2")
+        self.assertEqual(self.client.get_function(FunctionName="function", Qualifier=LIVE_ALIAS)
+                         ["Configuration"]["MemorySize"], 512)
+        self.assertEqual(self.deploy(memory_size=512, dependency="2"), "3")
+        self.assertEqual(self.invoke()["dependency"], "2")
+
+    def test_layers_are_reused_per_key(self):
+        self.deploy()
+        self.deploy(handler="v2")
+        self.assertEqual(sum(len(versions) for versions in self.client.layers.values()), 1)
+        self.deploy(handler="v2", dependency="2")
+        self.assertEqual(sum(len(versions) for versions in self.client.layers.values()), 2)
+
+    def test_old_versions_are_pruned(self):
+        for index in range(5):
+            self.deploy(handler=f"v{index}", keep_versions=2)
+        self.assertEqual(self.versions(), ["$LATEST", "3", "4", "5"])
+        self.assertEqual(self.invoke()["handler"], "v4")
+
+
+class LayerKeyTest(unittest.TestCase):
+    def test_archive_options_change_the_key(self):
+        key = layer_key("environment")
+        self.assertEqual(key, layer_key("environment", PruneRules()))
+        self.assertNotEqual(key, layer_key("other environment"))
+        self.assertNotEqual(key, layer_key("environment", PruneRules(exclude_dirs=())))
+        self.assertNotEqual(key, layer_key("environment", PruneRules(prune_packages=True)))
+        self.assertNotEqual(key, layer_key("environment", compile_for="python3.10"))
+
+
+# the environment is installed ahead of time, so deploys only archive it and never run pip.
+class BuilderLayerTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.client = LocalLambdaClient(os.path.join(self.directory, "lambda"))
+        self.addCleanup(self.client.shutdown)
+        environment = os.path.join(self.directory, "packages", hash_env({"dill": "0.3.6"}), "dill")
+        os.makedirs(os.path.join(environment, "tests"))
+        for path in ("__init__.py", "tests/__init__.py"):
+            with open(os.path.join(environment, path), "w") as file:
+                file.write("")
+
+    def deploy(self, prune_rules: PruneRules) -> str:
+        builder = LambdaBuilder("arn:aws:iam::000000000000:role/local", "local", "function", requirements={},
+                                package_dir=os.path.join(self.directory, "packages"), prune_rules=prune_rules,
+                                lambda_client=self.client,
+                                manifest=DeploymentManifest(os.path.join(self.directory, "deployments.json")))
+        with contextlib.redirect_stdout(io.StringIO()):
+            return builder.deploy()
+
+    def test_prune_rules_change_publishes_a_layer(self):
+        self.assertEqual(self.deploy(PruneRules()), "1")
+        self.assertEqual(self.deploy(PruneRules()), "1")
+        self.assertEqual(len(self.client.layers), 1)
+        self.assertEqual(self.deploy(PruneRules(prune_packages=True)), "2")
+        self.assertEqual(len(self.client.layers), 2)
+        layer = self.client.get_function(FunctionName="function", Qualifier=LIVE_ALIAS)["Configuration"]["Layers"]
+        with zipfile.ZipFile(io.BytesIO(self.client._layer_data(layer[0]["Arn"]))) as archive:
+            self.assertNotIn("python/dill/tests/__init__.py", archive.namelist())
+
+
+if __name__ == "__main__":
+    unittest.main()
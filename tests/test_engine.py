@@ -0,0 +1,95 @@
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from src.bauplan.engine import InvocationEngine, TokenBucket
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+
+# a function whose concurrency is used up by a single invocation, lambda throttles the others.
+client = FakeLambdaClient(max_concurrency=1) if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False)
+
+
+@env.cloud_execute()
+def pause(seconds: float) -> float:
+    time.sleep(seconds)
+    return seconds
+
+
+# calls made at once from threads of their own, the way unrelated parts of a driver would.
+def call_at_once(calls: int, seconds: float) -> list:
+    with ThreadPoolExecutor(calls) as threads:
+        return list(threads.map(pause, [seconds] * calls))
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_bursts_then_rate(self):
+        bucket = TokenBucket(rate=20, capacity=2)
+        start = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        # two tokens are available right away, the other four come at 20 per second.
+        self.assertGreaterEqual(time.monotonic() - start, 0.18)
+        self.assertLess(time.monotonic() - start, 1.0)
+
+    def test_default_capacity(self):
+        self.assertEqual(TokenBucket(rate=0.5).capacity, 1.0)
+        self.assertEqual(TokenBucket(rate=10).capacity, 10)
+
+
+class EngineTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # warms the container so later calls do not pay for starting it.
+        pause(0)
+
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def use_engine(self, **params) -> InvocationEngine:
+        engine = InvocationEngine(client=client, **params)
+        self.addCleanup(engine.shutdown)
+        env.engine = engine
+        return engine
+
+    def test_in_flight_invokes_are_capped(self):
+        engine = self.use_engine(max_concurrency=1)
+        throttles = client.throttles
+        self.assertEqual(call_at_once(4, 0.1), [0.1] * 4)
+        self.assertEqual(client.throttles, throttles)
+        self.assertEqual(engine.throttled, 0)
+
+    def test_throttles_are_retried_with_backoff(self):
+        engine = self.use_engine(max_concurrency=4, base_backoff=0.05, max_throttle_retries=20)
+        throttles = client.throttles
+        self.assertEqual(call_at_once(4, 0.1), [0.1] * 4)
+        self.assertGreater(engine.throttled, 0)
+        self.assertEqual(engine.throttled, client.throttles - throttles)
+
+    def test_throttles_beyond_the_retries_are_raised(self):
+        self.use_engine(max_concurrency=4, max_throttle_retries=0)
+        with self.assertRaises(ClientError) as raised:
+            call_at_once(4, 0.2)
+        self.assertEqual(raised.exception.response["Error"]["Code"], "TooManyRequestsException")
+
+    def test_rate_limit(self):
+        self.use_engine(max_concurrency=1, rate=10, burst=1)
+        start = time.monotonic()
+        self.assertEqual(call_at_once(4, 0), [0] * 4)
+        self.assertGreaterEqual(time.monotonic() - start, 0.28)
+
+    def test_backoff_is_jittered_and_bounded(self):
+        engine = InvocationEngine(client=client, base_backoff=0.1, max_backoff=1.0)
+        self.addCleanup(engine.shutdown)
+        for attempt in range(10):
+            self.assertLessEqual(engine.backoff_seconds(attempt), min(1.0, 0.1 * 2 ** attempt))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import os
+import sys
+import unittest
+
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False)
+
+
+# what the handler of the container running the call holds: the namespace the function runs in, and the contexts it
+# executed and the code objects it loaded.
+def handler_state() -> tuple:
+    handler = sys.modules["lambda_function"]
+    return id(globals()), sorted(key[2] for key in handler.execution_cache), len(handler.code_cache)
+
+
+@env.cloud_execute()
+def first() -> tuple:
+    return handler_state()
+
+
+@env.cloud_execute()
+def second() -> tuple:
+    return handler_state()
+
+
+class ExecutionCacheTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def test_repeat_calls_reuse_the_executed_context(self):
+        namespace, _, _ = first()
+        self.assertEqual(first()[0], namespace)
+        self.assertEqual(client.cold_starts, 1)
+
+    def test_functions_of_one_file_share_its_code_object(self):
+        first_namespace, _, _ = first()
+        second_namespace, functions, code_objects = second()
+        # each function has an executed context of its own, the file is loaded once.
+        self.assertNotEqual(first_namespace, second_namespace)
+        self.assertEqual(functions, ["first", "second"])
+        self.assertEqual(code_objects, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import unittest
+import uuid
+
+from src.bauplan.imports import ImportGraph, module_files, parse_imports
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+from src.bauplan.snapshot import ProjectSnapshot
+
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False,
+                    include=["tests/scratch_*.json"])
+
+
+@env.cloud_execute()
+def read_data(relative_path: str) -> str:
+    with open(relative_path) as file:
+        return file.read()
+
+
+PROJECT = {
+    "main.py": "import json\nfrom pkg import mod\n",
+    "pkg/__init__.py": "",
+    "pkg/mod.py": "from . import util\n\ndef load():\n    import importlib\n    importlib.import_module('plugins.fast')\n",
+    "pkg/util.py": "",
+    "plugins/__init__.py": "",
+    "plugins/fast.py": "",
+    "plugins/slow.py": "",
+    "unrelated.py": "import main\n",
+    "data/config.json": "{}",
+}
+
+
+class ImportGraphTest(unittest.TestCase):
+    def setUp(self):
+        root = tempfile.mkdtemp(prefix="bauplan-imports-")
+        for relative_path, content in PROJECT.items():
+            os.makedirs(os.path.dirname(os.path.join(root, relative_path)), exist_ok=True)
+            with open(os.path.join(root, relative_path), "w") as file:
+                file.write(content)
+        self.snapshot = ProjectSnapshot(root)
+        self.snapshot.track(["data/*.json"])
+        self.snapshot.refresh()
+        self.graph = ImportGraph(self.snapshot)
+
+    def test_closure(self):
+        self.assertEqual(self.graph.closure("main.py"), {
+            "main.py", "pkg/__init__.py", "pkg/mod.py", "pkg/util.py", "plugins/__init__.py", "plugins/fast.py"})
+
+    def test_include(self):
+        closure = self.graph.closure("main.py", ["plugins/*.py", "data/*"])
+        self.assertIn("plugins/slow.py", closure)
+        self.assertIn("data/config.json", closure)
+        self.assertNotIn("unrelated.py", closure)
+
+    def test_files_outside_the_project(self):
+        self.assertIsNone(self.graph.closure("missing.py"))
+
+    def test_relative_imports(self):
+        self.assertEqual(parse_imports(b"from .. import a\nfrom .b import c\n", "x/y/z.py"),
+                         ["x", "x.a", "x.y.b", "x.y.b.c"])
+
+    def test_module_files(self):
+        files = {"a/__init__.py", "a/b.py", "c.py"}
+        self.assertEqual(module_files("a.b", files), ["a/__init__.py", "a/b.py"])
+        self.assertEqual(module_files("c.d", files), ["c.py"])
+        self.assertEqual(module_files("os.path", files), [])
+
+
+class SlicingTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def test_calls_ship_the_closure_and_included_files(self):
+        relative_path = f"tests/scratch_{uuid.uuid4().hex}.json"
+        with open(relative_path, "w") as file:
+            file.write('{"included": true}')
+        self.addCleanup(os.remove, relative_path)
+        files = env._prepare_function(read_data.__wrapped__).files
+        self.assertIn("tests/test_imports.py", files)
+        self.assertIn("src/bauplan/lambda_builder.py", files)
+        self.assertIn(relative_path, files)
+        self.assertNotIn("tests/test_map.py", files)
+        self.assertEqual(read_data(relative_path), '{"included": true}')
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from concurrent.futures import CancelledError
+
+from src.bauplan.backends import ProcessPoolBackend
+from src.bauplan.jobs import EVENT_PAYLOAD_LIMIT, as_completed
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.lambda_function import LocalBlobStore
+
+# one worker, jobs submitted behind a running one wait for it.
+env = LambdaBuilder("role", "local", "jobs", backend=ProcessPoolBackend(max_workers=1),
+                    blob_store=LocalBlobStore(tempfile.mkdtemp(prefix="bauplan-jobs-")))
+
+
+@env.cloud_execute()
+def square(n: int, seconds: float = 0.0) -> int:
+    time.sleep(seconds)
+    return n * n
+
+
+@env.cloud_execute()
+def size(data: bytes) -> int:
+    return len(data)
+
+
+def wait_for(condition, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("condition not met in time")
+        time.sleep(0.01)
+
+
+def tearDownModule():
+    env.shutdown()
+
+
+class CancelTest(unittest.TestCase):
+    def test_cancel_before_start(self):
+        running = env.submit(square, 2, 1.0)
+        queued = env.submit(square, 3)
+        self.assertTrue(queued.cancel())
+        with self.assertRaises(CancelledError):
+            queued.result()
+        self.assertEqual(running.result(30), 4)
+        # the lambda picks the job up eventually and skips it.
+        wait_for(lambda: env.result_store.exists(queued.result_key))
+        self.assertEqual(json.loads(env.result_store.get(queued.result_key)), {"cancelled": True})
+
+    def test_cancel_after_start(self):
+        job = env.submit(square, 4, 0.5)
+        wait_for(lambda: env.result_store.exists(job.start_key))
+        self.assertFalse(job.cancel())
+        self.assertFalse(job.is_cancelled)
+        self.assertEqual(job.result(30), 16)
+
+    def test_cancel_after_finish(self):
+        job = env.submit(square, 5)
+        self.assertEqual(job.result(30), 25)
+        self.assertFalse(job.cancel())
+        self.assertEqual(job.result(), 25)
+
+
+class CleanupTest(unittest.TestCase):
+    def test_keys_are_deleted_once_the_result_is_read(self):
+        job = env.submit(square, 6)
+        self.assertEqual(job.result(30), 36)
+        self.assertEqual(env.result_store.list_keys(f"job-{job.session}-{job.id}"), [])
+        self.assertFalse(env.result_store.exists(job.start_key))
+        self.assertEqual(job.result(), 36)
+
+    def test_as_completed_deletes_the_keys_it_reads(self):
+        jobs = [env.submit(square, n) for n in range(4)]
+        self.assertEqual(sorted(job.result() for job in as_completed(jobs, 30)), [0, 1, 4, 9])
+        keys = set(env.result_store.list_keys(f"job-{env.job_session}-"))
+        self.assertFalse(keys & {job.result_key for job in jobs})
+
+    def test_stored_requests_are_deleted(self):
+        # random bytes do not compress below the limit of an event.
+        job = env.submit(size, os.urandom(EVENT_PAYLOAD_LIMIT))
+        self.assertEqual(job.result(30), EVENT_PAYLOAD_LIMIT)
+        self.assertFalse(env.result_store.exists(job.request_key))
+        self.assertEqual(env.result_store.list_keys(f"request-{job.session}-{job.id}"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
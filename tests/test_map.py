@@ -0,0 +1,97 @@
+import asyncio
+import os
+import time
+import unittest
+
+from src.bauplan.lambda_builder import ChunkSizer, LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False, thread_count_per_lambda=4)
+
+
+# early elements are the slow ones, so later chunks finish first.
+@env.cloud_execute()
+def slow_square(n: int, slow_below: int = 0) -> int:
+    if n < slow_below:
+        time.sleep(0.2)
+    return n * n
+
+
+@env.cloud_execute()
+def add(a: int, b: int) -> int:
+    return a + b
+
+
+@env.aio_cloud_execute()
+async def aio_square(n: int) -> int:
+    return n * n
+
+
+class MapTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def invocations(self) -> int:
+        return sum(client.invocations.values())
+
+    def test_results_keep_the_input_order(self):
+        invocations = self.invocations()
+        results = list(env.starmap(slow_square, [(n, 5) for n in range(40)], chunksize=5))
+        self.assertEqual(results, [n * n for n in range(40)])
+        self.assertEqual(self.invocations() - invocations, 8)
+
+    def test_unordered_results(self):
+        results = list(env.starmap(slow_square, [(n, 5) for n in range(40)], chunksize=5, ordered=False))
+        self.assertEqual(sorted(results), [n * n for n in range(40)])
+        # the chunk of slow elements finishes last.
+        self.assertEqual(results[-5:], [n * n for n in range(5)])
+
+    def test_map_and_starmap(self):
+        self.assertEqual(list(env.map(slow_square, range(10))), [n * n for n in range(10)])
+        self.assertEqual(list(env.starmap(add, [(1, 2), (3, 4)])), [3, 7])
+
+    def test_lazy_inputs(self):
+        results = env.map(slow_square, iter(range(1000)), chunksize=100, max_concurrency=2)
+        self.assertEqual(next(results), 0)
+        self.assertEqual(sum(results), sum(n * n for n in range(1, 1000)))
+
+    def test_aio_map(self):
+        async def main():
+            return [result async for result in env.aio_map(aio_square, range(50), chunksize=7)]
+
+        self.assertEqual(asyncio.run(main()), [n * n for n in range(50)])
+
+
+class ChunkSizerTest(unittest.TestCase):
+    def test_chunks_aim_for_the_target_duration(self):
+        sizer = ChunkSizer(target_seconds=2.0, initial_chunksize=16)
+        self.assertEqual(sizer.next_chunksize(), 16)
+        sizer.observe(16, 0.16)
+        self.assertEqual(sizer.next_chunksize(), 200)
+
+    def test_latencies_are_smoothed(self):
+        sizer = ChunkSizer(target_seconds=1.0, smoothing=0.5)
+        sizer.observe(10, 1.0)
+        sizer.observe(10, 3.0)
+        # 0.1 then 0.3 seconds per element average to 0.2.
+        self.assertEqual(sizer.next_chunksize(), 5)
+
+    def test_bounds(self):
+        sizer = ChunkSizer(max_chunksize=100)
+        sizer.observe(10, 0.0)
+        self.assertEqual(sizer.next_chunksize(), 100)
+        sizer = ChunkSizer(smoothing=1.0)
+        sizer.observe(1, 60.0)
+        self.assertEqual(sizer.next_chunksize(), 1)
+
+    def test_fixed_chunksize(self):
+        sizer = ChunkSizer(chunksize=3)
+        sizer.observe(3, 30.0)
+        self.assertEqual(sizer.next_chunksize(), 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
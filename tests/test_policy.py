@@ -0,0 +1,80 @@
+import asyncio
+import unittest
+from typing import List
+from unittest import mock
+
+from src.bauplan import policy as policy_module
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+from src.bauplan.policy import ExecutionPolicy, get_current_invocation
+
+# calls made inside a container go through a fake client of their own, running nested containers.
+client = FakeLambdaClient()
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False)
+
+
+# the depth of the invocation running the call, 1 when it ran in process in the first lambda.
+@env.cloud_execute(policy=ExecutionPolicy(max_depth=1))
+def depth(_: int) -> int:
+    return get_current_invocation().depth
+
+
+@env.cloud_execute(policy=ExecutionPolicy(max_remote_calls=1))
+def budgeted_depth(_: int) -> int:
+    return get_current_invocation().depth
+
+
+@env.aio_cloud_execute(policy=ExecutionPolicy(max_depth=1))
+async def aio_depth(_: int) -> int:
+    return get_current_invocation().depth
+
+
+@env.cloud_execute()
+def map_depths(n: int, budgeted: bool = False) -> List[int]:
+    return list(env.map(budgeted_depth if budgeted else depth, range(n), chunksize=2, max_concurrency=1))
+
+
+@env.aio_cloud_execute()
+async def aio_map_depths(n: int) -> List[int]:
+    return [value async for value in env.aio_map(aio_depth, range(n), chunksize=2)]
+
+
+class FakeInvocation:
+    depth = 2
+
+    def remaining_ms(self) -> None:
+        return None
+
+    def take_remote_call(self, budget: int) -> bool:
+        return True
+
+
+class MapPolicyTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def test_chunks_past_the_max_depth_run_in_process(self):
+        self.assertEqual(map_depths(6), [1] * 6)
+
+    def test_chunks_past_the_remote_call_budget_run_in_process(self):
+        self.assertEqual(map_depths(6, True), [2, 2, 1, 1, 1, 1])
+
+    def test_async_chunks(self):
+        self.assertEqual(asyncio.run(aio_map_depths(6)), [1] * 6)
+
+    def test_the_local_driver_ships_every_chunk(self):
+        invocations = sum(client.invocations.values())
+        self.assertEqual(list(env.map(depth, range(4), chunksize=2)), [1] * 4)
+        self.assertGreaterEqual(sum(client.invocations.values()) - invocations, 2)
+
+    def test_chunk_cost(self):
+        policy = ExecutionPolicy(min_cost=10, cost=lambda n: n)
+        with mock.patch.object(policy_module, "get_current_invocation", FakeInvocation):
+            self.assertFalse(policy.should_run_chunk_remotely([((4,), {}), ((5,), {})]))
+            self.assertTrue(policy.should_run_chunk_remotely([((4,), {}), ((6,), {})]))
+
+
+if __name__ == "__main__":
+    unittest.main()
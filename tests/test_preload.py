@@ -0,0 +1,22 @@
+import unittest
+
+from tests.preload_env import client, env
+from tests.preload_first import first
+from tests.preload_second import second
+
+
+class PreloadTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def test_preloaded_functions_share_one_tree(self):
+        # the functions are defined in different files, each imports a different slice of the project.
+        client.publish_handler(env.handler_files())
+        # every call reports how many times the container imported preload_env: once, in the init phase.
+        self.assertEqual([first(), second(), first(), second()], [1, 1, 1, 1])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import os
+import tempfile
+import unittest
+
+from src.bauplan.resources import MemoryTuner, ResourceProfile, choose_memory_size, invocation_cost, \
+    records_from_spans, variant_name
+
+# duration in ms per memory size of a cpu bound function: twice the memory is twice as fast until 1024MB, more memory
+# barely helps past it.
+DURATIONS = {128: 4000, 256: 2000, 512: 1000, 1024: 400, 1769: 380, 3008: 370}
+
+
+def records(durations, function="train", samples=5):
+    return [{"function": function, "memory_size": memory_size, "duration_ms": duration_ms}
+            for memory_size, duration_ms in durations.items() for _ in range(samples)]
+
+
+class ChooseMemorySizeTest(unittest.TestCase):
+    def test_cost_picks_the_cheapest_size(self):
+        tuner = MemoryTuner.from_records(records(DURATIONS), objective="cost")
+        self.assertEqual(tuner.recommend("train"), 1024)
+
+    def test_latency_picks_the_fastest_size(self):
+        tuner = MemoryTuner.from_records(records(DURATIONS), objective="latency")
+        self.assertEqual(tuner.recommend("train"), 3008)
+
+    def test_cost_ties_go_to_the_faster_size(self):
+        # billed cost is the same at 128, 256 and 512MB.
+        tuner = MemoryTuner.from_records(records({128: 4000, 256: 2000, 512: 1000}))
+        self.assertEqual(tuner.recommend("train"), 512)
+
+    def test_sizes_short_of_min_samples_are_ignored(self):
+        tuner = MemoryTuner.from_records(records(DURATIONS, samples=2) + records({512: 1000}), min_samples=5)
+        self.assertEqual(tuner.recommend("train"), 512)
+        self.assertIsNone(MemoryTuner.from_records(records(DURATIONS, samples=2), min_samples=5).recommend("train"))
+
+    def test_map_chunks_are_compared_per_element(self):
+        chunks = [{"function": "score", "memory_size": 256, "duration_ms": 1000, "calls": 100},
+                  {"function": "score", "memory_size": 512, "duration_ms": 100, "calls": 1}]
+        tuner = MemoryTuner.from_records(chunks, min_samples=1, objective="latency")
+        self.assertEqual(tuner.summary("score")[256]["ms_per_call"], 10)
+        self.assertEqual(tuner.recommend("score"), 256)
+
+    def test_summary_costs(self):
+        summary = MemoryTuner.from_records(records({1024: 400}), min_samples=1).summary("train")
+        self.assertEqual(summary[1024]["samples"], 5)
+        self.assertAlmostEqual(summary[1024]["cost_per_call"], invocation_cost(1024, 400))
+        self.assertAlmostEqual(invocation_cost(1024, 1000, price_per_request=0), 0.0000166667)
+
+    def test_unknown_objective(self):
+        with self.assertRaises(Exception):
+            choose_memory_size({}, "throughput")
+
+
+class SwitchTest(unittest.TestCase):
+    def test_every_size_is_explored_before_switching(self):
+        tuner = MemoryTuner(memory_sizes=(256, 1024), min_samples=2, switch=True)
+        chosen = []
+        for _ in range(6):
+            memory_size = tuner.next_memory_size("train", 256)
+            chosen.append(memory_size)
+            tuner.record("train", memory_size, DURATIONS[memory_size])
+        self.assertEqual(chosen, [256, 1024, 256, 1024, 1024, 1024])
+
+    def test_without_switch_calls_keep_their_size(self):
+        tuner = MemoryTuner.from_records(records(DURATIONS))
+        self.assertEqual(tuner.next_memory_size("train", 256), 256)
+
+
+class PersistenceTest(unittest.TestCase):
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "tuning.json")
+            tuner = MemoryTuner(path=path)
+            for record in records(DURATIONS):
+                tuner.record(record["function"], record["memory_size"], record["duration_ms"])
+            tuner.save()
+            self.assertEqual(MemoryTuner(path=path).recommend("train"), 1024)
+
+    def test_records_from_spans(self):
+        spans = [{"kind": "handler", "name": "train", "memory_size": 1024, "duration_ms": 400.0, "calls": 1},
+                 {"kind": "client", "name": "train", "duration_ms": 450.0},
+                 {"kind": "handler", "name": "train", "memory_size": None, "duration_ms": 400.0}]
+        self.assertEqual(records_from_spans(spans),
+                         [{"function": "train", "memory_size": 1024, "duration_ms": 400.0, "calls": 1}])
+
+
+class VariantNameTest(unittest.TestCase):
+    def test_variant_names_fit_lambda_limits(self):
+        self.assertEqual(variant_name("function", ResourceProfile(1024, 900)), "function-1024mb-900s")
+        self.assertEqual(len(variant_name("f" * 80, ResourceProfile(3008, 900))), 64)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,244 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+from typing import List, Optional
+
+from src.bauplan.backends import ExecutionBackend, ProcessPoolBackend
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.lambda_function import LocalBlobStore
+from src.bauplan.local_lambda import throttled
+from src.bauplan.policy import get_idempotency_key
+from src.bauplan.resources import ResourceProfile
+from src.bauplan.retries import HedgePolicy, RemoteError, RetryPolicy
+
+
+# fails the invocations it is told to fail before they reach the pool, the way lambda or the network would.
+class FlakyBackend(ExecutionBackend):
+    def __init__(self, backend: ExecutionBackend):
+        self.backend = backend
+        self.max_concurrency = backend.max_concurrency
+        self.failures: List[Exception] = []
+        self.invocations = 0
+
+    def invoke(self, payload: bytes, resources: Optional[ResourceProfile] = None) -> bytes:
+        self.invocations += 1
+        if self.failures:
+            failure = self.failures.pop(0)
+            if isinstance(failure, RemoteError):
+                return json.dumps({"errorType": failure.error_type, "errorMessage": failure.message}).encode()
+            raise failure
+        return self.backend.invoke(payload, resources)
+
+    def submit(self, payload: bytes, resources: Optional[ResourceProfile] = None) -> None:
+        self.backend.submit(payload, resources)
+
+    def runs_nested_calls_in_process(self) -> bool:
+        return self.backend.runs_nested_calls_in_process()
+
+    def shutdown(self, wait: bool = True) -> None:
+        self.backend.shutdown(wait)
+
+
+backend = FlakyBackend(ProcessPoolBackend(max_workers=2))
+env = LambdaBuilder("role", "local", "retries", backend=backend, thread_count_per_lambda=2,
+                    blob_store=LocalBlobStore(tempfile.mkdtemp(prefix="bauplan-retries-")),
+                    retry=RetryPolicy(base_backoff=0.0))
+
+
+# numbers the invocations of a call made with the same directory, from 1, across processes.
+def attempt(directory: str) -> int:
+    number = 1
+    while True:
+        try:
+            os.mkdir(os.path.join(directory, str(number)))
+            return number
+        except FileExistsError:
+            number += 1
+
+
+def record_key(directory: str, number: int) -> None:
+    with open(os.path.join(directory, f"{number}.key"), "w") as file:
+        file.write(get_idempotency_key() or "")
+
+
+def recorded_keys(directory: str) -> List[str]:
+    keys = []
+    for name in sorted(os.listdir(directory)):
+        if name.endswith(".key"):
+            with open(os.path.join(directory, name)) as file:
+                keys.append(file.read())
+    return keys
+
+
+@env.cloud_execute()
+def fail(message: str) -> None:
+    raise ValueError(message)
+
+
+# raises until the call's attempt number reaches succeed_on.
+@env.cloud_execute(retry=RetryPolicy(user_retries=2, base_backoff=0.0))
+def flaky(directory: str, succeed_on: int, error: str = "ValueError") -> int:
+    number = attempt(directory)
+    record_key(directory, number)
+    if number < succeed_on:
+        raise {"ValueError": ValueError, "KeyError": KeyError}[error](f"attempt {number}")
+    return number
+
+
+@env.cloud_execute(retry=RetryPolicy(user_retries=2, retry_on=["KeyError"], base_backoff=0.0))
+def flaky_on_key_errors(directory: str, succeed_on: int, error: str) -> int:
+    number = attempt(directory)
+    if number < succeed_on:
+        raise {"ValueError": ValueError, "KeyError": KeyError}[error](f"attempt {number}")
+    return number
+
+
+@env.cloud_execute(retry=RetryPolicy(platform_retries=1, base_backoff=0.0))
+def echo(n: int) -> int:
+    return n
+
+
+# the first invocation of a call is slow and fails, its duplicates answer right away.
+@env.cloud_execute(hedge=HedgePolicy(min_samples=1, min_delay=0.2))
+def straggler(directory: str) -> int:
+    number = attempt(directory)
+    record_key(directory, number)
+    if number == 1:
+        time.sleep(2)
+        raise ValueError("the straggler lost")
+    return number
+
+
+@env.cloud_execute(hedge=HedgePolicy(min_samples=1, min_delay=0.2))
+def slow_numbers(directory: str, n: int):
+    attempt(directory)
+    for i in range(n):
+        time.sleep(0.2)
+        yield i
+
+
+@env.cloud_execute(hedge=HedgePolicy(min_samples=1, min_delay=0.2))
+def slow_job(directory: str) -> int:
+    number = attempt(directory)
+    time.sleep(1)
+    return number
+
+
+def tearDownModule():
+    env.shutdown()
+
+
+class RetryTest(unittest.TestCase):
+    def setUp(self):
+        backend.failures = []
+        backend.invocations = 0
+        self.directory = tempfile.mkdtemp(prefix="bauplan-attempts-")
+
+    def test_remote_exception(self):
+        with self.assertRaises(RemoteError) as raised:
+            fail("boom")
+        self.assertEqual(raised.exception.error_type, "ValueError")
+        self.assertEqual(raised.exception.message, "boom")
+        self.assertTrue(any("raise ValueError(message)" in line for line in raised.exception.stack_trace))
+        self.assertIn("Remote traceback", str(raised.exception))
+        # user errors are not retried without user_retries.
+        self.assertEqual(backend.invocations, 1)
+
+    def test_user_errors_are_retried_with_user_retries(self):
+        self.assertEqual(flaky(self.directory, 3), 3)
+        with self.assertRaises(RemoteError):
+            flaky(tempfile.mkdtemp(prefix="bauplan-attempts-"), 4)
+
+    def test_user_errors_are_retried_only_when_in_retry_on(self):
+        self.assertEqual(flaky_on_key_errors(self.directory, 2, "KeyError"), 2)
+        with self.assertRaises(RemoteError) as raised:
+            flaky_on_key_errors(tempfile.mkdtemp(prefix="bauplan-attempts-"), 2, "ValueError")
+        self.assertEqual(raised.exception.error_type, "ValueError")
+
+    def test_retries_share_the_idempotency_key(self):
+        flaky(self.directory, 3)
+        keys = recorded_keys(self.directory)
+        self.assertEqual(len(keys), 3)
+        self.assertEqual(len(set(keys)), 1)
+        self.assertTrue(keys[0])
+        flaky(self.directory, 0)
+        self.assertNotEqual(recorded_keys(self.directory)[-1], keys[0])
+
+    def test_transport_errors(self):
+        backend.failures = [ConnectionError("reset")] * 2
+        self.assertEqual(flaky(self.directory, 0), 1)
+        backend.failures = [ConnectionError("reset")] * 3
+        with self.assertRaises(ConnectionError):
+            flaky(self.directory, 0)
+
+    def test_throttles(self):
+        backend.failures = [throttled("Rate Exceeded.")] * 4
+        self.assertEqual(flaky(self.directory, 0), 1)
+        backend.failures = [throttled("Rate Exceeded.")] * 5
+        with self.assertRaises(Exception) as raised:
+            flaky(self.directory, 0)
+        self.assertEqual(raised.exception.response["Error"]["Code"], "TooManyRequestsException")
+
+    def test_platform_errors_are_not_retried_by_default(self):
+        backend.failures = [RemoteError("Runtime.ExitError", "out of memory", [])]
+        with self.assertRaises(RemoteError) as raised:
+            flaky(self.directory, 0)
+        self.assertTrue(raised.exception.is_platform_error)
+        self.assertEqual(backend.invocations, 1)
+
+    def test_platform_retries(self):
+        backend.failures = [RemoteError("Sandbox.Timedout", "timed out", [])]
+        self.assertEqual(echo(7), 7)
+        backend.failures = [RemoteError("Sandbox.Timedout", "timed out", [])] * 2
+        with self.assertRaises(RemoteError) as raised:
+            echo(7)
+        self.assertEqual(raised.exception.error_type, "Sandbox.Timedout")
+
+    def test_budgets_are_kept_per_kind_of_error(self):
+        backend.failures = [ConnectionError("reset"), throttled("Rate Exceeded."), ConnectionError("reset"),
+                            throttled("Rate Exceeded.")]
+        self.assertEqual(flaky(self.directory, 0), 1)
+        self.assertEqual(backend.invocations, 5)
+
+
+class HedgeTest(unittest.TestCase):
+    def setUp(self):
+        backend.failures = []
+        self.directory = tempfile.mkdtemp(prefix="bauplan-attempts-")
+
+    def hedge(self, func) -> HedgePolicy:
+        policy = env._function_hedges[func.__wrapped__]
+        policy.latencies.clear()
+        policy.observe(func.__name__, 0.01)
+        policy.hedged = policy.won = 0
+        return policy
+
+    def test_first_answer_wins(self):
+        policy = self.hedge(straggler)
+        start = time.monotonic()
+        self.assertEqual(straggler(self.directory), 2)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual((policy.hedged, policy.won), (1, 1))
+        # the straggler finishes and fails afterwards, nothing reaches the caller.
+        time.sleep(2.5)
+        keys = recorded_keys(self.directory)
+        self.assertEqual(len(keys), 2)
+        self.assertEqual(len(set(keys)), 1)
+
+    def test_streams_are_not_hedged(self):
+        policy = self.hedge(slow_numbers)
+        self.assertEqual(list(slow_numbers(self.directory, 5)), list(range(5)))
+        self.assertEqual(policy.hedged, 0)
+        self.assertEqual(os.listdir(self.directory), ["1"])
+
+    def test_jobs_are_not_hedged(self):
+        policy = self.hedge(slow_job)
+        self.assertEqual(env.submit(slow_job, self.directory).result(30), 1)
+        self.assertEqual(policy.hedged, 0)
+        self.assertEqual(os.listdir(self.directory), ["1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+from src.bauplan.retries import RemoteError
+
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False)
+
+
+@env.cloud_execute(coalesce=True)
+def slow_square(n: int) -> int:
+    time.sleep(0.5)
+    if n < 0:
+        raise ValueError("negative")
+    return n * n
+
+
+@env.aio_cloud_execute(coalesce=True)
+async def aio_slow_square(n: int) -> int:
+    await asyncio.sleep(0.5)
+    return n * n
+
+
+class SingleFlightTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def invocations(self) -> int:
+        return sum(client.invocations.values())
+
+    def call_at_once(self, args: list) -> list:
+        with ThreadPoolExecutor(len(args)) as threads:
+            futures = [threads.submit(slow_square, n) for n in args]
+            return [future.exception() or future.result() for future in futures]
+
+    def test_identical_calls_share_one_invocation(self):
+        invocations = self.invocations()
+        saved = slow_square.single_flight.saved
+        self.assertEqual(self.call_at_once([3] * 5), [9] * 5)
+        self.assertEqual(self.invocations() - invocations, 1)
+        self.assertEqual(slow_square.single_flight.saved - saved, 4)
+        self.assertEqual(slow_square.single_flight.stats()["in_flight"], 0)
+
+    def test_different_arguments_are_not_coalesced(self):
+        saved = slow_square.single_flight.saved
+        self.assertEqual(self.call_at_once([1, 2, 1]), [1, 4, 1])
+        self.assertEqual(slow_square.single_flight.saved - saved, 1)
+
+    def test_waiters_get_the_exception(self):
+        results = self.call_at_once([-1] * 3)
+        self.assertTrue(all(isinstance(result, RemoteError) for result in results))
+        self.assertIs(results[0], results[1])
+
+    def test_calls_after_the_first_finished_run_again(self):
+        invocations = self.invocations()
+        self.assertEqual([slow_square(5), slow_square(5)], [25, 25])
+        self.assertEqual(self.invocations() - invocations, 2)
+
+    def test_async_callers(self):
+        async def main():
+            return await asyncio.gather(*[aio_slow_square(4) for _ in range(4)])
+
+        invocations = self.invocations()
+        saved = aio_slow_square.single_flight.saved
+        self.assertEqual(asyncio.run(main()), [16] * 4)
+        self.assertEqual(self.invocations() - invocations, 1)
+        self.assertEqual(aio_slow_square.single_flight.saved - saved, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
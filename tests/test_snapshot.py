@@ -0,0 +1,110 @@
+import os
+import tempfile
+import unittest
+
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+from src.bauplan.snapshot import ProjectSnapshot
+
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False)
+
+
+@env.cloud_execute()
+def double(n: int) -> int:
+    return n * 2
+
+
+def write(root: str, relative_path: str, content: str) -> None:
+    path = os.path.join(root, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+    # the snapshot notices changes through mtime and size.
+    os.utime(path, ns=(os.stat(path).st_mtime_ns + 1_000_000, os.stat(path).st_mtime_ns + 1_000_000))
+
+
+class SnapshotTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="bauplan-snapshot-")
+        write(self.root, "main.py", "import helpers\n")
+        write(self.root, "helpers/__init__.py", "VALUE = 1\n")
+        write(self.root, "venv/lib.py", "ignored = True\n")
+        write(self.root, ".hidden/secret.py", "ignored = True\n")
+        write(self.root, "notes.txt", "not python\n")
+        self.snapshot = ProjectSnapshot(self.root)
+
+    def test_full_tree(self):
+        digest = self.snapshot.refresh()
+        delta = self.snapshot.delta()
+        self.assertEqual(delta["digest"], digest)
+        self.assertIsNone(delta["base"])
+        self.assertEqual(set(delta["files"]), {"main.py", "helpers/__init__.py"})
+
+    def test_delta_against_a_previous_tree(self):
+        base = self.snapshot.refresh()
+        write(self.root, "helpers/__init__.py", "VALUE = 2\n")
+        write(self.root, "extra.py", "")
+        os.remove(os.path.join(self.root, "main.py"))
+        digest = self.snapshot.refresh()
+        self.assertNotEqual(digest, base)
+        delta = self.snapshot.delta(base)
+        self.assertEqual(delta["base"], base)
+        self.assertEqual(delta["files"], {"helpers/__init__.py": b"VALUE = 2\n", "extra.py": b""})
+        self.assertEqual(delta["deleted"], ["main.py"])
+
+    def test_unchanged_tree_keeps_its_digest(self):
+        self.assertEqual(self.snapshot.refresh(), self.snapshot.refresh())
+        self.assertEqual(self.snapshot.delta(self.snapshot.digest)["files"], {})
+
+    def test_unknown_base_sends_the_full_tree(self):
+        self.snapshot.refresh()
+        delta = self.snapshot.delta("unknown")
+        self.assertIsNone(delta["base"])
+        self.assertEqual(set(delta["files"]), {"main.py", "helpers/__init__.py"})
+
+    def test_data_patterns(self):
+        self.snapshot.track(["*.txt"])
+        self.snapshot.refresh()
+        self.assertIn("notes.txt", self.snapshot.delta()["files"])
+
+    def test_subsets_are_trees_of_their_own(self):
+        self.snapshot.refresh()
+        subset = self.snapshot.delta(None, frozenset({"main.py"}))
+        self.assertEqual(set(subset["files"]), {"main.py"})
+        self.assertEqual(self.snapshot.delta(subset["digest"], frozenset({"main.py"}))["files"], {})
+
+
+class ProjectShippingTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def invocations(self) -> int:
+        return sum(client.invocations.values())
+
+    def sent(self, n: int) -> int:
+        sent = client.bytes_sent
+        self.assertEqual(double(n), n * 2)
+        return client.bytes_sent - sent
+
+    def test_warm_containers_receive_deltas(self):
+        # without a digest reported by a container the whole tree is sent.
+        env.remote_project_digest = None
+        full = self.sent(1)
+        self.assertLess(self.sent(2), full / 4)
+
+    def test_missing_project_is_sent_again(self):
+        self.assertEqual(double(3), 6)
+        invocations = self.invocations()
+        # the next call lands on a new container, which does not hold the tree the delta is computed against.
+        client.shutdown()
+        self.assertEqual(double(4), 8)
+        self.assertEqual(self.invocations() - invocations, 2)
+        self.assertEqual(double(5), 10)
+        self.assertEqual(self.invocations() - invocations, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
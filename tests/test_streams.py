@@ -0,0 +1,81 @@
+import asyncio
+import tempfile
+import time
+import unittest
+
+from src.bauplan.backends import ProcessPoolBackend
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.lambda_function import STREAM_CHUNK_ITEMS, STREAM_MAX_AHEAD, LocalBlobStore
+
+# streams long enough that writers wait on their readers.
+ITEMS = STREAM_CHUNK_ITEMS * STREAM_MAX_AHEAD * 2
+
+env = LambdaBuilder("role", "local", "streams", backend=ProcessPoolBackend(max_workers=2), thread_count_per_lambda=2,
+                    blob_store=LocalBlobStore(tempfile.mkdtemp(prefix="bauplan-streams-")))
+
+
+@env.cloud_execute()
+def numbers(n: int):
+    for i in range(n):
+        yield i
+
+
+@env.aio_cloud_execute()
+async def aio_numbers(n: int):
+    for i in range(n):
+        yield i
+
+
+class StreamTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+
+    def test_stream(self):
+        self.assertEqual(list(numbers(ITEMS)), list(range(ITEMS)))
+
+    def test_more_async_streams_than_threads(self):
+        async def consume() -> int:
+            return sum([item async for item in aio_numbers(ITEMS)])
+
+        async def main():
+            return await asyncio.wait_for(asyncio.gather(*[consume() for _ in range(env.thread_count * 2)]), 120)
+
+        self.assertEqual(asyncio.run(main()), [sum(range(ITEMS))] * env.thread_count * 2)
+
+    def test_closing_a_stream_early(self):
+        async def main():
+            stream = aio_numbers(ITEMS)
+            first = [item async for item, _ in zip_range(stream, 10)]
+            await stream.aclose()
+            return first
+
+        self.assertEqual(asyncio.run(main()), list(range(10)))
+
+    def test_keys_are_deleted(self):
+        self.assertEqual(list(numbers(STREAM_CHUNK_ITEMS * 3)), list(range(STREAM_CHUNK_ITEMS * 3)))
+        stream = numbers(ITEMS)
+        self.assertEqual(next(stream), 0)
+        stream.close()
+        wait_for(lambda: env.result_store.list_keys(f"stream-{env.job_session}-") == [])
+
+
+def wait_for(condition, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise TimeoutError("condition not met in time")
+        time.sleep(0.01)
+
+
+async def zip_range(stream, n: int):
+    index = 0
+    async for item in stream:
+        yield item, index
+        index += 1
+        if index == n:
+            return
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from src.bauplan import symbols
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+from src.bauplan.snapshot import ProjectSnapshot
+from src.bauplan.symbols import SymbolIndex, parse_symbols
+
+client = FakeLambdaClient() if "AWS_LAMBDA_FUNCTION_NAME" not in os.environ else None
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False)
+
+PROJECT = {
+    "a.py": "def work():\n    pass\n",
+    "b.py": "\n\ndef work():\n    pass\n",
+    "pkg/__init__.py": "",
+    "pkg/c.py": "class Job:\n    def work(self):\n        pass\n\n\ndef outer():\n    def inner():\n        pass\n",
+}
+
+
+# a function the way a notebook or exec defines it: its code does not point at a file.
+def define(source: str, name: str, module: str = "__main__"):
+    namespace = {"__name__": module}
+    exec(compile(source, "<cell>", "exec"), namespace)
+    return namespace[name]
+
+
+class SymbolIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp(prefix="bauplan-symbols-")
+        for relative_path, content in PROJECT.items():
+            self.write(relative_path, content)
+        self.snapshot = ProjectSnapshot(self.root)
+        self.snapshot.refresh()
+        self.cache_path = os.path.join(self.root, ".bauplan", "symbols.json")
+
+    def write(self, relative_path: str, content: str) -> None:
+        path = os.path.join(self.root, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as file:
+            file.write(content)
+
+    def test_qualified_names(self):
+        self.assertEqual(parse_symbols(PROJECT["pkg/c.py"].encode()),
+                         {"Job.work": 2, "outer": 6, "outer.<locals>.inner": 7})
+        index = SymbolIndex(self.snapshot)
+        self.assertEqual(index.find(define("def outer():\n    pass\n", "outer")), "pkg/c.py")
+
+    def test_same_name_told_apart_by_module(self):
+        index = SymbolIndex(self.snapshot)
+        self.assertEqual(index.find(define("def work():\n    pass\n", "work", "b")), "b.py")
+
+    def test_same_name_told_apart_by_line(self):
+        index = SymbolIndex(self.snapshot)
+        self.assertEqual(index.find(define("\n\ndef work():\n    pass\n", "work")), "b.py")
+        self.assertEqual(index.find(define("def work():\n    pass\n", "work")), "a.py")
+
+    def test_ambiguous_and_unknown_functions(self):
+        index = SymbolIndex(self.snapshot)
+        with self.assertRaises(Exception):
+            index.find(define("\n\n\n\ndef work():\n    pass\n", "work"))
+        with self.assertRaises(Exception):
+            index.find(define("def missing():\n    pass\n", "missing"))
+
+    def test_persisted_symbols_are_not_parsed_again(self):
+        SymbolIndex(self.snapshot, self.cache_path).find(define("def outer():\n    pass\n", "outer"))
+        self.assertTrue(os.path.exists(self.cache_path))
+        self.write("a.py", "def work():\n    pass\n\n\ndef rest():\n    pass\n")
+        self.snapshot.refresh()
+        with mock.patch.object(symbols, "parse_symbols", wraps=parse_symbols) as parse:
+            index = SymbolIndex(self.snapshot, self.cache_path)
+            self.assertEqual(index.find(define("def rest():\n    pass\n", "rest")), "a.py")
+        # only the file that changed since the index was saved is parsed.
+        self.assertEqual(parse.call_count, 1)
+
+    def test_deleted_files_leave_the_index(self):
+        index = SymbolIndex(self.snapshot)
+        os.remove(os.path.join(self.root, "a.py"))
+        self.snapshot.refresh()
+        self.assertEqual(index.find(define("def work():\n    pass\n", "work")), "b.py")
+
+
+class NotebookFunctionTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def test_functions_without_a_file_are_located(self):
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "notebook_cells.py")
+        with open(path) as file:
+            notebook_triple = define(file.read(), "notebook_triple")
+        self.assertEqual(env._prepare_function(notebook_triple.__wrapped__).filename, "tests/notebook_cells.py")
+        self.assertEqual(notebook_triple(5), 15)
+
+
+if __name__ == "__main__":
+    unittest.main()
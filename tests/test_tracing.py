@@ -0,0 +1,84 @@
+import unittest
+from typing import Dict, List
+
+from src.bauplan.lambda_builder import LambdaBuilder
+from src.bauplan.local_lambda import FakeLambdaClient
+from src.bauplan.policy import ExecutionPolicy
+from src.bauplan.tracing import MemorySink, Tracer
+
+# calls made inside a container go through a fake client of their own, running nested containers.
+client = FakeLambdaClient()
+sink = MemorySink()
+env = LambdaBuilder("role", "local", "bauplan", lambda_client=client, auto_deploy=False, tracer=Tracer(sink))
+
+
+@env.cloud_execute()
+def inner(n: int) -> int:
+    return n + 1
+
+
+@env.cloud_execute()
+def outer(n: int) -> int:
+    return inner(n) * 2
+
+
+# nested calls past the first hop run in process.
+@env.cloud_execute(policy=ExecutionPolicy(max_depth=1))
+def shallow(n: int) -> int:
+    return n if n == 0 else shallow(n - 1) + 1
+
+
+# (kind, name) of every span below parent_id, depth first.
+def tree(spans: List[Dict], parent_id=None) -> list:
+    children = sorted((span for span in spans if span["parent_id"] == parent_id), key=lambda span: span["start"])
+    return [((span["kind"], span["name"]), tree(spans, span["span_id"])) for span in children]
+
+
+class TracingTest(unittest.TestCase):
+    @classmethod
+    def tearDownClass(cls):
+        env.shutdown()
+        client.shutdown()
+
+    def setUp(self):
+        sink.spans.clear()
+
+    def test_nested_calls_form_one_tree(self):
+        self.assertEqual(outer(1), 4)
+        traces = sink.traces()
+        self.assertEqual(len(traces), 1)
+        spans = next(iter(traces.values()))
+        self.assertEqual(tree(spans), [
+            (("client", "outer"), [
+                (("handler", "outer"), [
+                    (("client", "inner"), [
+                        (("handler", "inner"), [])])])])])
+
+    def test_spans_carry_stages_and_sizes(self):
+        outer(1)
+        by_kind = {(span["kind"], span["name"]): span for span in sink.spans}
+        client_span, handler_span = by_kind[("client", "outer")], by_kind[("handler", "outer")]
+        self.assertIn("invoke", client_span["stages"])
+        self.assertIn("request_bytes", client_span["sizes"])
+        self.assertIn("call", handler_span["stages"])
+        self.assertIsNotNone(client_span["cold"])
+        # the client span includes the handler's.
+        self.assertGreaterEqual(client_span["duration_ms"], handler_span["duration_ms"])
+
+    def test_in_process_calls(self):
+        self.assertEqual(shallow(2), 2)
+        spans = next(iter(sink.traces().values()))
+        self.assertEqual(tree(spans), [
+            (("client", "shallow"), [
+                (("handler", "shallow"), [
+                    (("in_process", "shallow"), [
+                        (("in_process", "shallow"), [])])])])])
+
+    def test_separate_calls_are_separate_traces(self):
+        inner(1)
+        inner(2)
+        self.assertEqual(len(sink.traces()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,131 @@
+import os
+import sysconfig
+import tempfile
+import unittest
+import zipfile
+from typing import List
+
+from src.bauplan.utils import (find_cached_wheel, install_requirements, is_pure_wheel, parse_wheel_filename,
+                               resolve_requirements)
+
+PLATFORMS = ["manylinux2014_x86_64"]
+
+
+class FindCachedWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+
+    def add(self, *filenames: str) -> None:
+        for filename in filenames:
+            open(os.path.join(self.directory.name, filename), "wb").close()
+
+    def find(self, package: str, version: str, python_version: str = "3.10") -> str:
+        wheel = find_cached_wheel(self.directory.name, package, version, python_version, PLATFORMS)
+        return os.path.basename(wheel) if wheel is not None else None
+
+    def test_version_must_match_exactly(self):
+        self.add("pytz-2023.3.post1-py2.py3-none-any.whl")
+        self.assertIsNone(self.find("pytz", "2023.3"))
+        self.add("pytz-2023.3-py2.py3-none-any.whl")
+        self.assertEqual(self.find("pytz", "2023.3"), "pytz-2023.3-py2.py3-none-any.whl")
+
+    def test_name_must_match_exactly(self):
+        self.add("typing_extensions_more-1.0-py3-none-any.whl")
+        self.assertIsNone(self.find("typing-extensions", "1.0"))
+        self.add("typing_extensions-1.0-py3-none-any.whl")
+        self.assertEqual(self.find("Typing.Extensions", "1.0"), "typing_extensions-1.0-py3-none-any.whl")
+
+    def test_platform_must_match(self):
+        self.add("numpy-1.26.0-cp310-cp310-macosx_11_0_arm64.whl")
+        self.assertIsNone(self.find("numpy", "1.26.0"))
+        self.add("numpy-1.26.0-cp310-cp310-manylinux_2_17_x86_64.manylinux2014_x86_64.whl")
+        self.assertEqual(self.find("numpy", "1.26.0"),
+                         "numpy-1.26.0-cp310-cp310-manylinux_2_17_x86_64.manylinux2014_x86_64.whl")
+
+    def test_newer_glibc_is_rejected(self):
+        self.add("polars-0.20.0-cp38-abi3-manylinux_2_28_x86_64.whl")
+        self.assertIsNone(self.find("polars", "0.20.0"))
+
+    def test_python_version_must_match(self):
+        self.add("numpy-1.26.0-cp311-cp311-manylinux2014_x86_64.whl")
+        self.assertIsNone(self.find("numpy", "1.26.0"))
+        self.assertIsNotNone(self.find("numpy", "1.26.0", python_version="3.11"))
+
+    def test_stable_abi_runs_on_newer_pythons(self):
+        self.add("cryptography-41.0.0-cp37-abi3-manylinux_2_17_x86_64.whl")
+        self.assertIsNotNone(self.find("cryptography", "41.0.0"))
+
+    def test_parse_wheel_filename(self):
+        self.assertEqual(parse_wheel_filename("six-1.16.0-py2.py3-none-any.whl"),
+                         ("six", "1.16.0", [("py2", "none", "any"), ("py3", "none", "any")]))
+        self.assertIsNone(parse_wheel_filename("six-1.16.0.tar.gz"))
+
+
+class IsPureWheelTest(unittest.TestCase):
+    def test_pure_wheels(self):
+        self.assertTrue(is_pure_wheel("six-1.16.0-py2.py3-none-any.whl", "3.10"))
+        self.assertFalse(is_pure_wheel("numpy-1.26.0-cp310-cp310-linux_x86_64.whl", "3.10"))
+        self.assertFalse(is_pure_wheel("numpy-1.26.0-cp310-cp310-macosx_11_0_arm64.whl", "3.10"))
+
+
+# a wheel with a single module, named after the distribution.
+def make_wheel(directory: str, name: str, version: str, tag: str = "py3-none-any", requires: List[str] = ()) -> str:
+    filename = f"{name}-{version}-{tag}.whl"
+    dist_info = f"{name}-{version}.dist-info"
+    metadata = f"Metadata-Version: 2.1\nName: {name}\nVersion: {version}\n" + \
+        "".join(f"Requires-Dist: {requirement}\n" for requirement in requires)
+    with zipfile.ZipFile(os.path.join(directory, filename), "w") as wheel:
+        wheel.writestr(f"{name}/__init__.py", f"VERSION = {version!r}\n")
+        wheel.writestr(f"{dist_info}/METADATA", metadata)
+        wheel.writestr(f"{dist_info}/WHEEL", f"Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: {tag}\n")
+        wheel.writestr(f"{dist_info}/RECORD", "")
+    return filename
+
+
+class OfflineBuildTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.wheelhouse = os.path.join(self.directory.name, "wheelhouse")
+        self.wheel_cache_dir = os.path.join(self.directory.name, "wheels")
+        os.makedirs(self.wheelhouse)
+        make_wheel(self.wheelhouse, "bauplan_fixture", "1.0", requires=["bauplan_fixture_dep>=2"])
+        make_wheel(self.wheelhouse, "bauplan_fixture_dep", "2.0")
+
+    def resolutions(self) -> List[str]:
+        return os.listdir(os.path.join(self.wheel_cache_dir, "resolutions"))
+
+    def test_offline_build_from_a_wheelhouse(self):
+        target = os.path.join(self.directory.name, "target")
+        report = install_requirements({"bauplan_fixture": "1.0"}, target, "python3.10",
+                                      wheel_cache_dir=self.wheel_cache_dir, wheelhouse=self.wheelhouse, offline=True)
+        self.assertEqual(sorted(package["package"] for package in report["packages"]),
+                         ["bauplan_fixture", "bauplan_fixture_dep"])
+        self.assertTrue(os.path.exists(os.path.join(target, "bauplan_fixture", "__init__.py")))
+        self.assertTrue(os.path.exists(os.path.join(target, "bauplan_fixture_dep", "__init__.py")))
+        self.assertEqual(len(self.resolutions()), 1)
+
+    def test_resolutions_are_keyed_by_the_wheelhouse(self):
+        resolve = lambda wheelhouse, offline: resolve_requirements(  # noqa: E731
+            {"bauplan_fixture": "1.0"}, "3.10", PLATFORMS, self.wheel_cache_dir, wheelhouse, offline)
+        self.assertEqual(resolve(self.wheelhouse, True)["bauplan_fixture_dep"], "2.0")
+        make_wheel(self.wheelhouse, "bauplan_fixture_dep", "2.1")
+        self.assertEqual(resolve(self.wheelhouse, True)["bauplan_fixture_dep"], "2.1")
+        other_wheelhouse = os.path.join(self.directory.name, "other")
+        os.makedirs(other_wheelhouse)
+        with self.assertRaises(Exception):
+            resolve(other_wheelhouse, True)
+        self.assertEqual(len(self.resolutions()), 2)
+
+    def test_resolutions_for_this_machine_are_not_cached(self):
+        tag = f"py3-none-{sysconfig.get_platform().replace('-', '_').replace('.', '_')}"
+        make_wheel(self.wheelhouse, "bauplan_native", "1.0", tag)
+        resolved = resolve_requirements({"bauplan_native": "1.0"}, "3.10", PLATFORMS, self.wheel_cache_dir,
+                                        self.wheelhouse, True)
+        self.assertEqual(resolved, {"bauplan_native": "1.0"})
+        self.assertEqual(self.resolutions(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()